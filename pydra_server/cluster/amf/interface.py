@@ -170,11 +170,9 @@ class AMFInterface(pb.Root):
                 for i in range(node.cores):
                     w_key = '%s:%s:%i' % (node.host, node.port, i)
                     html_key = '%s_%i' % (node.id, i)
-                    if w_key in self.master._workers_idle:
-                        worker_status[html_key] = (1,-1,-1)
-                    elif w_key in self.master._workers_working:
-                        task_instance_id, task_key, args, subtask_key, workunit_key = self.master._workers_working[w_key]
-                        worker_status[html_key] = (1,task_key,subtask_key if subtask_key else -1)
+                    slots = self.master._slots.status(w_key)
+                    if slots:
+                        worker_status[html_key] = self.worker_status(slots)
                     else:
                         worker_status[html_key] = -1
 
@@ -188,6 +186,26 @@ class AMFInterface(pb.Root):
         return node_status
 
 
+    def worker_status(self, slots):
+        """
+        Returns status of a connected worker: (1, task_key, subtask_key, slots)
+        where the task is the one of the first working slot (-1 if idle) and
+        slots is a list of (task_key, subtask_key) of every slot
+        """
+        slot_status = []
+        for slot, job in sorted(slots.items()):
+            if job:
+                task_instance_id, task_key, args, subtask_key, workunit_key = job
+                slot_status.append((task_key, subtask_key if subtask_key else -1))
+            else:
+                slot_status.append((-1, -1))
+
+        working = [status for status in slot_status if status[0] != -1]
+        task_key, subtask_key = working[0] if working else (-1, -1)
+
+        return (1, task_key, subtask_key, slot_status)
+
+
     @authenticated
     def list_tasks(self, _):
         """
@@ -47,34 +47,34 @@ class WorkerAvatar(RSAAvatar):
         self.remote = None
 
 
-    def perspective_failed(self, message, workunit_key):
+    def perspective_failed(self, message, workunit_key, slot=0):
         """
         Called by workers when they task they were running threw an exception
         """
-        return self.server.task_failed(self.name, message, workunit_key)
+        return self.server.task_failed(self.name, message, workunit_key, slot)
 
 
-    def perspective_send_results(self, results, workunit_key):
+    def perspective_send_results(self, results, workunit_key, slot=0):
         """
         Called by workers when they have completed their task and need to report the results.
         * Tasks runtime and log should be saved in the database
         """
-        return self.server.send_results(self.name, results, workunit_key)
+        return self.server.send_results(self.name, results, workunit_key, slot)
 
-    def perspective_stopped(self):
+    def perspective_stopped(self, slot=0):
         """
         Called by workers when they have stopped themselves because of a stop_task call
         This response may be delayed because there is no guaruntee that the Task will
         respect the STOP_FLAG.  Until this callback is made the Worker is still working
         """
-        return self.server.worker_stopped(self.name)
+        return self.server.worker_stopped(self.name, slot)
 
-    def perspective_request_worker(self, subtask_key, args, workunit_key):
+    def perspective_request_worker(self, subtask_key, args, workunit_key, slot=0):
         """
         Called by workers running a Parallel task.  This is a request
         for a worker in the cluster to process the args sent
         """
-        return self.server.request_worker(self, subtask_key, args, workunit_key)
+        return self.server.request_worker(self, subtask_key, args, workunit_key, slot)
 
 
     def perspective_task_status(self):
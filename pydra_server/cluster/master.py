@@ -67,6 +67,7 @@ from dbus.mainloop.glib import DBusGMainLoop
 
 from pydra_server.models import Node, TaskInstance, pydraSettings
 from pydra_server.cluster.constants import *
+from pydra_server.cluster.slots import WorkerSlots
 from pydra_server.cluster.tasks.task_manager import TaskManager
 from pydra_server.cluster.tasks import STATUS_STOPPED, STATUS_RUNNING, STATUS_COMPLETE, STATUS_CANCELLED, STATUS_FAILED
 from pydra_server.cluster.auth.rsa_auth import RSAClient, load_crypto
@@ -121,7 +122,7 @@ class Master(object):
 
         #load tasks queue
         self._running = list(TaskInstance.objects.running())
-        self._running_workers = {}
+        self._running_workers = {}     # task_instance_id -> (worker_key, slot) of its main worker
         self._queue = list(TaskInstance.objects.queued())
 
         #task statuses
@@ -132,8 +133,7 @@ class Master(object):
         self.workers = {}
         self.nodes = self.load_nodes()
         self.known_nodes = set()
-        self._workers_idle = []
-        self._workers_working = {}
+        self._slots = WorkerSlots()    # idle and working slots of workers
 
         #connection management
         self.connecting = True
@@ -463,39 +463,39 @@ class Master(object):
         1) Only the worker was started/restarted, it is idle
         2) Only master was restarted.  Workers previous status must be reestablished
 
-        The best way to determine the state of the worker is to ask it.  It will return its status
-        plus any relevent information for reestablishing it's status
+        The best way to determine the state of the worker is to ask it.  It will return the status
+        of each of its slots plus any relevent information for reestablishing it's status
         """
-        # worker is working and it was the master for its task
-        if result[0] == WORKER_STATUS_WORKING:
-            logger.info('worker:%s - is still working' % worker_key)
-            #record what the worker is working on
-            #self._workers_working[worker_key] = task_key
+        for slot, status in enumerate(result):
+            # slot is working and it was the master for its task
+            if status[0] == WORKER_STATUS_WORKING:
+                logger.info('worker:%s - slot %d is still working' % (worker_key, slot))
+                #record what the slot is working on
+                #self._slots.working[worker_key][slot] = task_key
 
-        # worker is finished with a task
-        elif result[0] == WORKER_STATUS_FINISHED:
-            logger.info('worker:%s - was finished, requesting results' % worker_key)
-            #record what the worker is working on
-            #self._workers_working[worker_key] = task_key
+            # slot is finished with a task
+            elif status[0] == WORKER_STATUS_FINISHED:
+                logger.info('worker:%s - slot %d was finished, requesting results' % (worker_key, slot))
+                #record what the slot is working on
+                #self._slots.working[worker_key][slot] = task_key
 
-            #check if the Worker acting as master for this task is ready
-            if (True):
-                #TODO
-                pass
+                #check if the Worker acting as master for this task is ready
+                if (True):
+                    #TODO
+                    pass
 
-            #else not ready to send the results
-            else:
-                #TODO
-                pass
+                #else not ready to send the results
+                else:
+                    #TODO
+                    pass
 
-        #otherwise its idle
-        else:
-            with self._lock:
-                self.workers[worker_key] = worker
-                # worker shouldn't already be in the idle queue but check anyway
-                if not worker_key in self._workers_idle:
-                    self._workers_idle.append(worker_key)
-                    logger.info('worker:%s - added to idle workers' % worker_key)
+            #otherwise its idle
+            else:
+                with self._lock:
+                    self.workers[worker_key] = worker
+                    # slot shouldn't already be in the idle queue but check anyway
+                    if self._slots.add_idle(worker_key, slot):
+                        logger.info('worker:%s - slot %d added to idle workers' % (worker_key, slot))
 
 
     def remove_worker(self, worker_key):
@@ -503,31 +503,29 @@ class Master(object):
         Called when a worker disconnects
         """
         with self._lock:
-            # if idle, just remove it.  no need to do anything else
-            if worker_key in self._workers_idle:
-                logger.info('worker:%s - removing worker from idle pool' % worker_key)
-                self._workers_idle.remove(worker_key)
+            # idle slots are just removed.  no need to do anything else
+            logger.info('worker:%s - removing worker from idle pool' % worker_key)
+            working = self._slots.remove_worker(worker_key)
 
-            #worker was working on a task, need to clean it up
-            else:
-                removed_worker = self._workers_working[worker_key]
+            #slots working on a task, need to clean them up
+            for slot, removed_worker in working.items():
 
-                #worker was working on a subtask, return unfinished work to main worker
+                #slot was working on a subtask, return unfinished work to main worker
                 if removed_worker[3]:
                     logger.warning('%s failed during task, returning work unit' % worker_key)
-                    task_instance = TaskInstance.objects.get(id=removed_worker[0])
-                    main_worker = self.workers[task_instance.worker]
+                    main_worker_key, main_slot = self._running_workers.get(removed_worker[0], (None, None))
+                    main_worker = self.workers.get(main_worker_key)
                     if main_worker:
-                        d = main_worker.remote.callRemote('return_work', removed_worker[3], removed_worker[4])
-                        d.addCallback(self.return_work_success, worker_key)
-                        d.addErrback(self.return_work_failed, worker_key)
+                        d = main_worker.remote.callRemote('return_work', removed_worker[3], removed_worker[4], main_slot)
+                        d.addCallback(self.return_work_success, worker_key, slot)
+                        d.addErrback(self.return_work_failed, worker_key, slot)
 
                     else:
                         #if we don't have a main worker listed it probably already was disconnected
-                        #just call successful to clean up the worker
-                        self.return_work_success(None, worker_key)
+                        #just clean up the slot, the lock is already held
+                        self._slots.release(worker_key, slot, idle=False)
 
-                #worker was main worker for a task.  cancel the task and tell any
+                #slot was main worker for a task.  cancel the task and tell any
                 #workers working on subtasks to stop.  Cannot recover from the 
                 #main worker going down
                 else:
@@ -535,15 +533,15 @@ class Master(object):
                     pass
 
 
-    def return_work_success(self, results, worker_key):
+    def return_work_success(self, results, worker_key, slot):
         """
         Work was sucessful returned to the main worker
         """
         with self._lock:
-            del self._workers_working[worker_key]
+            self._slots.release(worker_key, slot, idle=False)
 
 
-    def return_work_failed(self, results, worker_key):
+    def return_work_failed(self, results, worker_key, slot):
         """
         A worker disconnected and the method call to return the work failed
         """
@@ -552,19 +550,19 @@ class Master(object):
 
     def select_worker(self, task_instance_id, task_key, args={}, subtask_key=None, workunit_key=None):
         """
-        Select a worker to use for running a task or subtask
+        Select a worker slot to use for running a task or subtask, returns
+        the worker and the slot
         """
         #lock, selecting workers must be threadsafe
         with self._lock:
-            if len(self._workers_idle):
-                #move the first worker to the working state storing the task its working on
-                worker_key = self._workers_idle.pop(0)
-                self._workers_working[worker_key] = (task_instance_id, task_key, args, subtask_key, workunit_key)
+            #move the first slot to the working state storing the task its working on
+            worker_key, slot = self._slots.select((task_instance_id, task_key, args, subtask_key, workunit_key))
 
+            if worker_key:
                 #return the worker object, not the key
-                return self.workers[worker_key]
+                return self.workers[worker_key], slot
             else:
-                return None
+                return None, None
 
 
     def queue_task(self, task_key, args={}, subtask_key=None):
@@ -606,13 +604,14 @@ class Master(object):
             else:
                 logger.debug('Cancelling Task, is running: %s' % task_id)
                 #get all the workers to stop
-                for worker_key, worker_task in self._workers_working.items():
+                for worker_key, slot, worker_task in self._slots.jobs():
                     if worker_task[0] == task_id:
                         worker = self.workers[worker_key]
                         logger.debug('signalling worker to stop: %s' % worker_key)
-                        worker.remote.callRemote('stop_task')
+                        worker.remote.callRemote('stop_task', slot)
 
                 self._running.remove(task_instance)
+                self._running_workers.pop(task_id, None)
 
             task_instance.completion_type = STATUS_CANCELLED
             task_instance.save()
@@ -663,15 +662,15 @@ class Master(object):
         sharing logic should be handled within select_worker() to keep the logic organized.
         """
 
-        # get a worker for this task
-        worker = self.select_worker(task_instance_id, task_key, args, subtask_key, workunit_key)
-        # determine how many workers are available for this task
-        available_workers = len(self._workers_idle)+1
+        # get a worker slot for this task
+        worker, slot = self.select_worker(task_instance_id, task_key, args, subtask_key, workunit_key)
+        # determine how many worker slots are available for this task
+        available_workers = len(self._slots)+1
 
         if worker:
-            logger.debug('Worker:%s - Assigned to task: %s:%s %s' % (worker.name, task_key, subtask_key, args))
-            d = worker.remote.callRemote('run_task', task_key, args, subtask_key, workunit_key, available_workers)
-            d.addCallback(self.run_task_successful, worker, task_instance_id, subtask_key)
+            logger.debug('Worker:%s - Assigned to task (slot %d): %s:%s %s' % (worker.name, slot, task_key, subtask_key, args))
+            d = worker.remote.callRemote('run_task', task_key, args, subtask_key, workunit_key, available_workers, slot)
+            d.addCallback(self.run_task_successful, worker, slot, task_instance_id, subtask_key)
             return worker
 
         # no worker was available
@@ -681,7 +680,7 @@ class Master(object):
             logger.warning('No worker available')
             return None
 
-    def run_task_successful(self, results, worker, task_instance_id, subtask_key=None):
+    def run_task_successful(self, results, worker, slot, task_instance_id, subtask_key=None):
 
         #save the history of what workers work on what task/subtask
         #its needed for tracking finished work in ParallelTasks and will aide in Fault recovery
@@ -695,8 +694,11 @@ class Master(object):
             task_instance.worker = worker.name
             task_instance.save()
 
+            # subtask results are sent to the slot running the main task
+            self._running_workers[task_instance_id] = (worker.name, slot)
+
 
-    def send_results(self, worker_key, results, workunit_key):
+    def send_results(self, worker_key, results, workunit_key, slot=0):
         """
         Called by workers when they have completed their task.
 
@@ -704,15 +706,14 @@ class Master(object):
         """
         logger.debug('Worker:%s - sent results: %s' % (worker_key, results))
         with self._lock:
-            task_instance_id, task_key, args, subtask_key, workunit_key = self._workers_working[worker_key]
+            task_instance_id, task_key, args, subtask_key, workunit_key = self._slots.job(worker_key, slot)
             logger.info('Worker:%s - completed: %s:%s (%s)' % (worker_key, task_key, subtask_key, workunit_key))
 
-            # release the worker back into the idle pool
+            # release the slot back into the idle pool
             # this must be done before informing the 
             # main worker.  otherwise a new work request
-            # can be made before the worker is released
-            del self._workers_working[worker_key]
-            self._workers_idle.append(worker_key)
+            # can be made before the slot is released
+            self._slots.release(worker_key, slot)
 
             #if this was the root task for the job then save info.  Ignore the fact that the task might have
             #been canceled.  If its 100% complete, then mark it as such.
@@ -729,6 +730,7 @@ class Master(object):
                     except ValueError:
                         # was already removed by cancel
                         pass
+                    self._running_workers.pop(task_instance_id, None)
 
             else:
                 #check to make sure the task was still in the queue.  Its possible this call was made at the same
@@ -738,10 +740,10 @@ class Master(object):
                 with self._lock_queue:
                     if task_instance in self._running:
                         #if this was a subtask the main task needs the results and to be informed
-                        task_instance = TaskInstance.objects.get(id=task_instance_id)
-                        main_worker = self.workers[task_instance.worker]
-                        logger.debug('Worker:%s - informed that subtask completed' % task_instance.worker)
-                        main_worker.remote.callRemote('receive_results', results, subtask_key, workunit_key)
+                        main_worker_key, main_slot = self._running_workers[task_instance_id]
+                        main_worker = self.workers[main_worker_key]
+                        logger.debug('Worker:%s - informed that subtask completed' % main_worker_key)
+                        main_worker.remote.callRemote('receive_results', results, subtask_key, workunit_key, main_slot)
                     else:
                         logger.debug('Worker:%s - returned a subtask but the task is no longer running.  discarding value.' % worker_key)
 
@@ -749,12 +751,12 @@ class Master(object):
         self.advance_queue()
 
 
-    def task_failed(self, worker_key, results, workunit_key):
+    def task_failed(self, worker_key, results, workunit_key, slot=0):
         """
         Called by workers when the task they were running throws an exception
         """
         with self._lock:
-            task_instance_id, task_key, args, subtask_key, workunit_key = self._workers_working[worker_key]
+            task_instance_id, task_key, args, subtask_key, workunit_key = self._slots.job(worker_key, slot)
             logger.info('Worker:%s - failed: %s:%s (%s)' % (worker_key, task_key, subtask_key, workunit_key))
 
 
@@ -763,20 +765,19 @@ class Master(object):
             # is not included for now.
             with self._lock_queue:
 
-                # release the worker back into the idle pool
-                del self._workers_working[worker_key]
-                self._workers_idle.append(worker_key)
+                # release the slot back into the idle pool
+                self._slots.release(worker_key, slot)
 
                 task_instance = TaskInstance.objects.get(id=task_instance_id)
                 task_instance.completed = datetime.datetime.now()
                 task_instance.completion_type = STATUS_FAILED
                 task_instance.save()
 
-                for worker_key, worker_task in self._workers_working.items():
+                for worker_key, slot, worker_task in self._slots.jobs():
                     if worker_task[0] == task_instance_id:
                         worker = self.workers[worker_key]
                         logger.debug('signalling worker to stop: %s' % worker_key)
-                        worker.remote.callRemote('stop_task')
+                        worker.remote.callRemote('stop_task', slot)
 
                 #remove task instance from running queue
                 try:
@@ -784,6 +785,7 @@ class Master(object):
                 except ValueError:
                     # was already removed
                     pass
+                self._running_workers.pop(task_instance_id, None)
 
         #attempt to advance the queue
         self.advance_queue()
@@ -807,11 +809,11 @@ class Master(object):
         now = datetime.datetime.now()
         if self._next_task_status_update < now:
             workers = self.workers
-            for key, data in self._workers_working.items():
+            for key, slot, data in self._slots.jobs():
                 if not data[3]:
                     worker = workers[key]
                     task_instance_id = data[0]
-                    deferred = worker.remote.callRemote('task_status')
+                    deferred = worker.remote.callRemote('task_status', slot)
                     deferred.addCallback(self.fetch_task_status_success, task_instance_id)
             self.next_task_status_update = now + datetime.timedelta(0, 3)
 
@@ -856,25 +858,24 @@ class Master(object):
         return statuses
 
 
-    def worker_stopped(self, worker_key):
+    def worker_stopped(self, worker_key, slot=0):
         """
         Called by workers when they have stopped due to a cancel task request.
         """
         with self._lock:
             logger.info(' Worker:%s - stopped' % worker_key)
 
-            # release the worker back into the idle pool
+            # release the slot back into the idle pool
             # this must be done before informing the 
             # main worker.  otherwise a new work request
-            # can be made before the worker is released
-            del self._workers_working[worker_key]
-            self._workers_idle.append(worker_key)
+            # can be made before the slot is released
+            self._slots.release(worker_key, slot)
 
         #attempt to advance the queue
         self.advance_queue()
 
 
-    def request_worker(self, workerAvatar, subtask_key, args, workunit_key):
+    def request_worker(self, workerAvatar, subtask_key, args, workunit_key, slot=0):
         """
         Called by workers running a Parallel task.  This is a request
         for a worker in the cluster to process a workunit from a task
@@ -883,7 +884,7 @@ class Master(object):
         #get the task key and run the task.  The key is looked up
         #here so that a worker can only request a worker for the 
         #their current task.
-        worker = self._workers_working[workerAvatar.name]
+        worker = self._slots.job(workerAvatar.name, slot)
         task_instance = TaskInstance.objects.get(id=worker[0])
         logger.debug('Worker:%s - request for worker: %s:%s' % (workerAvatar.name, subtask_key, args))
 
@@ -49,6 +49,7 @@ from subprocess import Popen
 import platform, dbus, avahi
 from pydra_server.cluster.auth.rsa_auth import load_crypto
 from pydra_server.cluster.auth.master_avatar import MasterAvatar
+from pydra_server.cluster.shuffle import get_shuffle_service
 
 
 # init logging
@@ -147,6 +148,22 @@ class NodeServer:
         return internet.TCPServer(self.port, factory)
 
 
+    def get_shuffle_service(self):
+        """
+        Creates a service serving node-local intermediate results of map-reduce
+        tasks to workers on other nodes, None if settings.SHUFFLE_DIR is not set.
+        The server removes files on request of any host, so it runs only when
+        it is configured
+        """
+        dir = getattr(settings, 'SHUFFLE_DIR', None)
+        if not dir:
+            return None
+
+        port = getattr(settings, 'SHUFFLE_PORT', 11891)
+        logger.info('Node - starting shuffle server on port %s' % port)
+        return get_shuffle_service(dir, port)
+
+
     def determine_info(self):
         """
         Builds a dictionary of useful information about this Node
@@ -183,10 +200,12 @@ class NodeServer:
 
     def start_workers(self):
         """
-        Starts all of the workers.  By default there will be one worker for each core
+        Starts all of the workers.  By default there will be one worker for each core, each
+        of them running settings.WORKER_SLOTS tasks at once
         """
+        slots = getattr(settings, 'WORKER_SLOTS', 1)
         self.pids = [
-            Popen(["python", "pydra_server/cluster/worker.py", self.master_host, str(self.master_port), self.node_key, '%s:%s' % (self.node_key, i)]).pid 
+            Popen(["python", "pydra_server/cluster/worker.py", self.master_host, str(self.master_port), self.node_key, '%s:%s' % (self.node_key, i), str(slots)]).pid 
             for i in range(self.info['cores'])
             ]
 
@@ -230,3 +249,7 @@ node_server = NodeServer()
 # attach service
 service = node_server.get_service()
 service.setServiceParent(application)
+
+shuffle_service = node_server.get_shuffle_service()
+if shuffle_service:
+    shuffle_service.setServiceParent(application)
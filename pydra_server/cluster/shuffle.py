@@ -0,0 +1,60 @@
+"""
+    Copyright 2009 Oregon State University
+
+    This file is part of Pydra.
+
+    Pydra is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Pydra is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Pydra.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os, logging
+
+from twisted.web import static, server, resource, http
+from twisted.application import internet
+
+logger = logging.getLogger('root')
+
+
+class ShuffleResource(static.File):
+    """
+    Serves intermediate results files of a node-local directory to reducers
+    on other nodes (see DatasourceShuffle).  GET supports byte ranges,
+    DELETE removes a file once it was merged or its task was discarded.
+    """
+
+    # only intermediate results files may be removed
+    prefix = 'mapreduce-i9e-'
+
+    def render_DELETE(self, request):
+        filename = os.path.basename(self.path)
+
+        if not filename.startswith(self.prefix) or not os.path.isfile(self.path):
+            request.setResponseCode(http.NOT_FOUND)
+            return ''
+
+        logger.debug('shuffle: removing %s' % filename)
+        os.remove(self.path)
+        return ''
+
+
+def get_shuffle_service(dir, port):
+    """
+    Creates a service serving files of dir over HTTP on port
+    """
+    if not os.path.isdir(dir):
+        os.makedirs(dir)
+
+    root = ShuffleResource(dir)
+    root.directoryListing = lambda: resource.ForbiddenResource()
+
+    return internet.TCPServer(port, server.Site(root))
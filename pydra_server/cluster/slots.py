@@ -0,0 +1,118 @@
+"""
+    Copyright 2009 Oregon State University
+
+    This file is part of Pydra.
+
+    Pydra is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Pydra is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Pydra.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+class WorkerSlots(object):
+    """
+    WorkerSlots - bookkeeping of the slots of workers for the Master.  Idle
+            slots are kept in the order they became idle, working slots with
+            the job they are working on:
+            (task_instance_id, task_key, args, subtask_key, workunit_key)
+
+            It is not thread safe, the Master uses it under its lock.
+    """
+    def __init__(self):
+        self.idle = []          # (worker_key, slot) for every idle slot
+        self.working = {}       # worker_key -> {slot:job}, only workers with working slots
+
+
+    def __len__(self):
+        """
+        Number of idle slots
+        """
+        return len(self.idle)
+
+
+    def add_idle(self, worker_key, slot):
+        """
+        Adds an idle slot, returns False if it was already idle
+        """
+        if (worker_key, slot) in self.idle:
+            return False
+
+        self.idle.append((worker_key, slot))
+        return True
+
+
+    def select(self, job):
+        """
+        Moves an idle slot of the least busy worker to the working slots, so
+        work is spread over the workers (threads of a worker share its GIL).
+        Returns the slot as (worker_key, slot), (None, None) if there are no
+        idle slots
+        """
+        if not self.idle:
+            return None, None
+
+        busy = lambda i: (len(self.working.get(self.idle[i][0], ())), i)
+        worker_key, slot = self.idle.pop(min(range(len(self.idle)), key=busy))
+        self.working.setdefault(worker_key, {})[slot] = job
+        return worker_key, slot
+
+
+    def job(self, worker_key, slot):
+        """
+        Returns the job of a working slot
+        """
+        return self.working[worker_key][slot]
+
+
+    def jobs(self):
+        """
+        Returns (worker_key, slot, job) of all the working slots
+        """
+        return [(worker_key, slot, job)
+                    for worker_key, slots in self.working.items()
+                    for slot, job in slots.items()]
+
+
+    def release(self, worker_key, slot, idle=True):
+        """
+        Removes a working slot, returning its job.  The slot becomes idle
+        unless its worker is gone (idle=False)
+        """
+        slots = self.working[worker_key]
+        job = slots.pop(slot)
+        if not slots:
+            del self.working[worker_key]
+
+        if idle:
+            self.idle.append((worker_key, slot))
+
+        return job
+
+
+    def remove_worker(self, worker_key):
+        """
+        Removes idle slots of a worker, returns its working slots as
+        {slot:job}.  They should be released with idle=False once their work
+        is taken care of
+        """
+        self.idle = [idle for idle in self.idle if idle[0] != worker_key]
+        return dict(self.working.get(worker_key, {}))
+
+
+    def status(self, worker_key):
+        """
+        Returns {slot:job} of the known slots of a worker, job is None for
+        idle slots
+        """
+        status = dict((slot, None) for key, slot in self.idle if key == worker_key)
+        status.update(self.working.get(worker_key, {}))
+        return status
@@ -1,11 +1,13 @@
 from __future__ import with_statement
 
-from threading import Lock
+from threading import Lock, Condition
+from contextlib import contextmanager
 
 import cPickle as pickle
-import os, logging
+import os, time, mmap, socket, urllib2, urlparse, logging, heapq, struct, zlib, bz2, gzip
 
 import MySQLdb
+import MySQLdb.cursors
 
 logger = logging.getLogger('root')
 
@@ -19,6 +21,191 @@ def chain_subslicer(obj, ss_list):
 
     return last_ss
 
+
+def merge_sorted(iterables):
+    """k-way merge of (key, value) streams sorted by key.
+
+    Returns a stream of (key, value) tuples sorted by key. Streams are
+    consumed lazily, only one tuple per stream is held in memory."""
+
+    heap = []
+    for i, it in enumerate(iterables):
+        it = iter(it)
+        for k, v in it:
+            heap.append((k, i, v, it))
+            break
+
+    heapq.heapify(heap)
+
+    while heap:
+        k, i, v, it = heap[0]
+        yield k, v
+
+        try:
+            k, v = it.next()
+            heapq.heapreplace(heap, (k, i, v, it))
+        except StopIteration:
+            heapq.heappop(heap)
+
+############
+# block format
+#
+# a block file is a sequence of blocks, every block is a header followed by
+# a list of records pickled with the highest protocol, optionally compressed.
+# header: magic, codec, number of records, data length, crc32 of data
+
+BLOCK_MAGIC = 'PBLK'
+BLOCK_HEADER = struct.Struct('!4sBIII')
+
+# compression -> codec id, compress function
+BLOCK_COMPRESSION = {
+        None: (0, None),
+        'zlib': (1, zlib.compress),
+        'bz2': (2, bz2.compress),
+    }
+
+# codec id -> decompress function
+BLOCK_DECOMPRESSION = {
+        0: None,
+        1: zlib.decompress,
+        2: bz2.decompress,
+    }
+
+
+def write_block(f, records, compression=None):
+    """writes a list of records as one block"""
+
+    codec, compress = BLOCK_COMPRESSION[compression]
+
+    data = pickle.dumps(records, pickle.HIGHEST_PROTOCOL)
+    if compress:
+        data = compress(data)
+
+    f.write(BLOCK_HEADER.pack(BLOCK_MAGIC, codec, len(records), len(data),
+                zlib.crc32(data) & 0xffffffff))
+    f.write(data)
+
+
+def read_block(f):
+    """reads one block, returns a list of its records or None at the end of file"""
+
+    header = f.read(BLOCK_HEADER.size)
+    if not header:
+        return None
+
+    if len(header) < BLOCK_HEADER.size:
+        raise IOError("block: truncated header")
+
+    magic, codec, count, length, checksum = BLOCK_HEADER.unpack(header)
+    if magic != BLOCK_MAGIC:
+        raise IOError("block: bad magic %r" % magic)
+
+    data = f.read(length)
+    if len(data) < length or zlib.crc32(data) & 0xffffffff != checksum:
+        raise IOError("block: checksum mismatch")
+
+    decompress = BLOCK_DECOMPRESSION[codec]
+    if decompress:
+        data = decompress(data)
+
+    records = pickle.loads(data)
+    if len(records) != count:
+        raise IOError("block: expected %d records, got %d" % (count, len(records)))
+
+    return records
+
+
+def block_offsets(f):
+    """generates offsets of blocks of a block file, reading only headers"""
+
+    offset = f.tell()
+    header = f.read(BLOCK_HEADER.size)
+
+    while len(header) == BLOCK_HEADER.size:
+        magic, codec, count, length, checksum = BLOCK_HEADER.unpack(header)
+        if magic != BLOCK_MAGIC:
+            raise IOError("block: bad magic %r" % magic)
+
+        yield offset
+
+        offset += BLOCK_HEADER.size + length
+        f.seek(offset)
+        header = f.read(BLOCK_HEADER.size)
+
+
+def write_line_blocks(f, lines, compression='zlib', block_lines=10000):
+    """writes lines as a block file, a splittable compressed container
+    for line input (see DatasourceDir)"""
+
+    block = []
+    for line in lines:
+        block.append(line.rstrip('\n'))
+
+        if len(block) >= block_lines:
+            write_block(f, block, compression)
+            block = []
+
+    if block:
+        write_block(f, block, compression)
+
+
+class BlockLineReader(object):
+    """Reads lines of a block file, file-like for iteration.
+
+    tell() and seek() use offsets in the decompressed lines, seek() reads
+    all the blocks before the offset (slow, use line keys of block files
+    only when there is no other way).
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.pos = 0
+        self._lines = self._read()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        return self._lines
+
+    def _read(self):
+        records = read_block(self.f)
+        while records is not None:
+            for line in records:
+                line = '%s\n' % line
+                self.pos += len(line)
+                yield line
+            records = read_block(self.f)
+
+    def readline(self):
+        try:
+            return self._lines.next()
+        except StopIteration:
+            return ''
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """seeks to the start of the line at or after the offset"""
+        if whence != os.SEEK_SET:
+            raise IOError("block: only absolute seek is supported")
+
+        if offset < self.pos:
+            self.f.seek(0)
+            self.pos = 0
+            self._lines = self._read()
+
+        while self.pos < offset and self.readline():
+            pass
+
+    def close(self):
+        self.f.close()
+
+
 ############
 # sources
 
@@ -69,11 +256,117 @@ class DatasourceDict(Datasource):
         return self.store[key[-1]]
 
 
-class DatasourceDir(Datasource):
+class MappedFile(object):
+    """Read-only file object over a memory mapping of a file.
 
-    def __init__(self, dir):
+    Every reader maps the file when it is opened and unmaps it in close(),
+    so it always reads the current file. Processes (and readers) mapping
+    the same file share its pages in the page cache, readline() and read()
+    are served from memory without syscalls.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+        with open(name, "rb") as f:
+            try:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, mmap.error):
+                # empty file can't be mapped
+                self.map = None
+
+        self.size = self.map and len(self.map) or 0
+        self.pos = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        line = self.readline()
+        while line:
+            yield line
+            line = self.readline()
+
+    def read(self, size=-1):
+        start = self.pos
+        if size < 0:
+            self.pos = self.size
+        else:
+            self.pos = min(start + size, self.size)
+        return self.map and self.map[start:self.pos] or ''
+
+    def readline(self):
+        start = self.pos
+        if start >= self.size:
+            return ''
+
+        end = self.map.find('\n', start)
+        if end < 0:
+            self.pos = self.size
+        else:
+            self.pos = end + 1
+
+        return self.map[start:self.pos]
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.pos = max(0, offset)
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
+class DatasourceDir(Datasource):
+    """Files of a directory.
+
+    With use_mmap files are read through memory mappings (MappedFile),
+    a file is mapped by every reader until the reader is closed.
+
+    With min_free (bytes) check_space() raises IOError when there is less
+    free space in the directory.
+
+    Compressed files (gzip, bz2, block files) are detected by extension,
+    confirmed by their magic bytes, text mode load() decompresses them as
+    a stream (a file without the magic bytes is read as plain text).
+    Binary mode ("rb") always reads raw data. gzip and bz2 files can't be
+    split, block files (write_line_blocks()) can be, at block boundaries.
+    """
+
+    # extension -> compression
+    extensions = {
+            '.gz': 'gzip',
+            '.bz2': 'bz2',
+            '.pblk': 'block',
+        }
+
+    # compression -> magic bytes
+    magics = {
+            'gzip': '\x1f\x8b',
+            'bz2': 'BZh',
+            'block': BLOCK_MAGIC,
+        }
+
+    # number of files whose compression is remembered
+    compression_cache = 1000
+
+    def __init__(self, dir, use_mmap=False, min_free=None):
         super(DatasourceDir, self).__init__()
         self.dir = dir
+        self.use_mmap = use_mmap
+        self.min_free = min_free
+
+        self._compression = {}  # path -> compression, of compression_cache files at most
 
 
     def __iter__(self):
@@ -83,35 +376,384 @@ class DatasourceDir(Datasource):
         for filename in files:
             yield filename,
 
+    def _path(self, filename):
+        return os.path.join(self.dir, filename)
+
+    def _dirs(self):
+        return [self.dir]
+
+    def size(self, key):
+        """size of particular input file"""
+        return os.path.getsize(self._path(key[-1]))
+
+    def location(self, filename):
+        """key under which a file written to the directory is loaded by others"""
+        return filename
+
+    def remove(self, key):
+        """removes particular file"""
+        os.remove(self._path(key[-1]))
+
+    def _files(self, prefix):
+        for dir in self._dirs():
+            for filename in os.listdir(dir):
+                if filename.startswith(prefix):
+                    yield os.path.join(dir, filename)
+
+    def usage(self, prefix):
+        """bytes used by files with names starting with a prefix"""
+        return sum(os.path.getsize(path) for path in self._files(prefix))
+
+    def remove_prefix(self, prefix):
+        """removes all the files with names starting with a prefix"""
+        for path in list(self._files(prefix)):
+            try:
+                os.remove(path)
+            except OSError, e:
+                logger.debug("datasource: can't remove %s: %s" % (path, e))
+
+    def check_space(self):
+        """raises IOError if there is less than min_free bytes free"""
+        if not self.min_free:
+            return
+
+        for dir in self._dirs():
+            stat = os.statvfs(dir)
+            free = stat.f_bavail * stat.f_frsize
+
+            if free < self.min_free:
+                raise IOError("datasource: only %d bytes free in %s" % (free, dir))
+
+    def compression(self, key):
+        """compression of particular input file, None if not compressed"""
+        path = self._path(key[-1])
+
+        try:
+            return self._compression[path]
+        except KeyError:
+            pass
+
+        compression = self.extensions.get(os.path.splitext(path)[1])
+
+        if compression:
+            with open(path, "rb") as f:
+                head = f.read(4)
+
+            if not head.startswith(self.magics[compression]):
+                logger.warning("datasource: %s is not %s compressed, reading it as plain text"
+                        % (path, compression))
+                compression = None
+
+        if len(self._compression) >= self.compression_cache:
+            self._compression.clear()
+        self._compression[path] = compression
+
+        return compression
+
     def _load(self, key, mode="r"):
         """open particular input file"""
         filename = key[-1]
-        path = os.path.join(self.dir, filename)
+        path = self._path(filename)
+
+        if mode == "r":
+            compression = self.compression(key)
+
+            if compression == 'gzip':
+                return gzip.GzipFile(path, "rb")
+            elif compression == 'bz2':
+                return bz2.BZ2File(path, "rb")
+            elif compression == 'block':
+                return BlockLineReader(open(path, "rb"))
+
+        if self.use_mmap and mode in ("r", "rb"):
+            return MappedFile(path)
+
         return open(path, mode)
 
 
+class ConnectionPool(object):
+    """Bounded pool of MySQLdb connections.
+
+    acquire() blocks while all the size connections are checked out, for
+    timeout seconds at most, then it raises MySQLdb.OperationalError (a
+    pool too small for the work units of the worker, see DatasourceSQL).
+    A connection idle for more than ping_interval seconds is checked
+    with ping() and replaced if it is broken.
+    """
+
+    ping_interval = 60
+    timeout = 60
+
+    def __init__(self, kwargs, size):
+        self.kwargs = kwargs
+        self.size = size
+
+        self._idle = [] # (connection, time of release)
+        self._count = 0
+        self._cond = Condition()
+
+
+    def acquire(self):
+        deadline = time.time() + self.timeout
+
+        with self._cond:
+            while not self._idle and self._count >= self.size:
+                left = deadline - time.time()
+                if left <= 0:
+                    raise MySQLdb.OperationalError("datasource: no connection "
+                            "free in %d seconds, pool of %d connections is too small"
+                            % (self.timeout, self.size))
+                self._cond.wait(left)
+
+            if self._idle:
+                conn, released = self._idle.pop()
+            else:
+                conn = None
+                self._count += 1
+
+        if conn is not None and time.time() - released > self.ping_interval:
+            try:
+                conn.ping()
+            except MySQLdb.Error, e:
+                logger.debug("datasource: dropping broken connection: %s" % e)
+                self._close(conn)
+                conn = None
+
+        if conn is None:
+            try:
+                conn = MySQLdb.connect(**self.kwargs)
+                logger.debug("datasource: connecting to DB")
+            except:
+                self._discard()
+                raise
+
+        return conn
+
+
+    def release(self, conn):
+        """returns a connection to the pool, uncommitted work is rolled back"""
+        try:
+            conn.rollback()
+        except MySQLdb.Error, e:
+            logger.debug("datasource: dropping broken connection: %s" % e)
+            self._close(conn)
+            self._discard()
+            return
+
+        with self._cond:
+            self._idle.append((conn, time.time()))
+            self._cond.notify()
+
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except MySQLdb.Error:
+            pass
+
+
+    def _discard(self):
+        with self._cond:
+            self._count -= 1
+            self._cond.notify()
+
+
+# connection arguments -> ConnectionPool, pools are shared by all the
+# datasources (and task instances) of a worker
+_pools = {}
+_pools_lock = Lock()
+
+def get_pool(kwargs, size):
+    key = tuple(sorted(kwargs.items()))
+
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(kwargs, size)
+
+        return _pools[key]
+
+
+class PooledCursor(object):
+    """Cursor of a connection checked out of a pool, close() returns
+    the connection to the pool."""
+
+    def __init__(self, pool, conn, cursorclass=None):
+        self.pool = pool
+        try:
+            self.cursor = conn.cursor(cursorclass)
+        except:
+            pool.release(conn)
+            raise
+        self.conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def close(self):
+        # no __getattr__ here, close() is called by __del__ of an object
+        # which may not be initialised
+        conn = self.__dict__.get('conn')
+        if conn is not None:
+            self.cursor.close()
+            self.pool.release(conn)
+            self.conn = None
+
+    __del__ = close
+
+
+class DatasourceStriped(DatasourceDir):
+    """Files striped across several directories (disks), a file goes to
+    a directory chosen by its name."""
+
+    def __init__(self, dirs, **kwargs):
+        super(DatasourceStriped, self).__init__(dirs[0], **kwargs)
+        self.dirs = dirs
+
+    def __iter__(self):
+        for dir in self.dirs:
+            for filename in os.walk(dir).__iter__().next()[2]:
+                yield filename,
+
+    def _path(self, filename):
+        dir = self.dirs[(zlib.crc32(filename) & 0xffffffff) % len(self.dirs)]
+        return os.path.join(dir, filename)
+
+    def _dirs(self):
+        return self.dirs
+
+
+class DatasourceShuffle(DatasourceDir):
+    """Node-local directory of intermediate results, served to other nodes
+    by the shuffle server of NodeServer (pydra_server.cluster.shuffle).
+
+    Files written here are located by http://host:port/filename URLs, a URL
+    of this host is read from the directory, other hosts' files are read
+    (and removed) over HTTP.
+    """
+
+    def __init__(self, dir, port, host=None, **kwargs):
+        super(DatasourceShuffle, self).__init__(dir, **kwargs)
+        self.port = port
+        self.host = host or socket.getfqdn()
+
+    def location(self, filename):
+        return 'http://%s:%d/%s' % (self.host, self.port, filename)
+
+    def _local(self, key):
+        """returns (local filename or None, url)"""
+        url = key[-1]
+
+        scheme, netloc, path = urlparse.urlparse(url)[:3]
+        if not scheme:
+            return url, None
+
+        if netloc == '%s:%d' % (self.host, self.port):
+            return path.lstrip('/'), url
+
+        return None, url
+
+    def size(self, key):
+        filename, url = self._local(key)
+        if filename is None:
+            return int(urllib2.urlopen(HeadRequest(url)).info()['Content-Length'])
+
+        return super(DatasourceShuffle, self).size((filename, ))
+
+    def _load(self, key, mode="r"):
+        filename, url = self._local(key)
+        if filename is None:
+            logger.debug("shuffle: fetching %s" % url)
+            return RemoteFile(urllib2.urlopen(url))
+
+        return super(DatasourceShuffle, self)._load((filename, ), mode)
+
+    def remove(self, key):
+        filename, url = self._local(key)
+        if filename is None:
+            urllib2.urlopen(DeleteRequest(url))
+        else:
+            super(DatasourceShuffle, self).remove((filename, ))
+
+
+class HeadRequest(urllib2.Request):
+    def get_method(self):
+        return 'HEAD'
+
+
+class DeleteRequest(urllib2.Request):
+    def get_method(self):
+        return 'DELETE'
+
+
+class RemoteFile(object):
+    """urllib2 response, usable in a with statement"""
+
+    def __init__(self, response):
+        self.response = response
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    def __iter__(self):
+        return iter(self.response)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.response.close()
+
+
 class DatasourceSQL(Datasource):
+    """MySQL database.
 
-    def __init__(self, **kwargs):
+    Connections come from a pool of the worker (pool_size connections
+    at most), connection() checks one out for a unit of work, a cursor
+    from load() holds its connection until it is closed. A work unit may
+    hold two connections at once (e.g. streaming its input while dumping
+    its output to the same database), so pool_size should be at least
+    twice the slots of a worker, or acquiring connections times out.
+    """
+
+    def __init__(self, pool_size=4, **kwargs):
         super(DatasourceSQL, self).__init__()
         self.kwargs = kwargs
-        self.db = None
+        self.pool_size = pool_size
+        self.pool = None
 
     def connect(self):
-        self.db = MySQLdb.connect(**self.kwargs) 
-        logger.debug("datasource: connecting to DB")
+        self.pool = get_pool(self.kwargs, self.pool_size)
 
     def close(self):
-        self.db.close()
-        logger.debug("datasource: closing connection to DB")
+        # connections stay in the pool for other tasks
+        pass
+
+
+    @contextmanager
+    def connection(self):
+        if self.pool is None:
+            self.connect()
+
+        conn = self.pool.acquire()
+        try:
+            yield conn
+        finally:
+            self.pool.release(conn)
 
 
     def __iter__(self):
         """generate key for database"""
         yield "_mysql",
 
-    def _load(self, key):
-        return self.db.cursor()
+    def _load(self, key, cursorclass=None):
+        """returns a cursor, SSCursor cursorclass streams results from server"""
+        if self.pool is None:
+            self.connect()
+
+        return PooledCursor(self.pool, self.pool.acquire(), cursorclass)
 
 
 ############
@@ -175,8 +817,65 @@ class SequenceSlicer(Slicer):
 
 
 class LineFileSlicer(Slicer):
+    """Slices files to lines.
+
+    With split_size argument files are sliced to byte ranges instead,
+    using only file sizes. Data of a range are its lines, a line belongs
+    to the range where it starts.
+
+    A compressed file (see DatasourceDir) is one range, a block file is
+    sliced at block boundaries. Line keys of compressed files need seeking
+    in a decompressed stream, use split_size for them.
+    """
 
     def __iter__(self):
+        """generates keys of lines, or of byte ranges with split_size"""
+        split_size = self.kwargs.get('split_size')
+        if split_size:
+            return self._ranges(split_size)
+
+        return self._lines()
+
+
+    def _ranges(self, split_size):
+        """generates a key == parent_key + (start, end), a byte range of a file"""
+        for input_key in self.input:
+            size = self.input.size(input_key)
+            compression = self._compression(input_key)
+
+            if compression == 'block':
+                for range in self._block_ranges(input_key, split_size, size):
+                    yield input_key + range
+
+            elif compression:
+                # not splittable
+                yield input_key + (0, size)
+
+            else:
+                for start in xrange(0, size, split_size):
+                    yield input_key + (start, min(start + split_size, size))
+
+
+    def _compression(self, key):
+        if hasattr(self.input, 'compression'):
+            return self.input.compression(key)
+        return None
+
+
+    def _block_ranges(self, key, split_size, size):
+        """generates (start, end) ranges of whole blocks of a block file"""
+        with self.input._load(key, "rb") as f:
+            start = 0
+            for offset in block_offsets(f):
+                if offset - start >= split_size:
+                    yield start, offset
+                    start = offset
+
+        if start < size:
+            yield start, size
+
+
+    def _lines(self):
         """generates a key == parent_key + (offset, ), where offset is a line position in file"""
         for input_key in self.input:
             with self.input.load(input_key) as f:
@@ -196,8 +895,18 @@ class LineFileSlicer(Slicer):
                     line = f.readline()
 
 
+    def size(self, key):
+        """size of a byte range, None for a line key (not known)"""
+        if not self.kwargs.get('split_size'):
+            return None
+        return key[-1] - key[-2]
+
+
     def _load(self, key):
         """reads particular line in file"""
+        if self.kwargs.get('split_size'):
+            return self._load_range(key[:-2], key[-2], key[-1])
+
         parent, offset = key[:-1], key[-1]
         with self.input.load(parent) as f:
             f.seek(offset)
@@ -206,9 +915,82 @@ class LineFileSlicer(Slicer):
         return line
 
 
+    def _load_range(self, parent, start, end):
+        """streams lines starting within a byte range"""
+        compression = self._compression(parent)
+
+        if compression == 'block':
+            with self.input._load(parent, "rb") as f:
+                f.seek(start)
+                while f.tell() < end:
+                    records = read_block(f)
+                    if records is None:
+                        break
+
+                    for line in records:
+                        yield line.strip()
+            return
+
+        elif compression:
+            with self.input.load(parent) as f:
+                for line in f:
+                    yield line.strip()
+            return
+
+        with self.input.load(parent) as f:
+            if start:
+                # the line crossing the start belongs to the previous range
+                f.seek(start - 1)
+                f.readline()
+
+            while f.tell() < end:
+                line = f.readline()
+                if not line:
+                    break
+
+                yield line.strip()
+
+
 class SQLTableSlicer(Slicer):
+    """Slices table rows by ids.
+
+    With range_size argument the table is sliced to ranges of ids instead,
+    probing MIN and MAX of the id column. Rows of a range are streamed
+    with a server side cursor, fetch_size rows at a time.
+    """
+
+    fetch_size = 1000
 
     def __iter__(self):
+        if self.kwargs.get('range_size'):
+            return self._ranges(self.kwargs['range_size'])
+
+        return self._ids()
+
+
+    def _ranges(self, range_size):
+        """generates a key == parent_key + (start, end), a range of ids"""
+        select_args = {'id_column': 'id'}
+        select_args.update(self.kwargs)
+
+        bounds_query = select_args.pop('bounds_query',
+                "SELECT MIN(%(id_column)s), MAX(%(id_column)s) FROM %(table)s")
+
+        for input_key in self.input:
+            c = self.input.load(input_key)
+
+            c.execute(bounds_query % select_args)
+            low, high = c.fetchone()
+            c.close()
+
+            if low is None:
+                continue
+
+            for start in xrange(int(low), int(high) + 1, range_size):
+                yield input_key + (start, start + range_size)
+
+
+    def _ids(self):
         select_args = {'id_column': 'id'}
         select_args.update(self.kwargs)
 
@@ -218,22 +1000,36 @@ class SQLTableSlicer(Slicer):
         for input_key in self.input:
             c = self.input.load(input_key)
 
-            c.execute(select_query % select_args)
-            row = c.fetchone()
+            try:
+                c.execute(select_query % select_args)
+                row = c.fetchone()
 
-            while row:
-                id = int(row[0])
-                if self.send_as_input:
-                    yield id
+                while row:
+                    id = int(row[0])
+                    if self.send_as_input:
+                        yield id
 
-                else:
-                    yield input_key + (id, )
+                    else:
+                        yield input_key + (id, )
 
-                row = c.fetchone()
+                    row = c.fetchone()
+
+            finally:
+                c.close()
+
+
+    def size(self, key):
+        """size of a range of ids, None for an id key (not known)"""
+        if not self.kwargs.get('range_size'):
+            return None
+        return key[-1] - key[-2]
 
 
     def _load(self, key):
         """reads particular row in table"""
+        if self.kwargs.get('range_size'):
+            return self._load_range(key[:-2], key[-2], key[-1])
+
         parent, id = key[:-1], key[-1]
         c = self.input.load(parent)
 
@@ -243,8 +1039,33 @@ class SQLTableSlicer(Slicer):
         load_query = select_args.pop('load_query',
                 "SELECT * FROM %(table)s WHERE %(id_column)s = %(id)d")
 
-        c.execute(load_query % select_args)
-        return c.fetchone()
+        try:
+            c.execute(load_query % select_args)
+            return c.fetchone()
+        finally:
+            c.close()
+
+
+    def _load_range(self, parent, start, end):
+        """streams rows of a range of ids"""
+        select_args = {'id_column': 'id'}
+        select_args.update(self.kwargs)
+
+        range_query = select_args.pop('range_query',
+                "SELECT * FROM %(table)s WHERE %(id_column)s >= %%s AND %(id_column)s < %%s")
+
+        c = self.input._load(parent, MySQLdb.cursors.SSCursor)
+        try:
+            c.execute(range_query % select_args, (start, end))
+
+            rows = c.fetchmany(self.fetch_size)
+            while rows:
+                for row in rows:
+                    yield row
+                rows = c.fetchmany(self.fetch_size)
+
+        finally:
+            c.close()
 
 
 ############
@@ -260,18 +1081,21 @@ class Subslicer(Slicer):
 class FileUnpicleSubslicer(Subslicer):
 
     def __iter__(self):
-        dir = self.kwargs['dir']
+        """merges key-sorted input files into one stream sorted by key"""
+        return merge_sorted([self._load_file(filename) for filename in self.input])
 
-        for filename in self.input:
 
+    def _load_file(self, filename):
+        dir = self.kwargs['dir']
+
+        # binary mode, intermediate files are not checked for compression
+        with dir._load((filename, ), mode="rb") as f:
             try:
-                with dir.load((filename, )) as f:
-                    while True:
-                        yield pickle.load(f)
+                while True:
+                    yield pickle.load(f)
 
             except EOFError:
-                logger.debug("subslicer: loading from %s done" % f.name)
-                pass
+                logger.debug("subslicer: loading from %s done" % filename)
 
 
 class FilePickleOutput(object):
@@ -280,56 +1104,313 @@ class FilePickleOutput(object):
         self.dir = dir
 
     def dump(self, key, values):
+        """dumps values to a file, returns its location"""
         with self.dir._load((key, ), mode="w") as f:
             for obj in values:
                 pickle.dump(obj, f)
 
+        return self.dir.location(key)
+
+    def remove(self, key):
+        self.dir.remove((key, ))
+
+
+class FileBlockSubslicer(FileUnpicleSubslicer):
+
+    def _load_file(self, filename):
+        dir = self.kwargs['dir']
+
+        with dir._load((filename, ), mode="rb") as f:
+            block = read_block(f)
+
+            while block is not None:
+                for obj in block:
+                    yield obj
+
+                block = read_block(f)
+
+        logger.debug("subslicer: loading from %s done" % filename)
+
+
+class FileBlockOutput(FilePickleOutput):
+
+    def __init__(self, dir, compression=None, block_records=1000):
+        super(FileBlockOutput, self).__init__(dir)
+        self.compression = compression
+        self.block_records = block_records
+
+    def dump(self, key, values):
+        with self.dir._load((key, ), mode="wb") as f:
+            block = []
+
+            for obj in values:
+                block.append(obj)
+
+                if len(block) >= self.block_records:
+                    write_block(f, block, self.compression)
+                    block = []
+
+            if block:
+                write_block(f, block, self.compression)
+
+        return self.dir.location(key)
+
 
 class SQLTableKeyInput(Subslicer):
+    """Reads (k, (v, )) tuples of partitions (input) sorted by key, all
+    the partitions with one ordered query streamed by a server side cursor."""
+
+    fetch_size = 1000
 
     def __iter__(self):
+        # input is read now, it may be replaced (by another reduce task)
+        # before the rows are read
+        partitions = list(self.input)
+        if not partitions:
+            return iter([])
+
+        return self._rows(partitions)
 
+
+    def _rows(self, partitions):
         db = self.kwargs['db']
         table = self.kwargs['table']
-        c = db.load(None)
 
-        for partition in self.input:
+        sql = "SELECT k, v FROM %s WHERE `partition` IN (%s) ORDER BY k" % \
+                (table, ', '.join(['%s'] * len(partitions)))
+        logger.debug("%s %s" % (sql, partitions))
 
-            sql = "SELECT k, v FROM %s WHERE partition = '%s'" % (table, partition)
-            logger.debug(sql)
+        with db.connection() as conn:
+            c = conn.cursor(MySQLdb.cursors.SSCursor)
 
-            c.execute(sql)
-            row = c.fetchone()
+            try:
+                c.execute(sql, partitions)
+                rows = c.fetchmany(self.fetch_size)
 
-            while row:
-                yield row
+                while rows:
+                    for k, v in rows:
+                        yield k, (v, )
 
-                row = c.fetchone()
+                    rows = c.fetchmany(self.fetch_size)
 
+            finally:
+                c.close()
 
-class SQLTableOutput(object):
 
-    def __init__(self, db, table):
+class SQLTableOutput(object):
+    """Dumps (k, values) tuples as (partition, k, v) rows.
+
+    The table is created with the first dump, if it does not exist, with
+    an index on (partition, k) for ordered reads of partitions (partition
+    is a reserved word since MySQL 5.1, it is always quoted).
+    Rows are inserted batch_size at a time (executemany makes it one
+    multi-row INSERT), a dump is one transaction.
+    """
+
+    schema = """CREATE TABLE IF NOT EXISTS %s (
+                    `partition` VARCHAR(255) NOT NULL,
+                    k VARBINARY(255) NOT NULL,
+                    v BLOB,
+                    INDEX (`partition`, k)
+                )"""
+
+    def __init__(self, db, table, batch_size=1000):
         self.table = table
         self.db = db
+        self.batch_size = batch_size
+
+        self._created = False
+
+
+    def create(self, conn):
+        if not self._created:
+            conn.cursor().execute(self.schema % self.table)
+            self._created = True
 
 
     def dump(self, key, tuples):
-        c = self.db.load(None)
-        for tuple in tuples:
-            k, vals = tuple
+        sql = "INSERT INTO %s (`partition`, k, v) VALUES (%%s, %%s, %%s)" % self.table
+        logger.debug("%s [%s]" % (sql, key))
 
-            try:
-                vals = iter(vals)
-            except TypeError:
-                vals = [vals]
+        with self.db.connection() as conn:
+            self.create(conn)
+            self._dump(conn, sql, key, tuples)
+
+        return key
+
+
+    def _dump(self, conn, sql, key, tuples):
+        c = conn.cursor()
+        rows = []
+
+        try:
+            for k, vals in tuples:
+
+                try:
+                    vals = iter(vals)
+                except TypeError:
+                    vals = [vals]
+
+                for v in vals:
+                    rows.append((key, k, str(v)))
+
+                if len(rows) >= self.batch_size:
+                    c.executemany(sql, rows)
+                    rows = []
+
+            if rows:
+                c.executemany(sql, rows)
+
+            conn.commit()
+
+        except:
+            conn.rollback()
+            raise
+
+
+    def remove(self, key):
+        sql = "DELETE FROM %s WHERE `partition` = %%s" % self.table
+        logger.debug("%s [%s]" % (sql, key))
+
+        with self.db.connection() as conn:
+            conn.cursor().execute(sql, (key, ))
+            conn.commit()
+
+
+    def remove_prefix(self, prefix):
+        """removes all the partitions with keys starting with a prefix"""
+        prefix = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+        sql = "DELETE FROM %s WHERE `partition` LIKE %%s" % self.table
+        logger.debug("%s [%s%%]" % (sql, prefix))
+
+        with self.db.connection() as conn:
+            conn.cursor().execute(sql, (prefix + '%', ))
+            conn.commit()
+
+
+
+
+############
+# sinks, reduce tasks write their output directly to them, open() returns
+# a writer (output[key] = value) and writer.close() a summary of the output
+
+class FileSink(object):
+    """Output file per partition in a DatasourceDir, 'key<TAB>value' lines.
+
+    An attempt writes to a temporary file renamed when complete, so two
+    attempts of a reduce task (speculative execution) leave one file.
+    """
+
+    idempotent = True
+
+    def __init__(self, dir):
+        self.dir = dir
+
+
+    def open(self, name, attempt):
+        return FileSinkWriter(os.path.join(self.dir.dir, name), attempt)
 
-            for v in vals:
-                sql = "INSERT INTO %s (partition, k, v) VALUES ('%s', '%s', '%s')" % \
-                        (self.table, key, k, str(v))
-                logger.debug(sql)
 
-                r = c.execute(sql)
-                logger.debug("inserted %s" % r)
+class FileSinkWriter(object):
 
+    def __init__(self, path, attempt):
+        self.path = path
+        self.tmp_path = '%s.%s.tmp' % (path, attempt)
+        self.f = open(self.tmp_path, 'w')
+        self.records = 0
 
+
+    def __setitem__(self, key, value):
+        self.f.write('%s\t%s\n' % (key, value))
+        self.records += 1
+
+
+    def close(self):
+        bytes = self.f.tell()
+        self.f.close()
+        os.rename(self.tmp_path, self.path)
+
+        return {'path': self.path, 'records': self.records, 'bytes': bytes}
+
+
+class SQLTableSink(object):
+    """Output rows (k, v) inserted into a table in batches."""
+
+    idempotent = False
+
+    def __init__(self, db, table, batch_size=1000):
+        self.db = db
+        self.table = table
+        self.batch_size = batch_size
+
+
+    def open(self, name, attempt):
+        return SQLTableSinkWriter(self.db, self.table, self.batch_size)
+
+
+class SQLTableSinkWriter(object):
+
+    def __init__(self, db, table, batch_size):
+        self.db = db
+        self.table = table
+        self.batch_size = batch_size
+        self.sql = "INSERT INTO %s (k, v) VALUES (%%s, %%s)" % table
+
+        self.rows = []
+        self.records = 0
+        self.bytes = 0
+
+
+    def __setitem__(self, key, value):
+        row = str(key), str(value)
+        self.rows.append(row)
+        self.records += 1
+        self.bytes += len(row[0]) + len(row[1])
+
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+
+    def flush(self):
+        if self.rows:
+            with self.db.connection() as conn:
+                conn.cursor().executemany(self.sql, self.rows)
+                conn.commit()
+            self.rows = []
+
+
+    def close(self):
+        self.flush()
+
+        return {'path': self.table, 'records': self.records, 'bytes': self.bytes}
+
+
+class CallableSink(object):
+    """Output passed to a callable, called as func(key, value)."""
+
+    idempotent = False
+
+    def __init__(self, func):
+        self.func = func
+
+
+    def open(self, name, attempt):
+        return CallableSinkWriter(self.func, name)
+
+
+class CallableSinkWriter(object):
+
+    def __init__(self, func, name):
+        self.func = func
+        self.name = name
+        self.records = 0
+
+
+    def __setitem__(self, key, value):
+        self.func(key, value)
+        self.records += 1
+
+
+    def close(self):
+        return {'path': self.name, 'records': self.records, 'bytes': None}
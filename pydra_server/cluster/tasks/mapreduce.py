@@ -1,19 +1,25 @@
 from __future__ import with_statement
 
 from tasks import Task, TaskNotFoundException, \
-    STATUS_RUNNING, STATUS_COMPLETE
+    STATUS_RUNNING, STATUS_COMPLETE, STATUS_FAILED
 
 from pydra_server.cluster.tasks.datasource import DatasourceDict, \
         SequenceSlicer, \
+        FileSink, SQLTableSink, CallableSink, \
         FileUnpicleSubslicer, FilePickleOutput, \
+        FileBlockSubslicer, FileBlockOutput, \
         SQLTableKeyInput, SQLTableOutput
 
-from twisted.internet import reactor, threads
+from twisted.internet import threads
 
 from threading import Lock
+from itertools import groupby, islice
+from operator import itemgetter
+from bisect import bisect_right
+from collections import deque
 
 import cPickle as pickle
-import os, logging
+import os, sys, time, math, random, logging, uuid, copy, zlib
 
 logger = logging.getLogger('root')
 
@@ -38,6 +44,225 @@ class AppendableDict(dict):
         super(AppendableDict, self).__getitem__(key).append(value)
 
 
+def estimate_size(obj):
+    """estimate of the memory taken by a key or a value, sys.getsizeof of
+    the object plus its items if it is a tuple, list, set or dict (shared
+    objects are counted for each reference)"""
+
+    size = sys.getsizeof(obj)
+
+    if isinstance(obj, dict):
+        size += sum(estimate_size(k) + estimate_size(v) for k, v in obj.iteritems())
+
+    elif isinstance(obj, (tuple, list, set, frozenset)):
+        size += sum(estimate_size(item) for item in obj)
+
+    return size
+
+
+class MapOutputBuffer(AppendableDict):
+    """AppendableDict with a memory budget.
+
+    When the buffer holds max_records values or roughly max_bytes of
+    keys and values, spill(buffer) is called and the buffer is emptied.
+    No limits means the buffer grows unbounded.
+    """
+
+    def __init__(self, spill, max_records=None, max_bytes=None):
+        super(MapOutputBuffer, self).__init__()
+
+        self.spill = spill
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+
+        self.records = 0
+        self.bytes = 0
+
+
+    def __setitem__(self, key, value):
+        super(MapOutputBuffer, self).__setitem__(key, value)
+
+        self.records += 1
+        if self.max_records and self.records >= self.max_records:
+            self.flush()
+
+        elif self.max_bytes:
+            self.bytes += estimate_size(key) + estimate_size(value)
+            if self.bytes >= self.max_bytes:
+                self.flush()
+
+
+    def flush(self):
+        """spills buffered items, if any"""
+
+        if self:
+            self.spill(self)
+
+        self.clear()
+        self.records = 0
+        self.bytes = 0
+
+
+def group_values(tuples):
+    """Groups a key-sorted stream of (key, values) tuples by key.
+
+    Yields (key, iterator) pairs, the iterator lazily chains values of all
+    the tuples sharing the same key.
+
+    >>> [(k, list(vs)) for k, vs in group_values([('a', [1]), ('a', [2, 3]), ('b', [4])])]
+    [('a', [1, 2, 3]), ('b', [4])]
+    """
+
+    for key, group in groupby(tuples, itemgetter(0)):
+        yield key, (v for k, vs in group for v in vs)
+
+
+def group_keys(keys, max_keys=None, max_bytes=None, size=None):
+    """groups input keys into splits (lists) of max_keys keys or of about
+    max_bytes bytes, size(key) returns the size of the key's data or None
+    if it is not known (such keys are grouped by max_keys only)"""
+
+    split = []
+    bytes = 0
+
+    for key in keys:
+        split.append(key)
+        key_size = size and size(key)
+        if key_size:
+            bytes += key_size
+
+        if (max_keys and len(split) >= max_keys) or \
+                (max_bytes and bytes >= max_bytes):
+            yield split
+            split = []
+            bytes = 0
+
+    if split:
+        yield split
+
+
+def split_files(files, parts):
+    """divides (file, records, bytes) tuples into parts of similar
+    size in bytes, returns lists of files"""
+
+    chunks = [[0, i, []] for i in range(parts)]
+
+    for f, records, bytes in sorted(files, key=itemgetter(2), reverse=True):
+        chunk = min(chunks)
+        chunk[0] += bytes
+        chunk[2].append(f)
+
+    return [chunk for size, i, chunk in chunks]
+
+
+def reservoir_sample(iterable, n):
+    """returns up to n items picked uniformly at random from an iterable
+    of unknown length, in a single pass"""
+
+    sample = []
+
+    for i, item in enumerate(iterable):
+        if i < n:
+            sample.append(item)
+        else:
+            j = random.randint(0, i)
+            if j < n:
+                sample[j] = item
+
+    return sample
+
+
+class HashPartitioner(object):
+    """Partitions keys by their hash.
+
+    hash() is used for strings, numbers and tuples of them, it is the same
+    on every worker. Other keys are partitioned by a checksum of their
+    repr(), which has to be the same for equal keys (not the default repr()
+    of objects, with their address).
+    """
+
+    # keys of these types have the same hash() in every process
+    stable_types = (str, unicode, int, long, float)
+
+    def sample(self, task):
+        """called before the map stage, nothing to do"""
+        pass
+
+
+    def get_state(self):
+        """returns the state to be sent to the workers along with map tasks"""
+        return None
+
+
+    def set_state(self, state):
+        pass
+
+
+    def partition(self, key, reducers):
+        if self._stable(key):
+            return hash(key) % reducers
+
+        return (zlib.crc32(repr(key)) & 0xffffffff) % reducers
+
+
+    def _stable(self, key):
+        if isinstance(key, tuple):
+            return all(self._stable(k) for k in key)
+
+        return isinstance(key, self.stable_types)
+
+
+class RangePartitioner(HashPartitioner):
+    """Partitions keys by ranges, so partition n holds only keys lower than
+    keys of partition n+1 and reduce outputs read in order of partitions
+    are sorted.
+
+    Split points are picked before the map stage: the map task is run on
+    a sample of input items (input_samples of the first input_prefix input
+    keys) and split points divide a sample of their output keys
+    (key_samples) into even ranges.
+    """
+
+    def __init__(self, input_samples=10, key_samples=1000, input_prefix=1000):
+        self.input_samples = input_samples
+        self.key_samples = key_samples
+        self.input_prefix = input_prefix
+        self.splits = []
+
+
+    def sample(self, task):
+        keys = []
+
+        input_keys = islice(task.input, self.input_prefix)
+
+        for input_key in reservoir_sample(input_keys, self.input_samples):
+            output = AppendableDict()
+            task.maptask.task._work(input=task.input.load(input_key), output=output)
+            keys.extend(output.iterkeys())
+
+        keys = sorted(reservoir_sample(keys, self.key_samples))
+
+        if keys:
+            self.splits = [keys[len(keys) * i / task.reducers]
+                            for i in range(1, task.reducers)]
+        else:
+            self.splits = []
+
+        logger.debug('range partitioner: split points %s' % self.splits)
+
+
+    def get_state(self):
+        return self.splits
+
+
+    def set_state(self, state):
+        self.splits = state
+
+
+    def partition(self, key, reducers):
+        return bisect_right(self.splits, key)
+
+
 class IntermediateResults(object):
     """Datahandler for not direct input/output handling.
 
@@ -47,49 +272,90 @@ class IntermediateResults(object):
     map stage:
     * map task output is a dictionary;
     * when map._work() is completed output dict is partitioned and dumped;
-    * partition_output() partitions items depending on a partition() function;
-    * dump() dumps them into a unique file, returns partition-dictionary;
+    * partition_output() partitions items depending on a partition() function
+      and sorts every partition by key;
+    * dump() dumps them into a unique file, returns partition-dictionary
+      of (file, records, bytes) tuples, file is where the backend locates
+      it (e.g. URL of node-local file, see DatasourceShuffle);
     * every map task's dump partition-dictionary is collected and provided
-      to update_partitions() function for future iterator generation.
+      to update_partitions() function for future iterator generation,
+      sizes of the files are kept for partition_sizes().
 
     partition:
     * number of partitions equals number of reducers;
     * partition must assure that a specific key will be processed by
-      one and only one reduce task.
+      one and only one reduce task;
+    * partition() delegates to a partitioner (HashPartitioner by default),
+      which is set by MapReduceTask.
 
     reduce stage:
     * __iter__() returns an iterator, which generates input keys for each partition;
     * load() returns iterator which is used as a input iterator
       for a reduce task (subslicers);
-    * iterator loads (key, values) tuples from a backend.
+    * iterator merges sorted (key, values) tuples from a backend and
+      groups them, so a reduce task gets every key once, in sorted order,
+      together with a lazy iterator over all its values;
+    * at most merge_factor files are merged (open) at once, more files are
+      merged in several passes through temporary files.
     """
 
     # mapreduce-i9e-(taks_id)-(partition)-(map_id)
     pattern = "mapreduce-i9e-%s-%d-%s"
 
+    # remove all the files (rows) of the task in clear()
+    cleanup = True
+
+    # number of files merged at once by load()
+    merge_factor = 100
+
 
     def __init__(self):
         self.task_id = "mapreduce_task"
         self.reducers = 1
 
         self._partitions = {}
+        self._sizes = {}
+        self.partitioner = HashPartitioner()
 
         self.map_output = None
         self.reduce_input = None
 
+        self._lock = Lock()
+
     def clear(self):
         self._partitions.clear()
+        self._sizes.clear()
+
+
+    def copy(self):
+        """returns a copy for a task instance, with its own task_id and
+        partitions, sharing the backend"""
+        im = copy.copy(self)
+        im._partitions = {}
+        im._sizes = {}
+        return im
+
+
+    def prefix(self):
+        """beginning of names of all the files of the task (see pattern)"""
+        return "mapreduce-i9e-%s-" % self.task_id
+
+
+    def check_space(self):
+        """called before a map task, raises IOError if there is no space
+        left for its output"""
+        pass
 
 
     def partition(self, key):
         """partition key depending on a number of a reducers"""
-        return hash(str(key)) % self.reducers
+        return self.partitioner.partition(key, self.reducers)
 
 
     def partition_output(self, output):
         """iterates through an output dictionary and partitions it,
         returns a dictionary where key is a partition number and value - items
-        of output dict belonging to this partition"""
+        of output dict belonging to this partition sorted by key"""
 
         pdict = {}
 
@@ -102,57 +368,233 @@ class IntermediateResults(object):
             else:
                 pdict[p] = [(k, vs)]
 
+        for tuples in pdict.itervalues():
+            tuples.sort(key=itemgetter(0))
+
         return pdict.iteritems()
 
 
+    def begin_merge(self, min_files, exclude=()):
+        """takes files of the partition with the most files (at least min_files)
+        out of the partition-dictionary, to be merged into one file.
+        returns (partition, files) or (None, None)"""
+
+        candidates = [(len(files), p) for p, files in self._partitions.iteritems()
+                        if p not in exclude and len(files) >= min_files]
+
+        if not candidates:
+            return None, None
+
+        count, p = max(candidates)
+        files = self._partitions[p]
+        self._partitions[p] = []
+
+        for f in files:
+            self._sizes.pop(f, None)
+
+        return p, files
+
+
     def update_partitions(self, partitions):
         """updates partition-dictionary for future iterator generation."""
 
-        for p, filename in partitions.items():
+        for p, (filename, records, bytes) in partitions.items():
+            self._sizes[filename] = records, bytes
+
             if p in self._partitions:
                 self._partitions[p].append(filename)
             else:
                 self._partitions[p] = [filename]
 
 
+    def partition_sizes(self):
+        """returns (partition, [(file, records, bytes), ...]) tuples
+        in order of partition numbers"""
+
+        return [(p, [(f,) + self._sizes.get(f, (0, 0)) for f in files])
+                    for p, files in sorted(self._partitions.iteritems())]
+
+
     def __iter__(self):
-        return self._partitions.itervalues()
+        """partitions are iterated in order of their numbers"""
+        return (files for p, files in sorted(self._partitions.iteritems()))
 
 
     def load(self, key):
-        self.reduce_input.input = key
-        return self.reduce_input
+        """returns (key, values) iterator over all the items of a partition"""
+
+        files = list(key)
+        temporary = []
+
+        while len(files) > self.merge_factor:
+            logger.debug("im: merging %d files in groups of %d" % (len(files), self.merge_factor))
+
+            merged = []
+            for i in range(0, len(files), self.merge_factor):
+                run_key = '%spass-%s' % (self.prefix(), uuid.uuid4().hex)
+                merged.append(self.map_output.dump(run_key,
+                        self._tuples(files[i:i + self.merge_factor])))
+
+            # inputs of the pass are removed unless they are the partition's
+            for run_key in temporary:
+                self.map_output.remove(run_key)
+
+            files = temporary = merged
+
+        return group_values(self._merged(files, temporary))
+
+
+    def _tuples(self, files):
+        """returns sorted (key, values) tuples of files"""
+
+        with self._lock:
+            self.reduce_input.input = files
+            return iter(self.reduce_input)
+
+
+    def _merged(self, files, temporary):
+        """generates sorted (key, values) tuples of files, removes the
+        temporary ones once they are read"""
+
+        try:
+            for kv in self._tuples(files):
+                yield kv
+
+        finally:
+            for run_key in temporary:
+                self.map_output.remove(run_key)
 
 
     def dump(self, pdict, mapid):
         """dumps a dictionary to a backend.
-        returns corresponding partitions-dictionary"""
-
-        logger.debug("im: dumping %s" % str(pdict))
+        returns corresponding partitions-dictionary of
+        (key, records, bytes) tuples"""
 
         partitions = {}
 
         for p, tuples in pdict:
 
             key = self.pattern % (self.task_id, p, mapid)
-            partitions[p] = key
 
-            logger.debug("im: dumping %s to %s" % (str(tuples), key))
+            logger.debug("im: dumping partition %d to %s" % (p, key))
+
+            size = [0, 0]
+            location = self.map_output.dump(key, self._count(tuples, size))
+
+            partitions[p] = (location, size[0], size[1])
+
+        return partitions
+
+
+    def _count(self, tuples, size):
+        """passes tuples through, counting records and bytes into size"""
+
+        for k, vs in tuples:
+            size[0] += len(vs)
+            size[1] += estimate_size(k) + sum(estimate_size(v) for v in vs)
+            yield k, vs
+
+
+    def merge_runs(self, runs, mapid):
+        """merges partitions-dictionaries of runs (spilled by a map task or
+        files of a partition merged ahead of the reduce stage) into one file
+        per partition and removes the runs.
+        returns corresponding partitions-dictionary"""
+
+        run_keys = {}
+        for run in runs:
+            for p, (key, records, bytes) in run.iteritems():
+                if p in run_keys:
+                    run_keys[p].append(key)
+                else:
+                    run_keys[p] = [key]
+
+        return self.merge_files(run_keys, mapid)
+
+
+    def merge_files(self, run_keys, mapid):
+        """merges files of every partition of a {partition: [file, ...]}
+        dictionary into one and removes them.
+        returns corresponding partitions-dictionary"""
+
+        pdict = ((p, ((k, list(vs)) for k, vs in self.load(keys)))
+                    for p, keys in run_keys.iteritems())
 
-            self.map_output.dump(key, tuples)
+        partitions = self.dump(pdict, mapid)
+
+        for keys in run_keys.itervalues():
+            for key in keys:
+                self.map_output.remove(key)
 
         return partitions
 
 
+    def discard(self, partitions):
+        """removes files of a partitions-dictionary from a backend"""
+
+        for key, records, bytes in partitions.itervalues():
+            self.map_output.remove(key)
+
+
 class IntermediateResultsFiles(IntermediateResults):
-    """Storing intermediate results in flat files."""
+    """Storing intermediate results in flat files.
+
+    dir is a DatasourceDir (or DatasourceStriped across several disks)
+    shared by all the workers, or a DatasourceShuffle to keep files on local
+    disks of nodes. Files of a task are removed in clear() (only the ones
+    in local directories with DatasourceShuffle), map tasks refuse to start
+    when the directory is short of free space (min_free of the datasource).
+
+    Files are written in one of the formats:
+    * 'pickle': a stream of pickled tuples;
+    * 'block': length-prefixed blocks of block_records tuples, pickled
+      with the highest protocol, compressed with compression (None, 'zlib'
+      or 'bz2') and checksummed.
+    """
 
-    def __init__(self, dir):
+    def __init__(self, dir, format='pickle', compression=None, block_records=1000):
         super(IntermediateResultsFiles, self).__init__()
         self.dir = dir
 
-        self.map_output = FilePickleOutput(dir=dir)
-        self.reduce_input = FileUnpicleSubslicer(dir=dir)
+        if format == 'pickle':
+            self.map_output = FilePickleOutput(dir=dir)
+            self.reduce_input = FileUnpicleSubslicer(dir=dir)
+
+        elif format == 'block':
+            self.map_output = FileBlockOutput(dir=dir, compression=compression,
+                                                block_records=block_records)
+            self.reduce_input = FileBlockSubslicer(dir=dir)
+
+        else:
+            raise ValueError("unknown intermediate results format: %s" % format)
+
+
+    def clear(self):
+        """removes all the files of the task, the known ones through the
+        datasource (they may be on other nodes with DatasourceShuffle)"""
+
+        if self.cleanup:
+            logger.info("im: task %s used %d bytes" % (self.task_id, self.usage()))
+
+            for files in self._partitions.itervalues():
+                for key in files:
+                    try:
+                        self.map_output.remove(key)
+                    except (IOError, OSError), e:
+                        logger.debug("im: can't remove %s: %s" % (key, e))
+
+            self.dir.remove_prefix(self.prefix())
+
+        super(IntermediateResultsFiles, self).clear()
+
+
+    def usage(self):
+        """bytes used by files of the task"""
+        return self.dir.usage(self.prefix())
+
+
+    def check_space(self):
+        self.dir.check_space()
 
 
 class IntermediateResultsSQL(IntermediateResults):
@@ -166,21 +608,68 @@ class IntermediateResultsSQL(IntermediateResults):
         self.reduce_input = SQLTableKeyInput(db=db, table=table)
 
 
+    def clear(self):
+        """removes all the rows of the task"""
+        super(IntermediateResultsSQL, self).clear()
+
+        if self.cleanup:
+            self.map_output.remove_prefix(self.prefix())
+
+
 class MapReduceTask(Task):
 
     datasources = {}
 
     input = None
+
+    # output dict collecting all the reduce outputs, or a sink (FileSink,
+    # SQLTableSink, CallableSink) reduce tasks write to directly, then the
+    # callback gets a list of output summaries instead
     output = None
 
     map = None
     reduce = None
+    combine = None
 
     intermediate = IntermediateResultsFiles
     intermediate_kwargs = {'dir': None }
 
     reducers = 1
 
+    # partitioner of map output keys, HashPartitioner or RangePartitioner
+    # (globally sorted output, split points sampled from input)
+    partitioner = HashPartitioner()
+
+    # input splits: a map task gets split_keys input keys, or keys of about
+    # split_bytes bytes if the input provides size(key) (None means one key)
+    split_keys = None
+    split_bytes = None
+
+    # memory budget of map output, map tasks spill sorted runs to
+    # intermediate results when it is exceeded (None means no limit)
+    map_buffer_records = None
+    map_buffer_bytes = 64 * 1024 * 1024
+
+    # reduce slow-start: once this fraction of map tasks is done, workers
+    # left idle by the map stage merge partition files (at least
+    # merge_min_files of them) ahead of the reduce stage (None disables it)
+    reduce_slowstart = None
+    merge_min_files = 2
+
+    # skew: files of a partition larger than skew_factor times the median
+    # partition are split across several reduce tasks, their outputs are
+    # then reduced once again for the final output, so the reduce task has
+    # to accept its own output values (like combine) (None disables it)
+    skew_factor = None
+
+    # speculative execution: once speculative_threshold fraction of a stage
+    # is done, a backup attempt is started for a task running longer than
+    # speculative_slowdown times the median task of the stage, the first
+    # attempt to finish wins
+    speculative_execution = False
+    speculative_threshold = 0.75
+    speculative_slowdown = 2.0
+
     description = "Abstract Map-Reduce Task"
 
     sequential = False
@@ -189,13 +678,38 @@ class MapReduceTask(Task):
     def __init__(self, msg=None):
         Task.__init__(self, msg)
         self.map_tasks = {}
+        self.merge_tasks = {}
         self.reduce_tasks = {}
+        self.split_tasks = {}
+
+        self._lock = Lock()
+
+        self._sink = hasattr(self.output, 'open')
+
+        # speculative execution bookkeeping
+        self._map_times = []
+        self._reduce_times = []
+        self._work_args = {}
+        self._attempts = {}
+        self._lost_attempts = {}
 
-        self.im = self.intermediate
+        # every instance (worker slot) has its own copy, task_id of a job
+        # run is set in _start() and sent to the workers with the work units
+        self.im = self.intermediate.copy()
         self.im.task_id = msg
         self.im.reducers = self.reducers
+        # the partitioner keeps split points of the job run, every instance
+        # has its own
+        self.partitioner = copy.copy(self.partitioner)
+        self.im.partitioner = self.partitioner
 
-        self.maptask = MapWrapper(self.map('MapTask'), self.im, self)
+        if self.combine:
+            combinetask = self.combine('CombineTask')
+        else:
+            combinetask = None
+
+        self.maptask = MapWrapper(self.map('MapTask'), self.im, self, combinetask,
+                                self.map_buffer_records, self.map_buffer_bytes)
 
         self.reducetask = ReduceWrapper(self.reduce('ReduceTask'), self.im, self)
 
@@ -207,12 +721,39 @@ class MapReduceTask(Task):
         """called on a map task completion"""
 
         logger.debug('   map_callback %s: %s' % (mapid, result))
-        self.im.update_partitions(result)
 
-        try:
-            del self.map_tasks[mapid]
-        except KeyError:
-            logger.debug('   map_callback: no such task -> %s' % mapid)
+        with self._lock:
+            won = self._status != STATUS_FAILED and \
+                    self._attempt_complete(self.map_tasks, self._map_times, mapid)
+            if won:
+                self.im.update_partitions(result)
+                self._maps_done += 1
+
+        if not won:
+            # other attempt of this map task was faster
+            self.im.discard(result)
+
+        # more work?
+        self._next(local)
+
+
+    def merge_callback(self, result, mergeid=None, local=False):
+        """called on a merge task completion"""
+
+        logger.debug('   merge_callback %s: %s' % (mergeid, result))
+
+        with self._lock:
+            failed = self._status == STATUS_FAILED
+            if not failed:
+                self.im.update_partitions(result)
+
+            try:
+                del self.merge_tasks[mergeid]
+            except KeyError:
+                logger.debug('   merge_callback: no such task -> %s' % mergeid)
+
+        if failed:
+            self.im.discard(result)
 
         # more work?
         self.map_next(local)
@@ -222,35 +763,121 @@ class MapReduceTask(Task):
         """called on a reduce task completion"""
 
         logger.debug('   reduce_callback %s: %s' % (reduceid, result))
-        self.output.update(result)
 
-        try:
-            del self.reduce_tasks[reduceid]
-        except KeyError:
-            logger.debug('   reduce_callback: no such task -> %s' % reduceid)
+        with self._lock:
+            if self._attempt_complete(self.reduce_tasks, self._reduce_times, reduceid):
+                if self._sink:
+                    self._summaries.append(result)
+                else:
+                    self.output.update(result)
 
         # more work?
         self.reduce_next(local)
 
 
+    def split_callback(self, result, splitid=None, local=False):
+        """called on a completion of a reduce task of a part of a hot partition"""
+
+        logger.debug('   split_callback %s: %s' % (splitid, result))
+
+        with self._lock:
+            try:
+                p = self.split_tasks.pop(splitid)
+            except KeyError:
+                logger.debug('   split_callback: no such task -> %s' % splitid)
+            else:
+                if self._status == STATUS_FAILED:
+                    self.im.discard(result)
+                    return
+
+                split = self._splits[p]
+                split[0] -= 1
+                split[1].extend(key for key, records, bytes in result.itervalues())
+
+                # all the parts are done, outputs are reduced once again
+                if split[0] == 0:
+                    self._reduce_queue.append(self._reduce_unit(p, split[1]))
+
+        # more work?
+        self.reduce_next(local)
+
+
+    def _attempt_complete(self, tasks, times, id):
+        """removes a completed task (attempt), returns False if other attempt
+        of the task has already won. Called under self._lock."""
+
+        if id in self._lost_attempts:
+            del self._lost_attempts[id]
+            logger.debug('   discarding results of a lost attempt -> %s' % id)
+            return False
+
+        try:
+            times.append(time.time() - tasks.pop(id))
+        except KeyError:
+            logger.debug('   no such task -> %s' % id)
+
+        self._work_args.pop(id, None)
+
+        # the other attempt lost, its results will be discarded
+        other = self._attempts.pop(id, None)
+        if other is not None:
+            del self._attempts[other]
+            del tasks[other]
+            self._work_args.pop(other, None)
+            self._lost_attempts[other] = tasks is self.map_tasks \
+                    and self.map_callback or self.reduce_callback
+
+        return True
+
+
+    def _next(self, local=False):
+        """more work for a slot freed by a map task"""
+
+        if self._reduce_queue is None:
+            self.map_next(local)
+        else:
+            self.reduce_next(local)
+
+
     def _start(self, args, callback, callback_args={}):
         """overridden to prevent early cleanup.
         
         MapReduceTask does not implement work() and don't expect user to provide its own. Instead it requires user to provide map and reduce attributes which should be classes derived from MapTask and ReduceTask respectively.
 
+        Optional combine attribute is a class with the same contract as the reduce task. It is run by a map task on every partition of its output before dumping it, to shrink intermediate results (e.g. summing counts).
+
         Cleanup is in _complete() which will be called when there is no more work remaining.
         map:
-        * work(): initialization and calling map_next() for every worker available;
+        * work(): initialization, sampling of input by the partitioner and calling map_next() for every worker available;
         * map_next(): checking if any data to process and starting a map task,
-          if no more data available, call reduce_stage();
+          if no more data available and no map task is running, call reduce_stage();
         * map_callback(): updating results (partition) and calling map_next() for more work.
+
+        reduce slow-start (if reduce_slowstart is set):
+        * map_next(): when no more data is available, but map tasks are still running,
+          merging files of a partition instead (reduce task in merge mode);
+        * merge_callback(): updating results (partition) and calling map_next() for more work.
+
+        speculative execution (if speculative_execution is set):
+        * map_next(), reduce_next(): when no more data is available, starting
+          a backup attempt of a straggling task of the stage (_begin_backup());
+        * callbacks: the first attempt to finish wins, results of the other
+          one are discarded when it completes (_attempt_complete()).
         
         reduce:
-        * reduce_stage: calling reduce_next() for every worker available;
+        * reduce_stage: planning reduce tasks, calling reduce_next() for every worker available;
         * reduce_next(): checking if any data to process and starting a reduce task,
-          if no more data available, call _complete();
+          if no more data available and no reduce task is running, call _complete();
         * reduce_callback(): updating results (output) and calling reduce_next() for more work.
 
+        skew (if skew_factor is set):
+        * reduce_stage(): files of a hot partition are split across several reduce tasks;
+        * split_callback(): collecting their outputs (dumped to intermediate results),
+          after the last one a reduce task of the outputs is queued.
+
+        Stage barriers are event-driven: the callback of the last running task
+        finds no more data and moves to the next stage (exactly once, under self._lock).
+
         _complete:
         * cleanup and callbacks.
         """
@@ -260,12 +887,27 @@ class MapReduceTask(Task):
 
         self._status = STATUS_RUNNING
 
+        # files of every job run have their own prefix
+        self.im.task_id = uuid.uuid4().hex
+
         self._reduce_called = False
         self._complete_called = False
 
+        self._maps_started = 0
+        self._maps_done = 0
+        self._merge_count = 0
+
+        self._reduce_queue = None
+        self._splits = {}
+        self._summaries = []
+
         # XXX we use current worker
         self._available_workers = self.get_worker().available_workers
-        self._input_iter = enumerate(self.input)
+        self._input_iter = enumerate(self._input_splits())
+
+        # split points etc. are sent to the workers with every map task
+        self.partitioner.sample(self)
+        self._partitioner_state = self.partitioner.get_state()
 
         # let's start the processing
         logger.debug('mapreduce: map stage')
@@ -280,49 +922,195 @@ class MapReduceTask(Task):
     def map_next(self, local=False):
         """more work for a map task"""
 
-        try:
-            id, i = self._input_iter.next()
-        except StopIteration:
-            # call reduce stage
-            if not self._reduce_called:
-                self._reduce_called = True
+        with self._lock:
+            if self._status == STATUS_FAILED:
+                return
+
+            try:
+                id, i = self._input_iter.next()
+                mapid = 'map%d' % id
+                self.map_tasks[mapid] = time.time()
+                self._maps_started += 1
+
+            except StopIteration:
+                mapid = None
+
+                # reduce slow-start, merge while the last maps are running
+                merge = self._begin_merge()
+
+                # speculative execution, backup of a straggling map task
+                backup = not merge and self._begin_backup(self.map_tasks,
+                                                          self._map_times)
+
+                # barrier, reduce stage starts after the last map (and merge) task
+                barrier = not (merge or self.map_tasks or self.merge_tasks \
+                                or self._reduce_called)
+                if barrier:
+                    self._reduce_called = True
+
+        if mapid is None:
+            if backup:
+                backupid, map_args = backup
+
+                logger.debug('   starting backup maptask: %s' % backupid)
+                self._start_work_unit(self.maptask, map_args, backupid,
+                        self.map_callback, {'mapid': backupid}, local)
+
+            elif merge:
+                mergeid, p, files = merge
+
+                logger.debug('   starting mergetask: %s' % mergeid)
+                merge_args = {
+                                'id': mergeid,
+                                'merge': p,
+                                'partition': files,
+                             }
+
+                self._start_work_unit(self.reducetask, merge_args, mergeid,
+                        self.merge_callback, {'mergeid': mergeid}, local)
+
+            elif barrier:
                 self.reduce_stage()
 
             return
 
-        mapid = 'map%d' % id
-        self.map_tasks[mapid] = 1
-
         logger.debug('   starting maptask: %s' % mapid)
         map_args = {
                     'id': mapid,
-                    'input_key': i,
                    }
 
+        if self._input_grouped:
+            map_args['input_keys'] = i
+        else:
+            map_args['input_key'] = i
+
+        if self._partitioner_state is not None:
+            map_args['partitioner'] = self._partitioner_state
+
+        if self.speculative_execution:
+            self._work_args[mapid] = dict(map_args)
+
+        self._start_work_unit(self.maptask, map_args, mapid,
+                self.map_callback, {'mapid': mapid}, local)
+
+
+    def _input_splits(self):
+        """returns an iterator of input keys, or of splits grouping them"""
+
+        size = getattr(self.input, 'size', None)
+        split_bytes = size and self.split_bytes
+
+        if self.split_bytes and not size:
+            logger.warning('mapreduce: input has no size(), split_bytes ignored')
+
+        self._input_grouped = bool(self.split_keys or split_bytes)
+
+        if self._input_grouped:
+            return group_keys(self.input, self.split_keys, split_bytes, size)
+
+        return iter(self.input)
+
+
+    def _begin_merge(self):
+        """picks partition files to be merged while map tasks are still running,
+        returns (mergeid, partition, files) or None. Called under self._lock."""
+
+        if self.reduce_slowstart is None or not self.map_tasks:
+            return None
+
+        if self._maps_done < self.reduce_slowstart * self._maps_started:
+            return None
+
+        # files of a partition which may be split by the reduce stage are
+        # left unmerged, merged into one file they could not be split
+        exclude = self.merge_tasks.values()
+        if self.skew_factor:
+            exclude.extend(self._skew_candidates(self.im.partition_sizes()))
+
+        p, files = self.im.begin_merge(self.merge_min_files, exclude)
+        if p is None:
+            return None
+
+        mergeid = 'merge%d' % self._merge_count
+        self._merge_count += 1
+        self.merge_tasks[mergeid] = p
+
+        return mergeid, p, files
+
+
+    def _skew_candidates(self, partitions):
+        """returns partitions larger than skew_factor times the median of
+        all the partitions so far, partitions are (partition, files) tuples
+        of partition_sizes(). Partitions without files count as empty, so
+        all of them are candidates until most partitions have some data"""
+
+        sizes = dict((p, sum(b for f, r, b in files)) for p, files in partitions)
+        median = sorted(sizes.get(p, 0) for p in range(self.reducers))[self.reducers / 2]
+
+        return [p for p, bytes in sizes.iteritems() if bytes > self.skew_factor * median]
+
+
+    def _begin_backup(self, tasks, times):
+        """picks the longest running task of a stage to be run once again,
+        if it runs much longer than the median task of the stage.
+        returns (backupid, args) or None. Called under self._lock."""
+
+        if not self.speculative_execution or not tasks or not times:
+            return None
+
+        if len(times) < self.speculative_threshold * (len(times) + len(tasks)):
+            return None
+
+        median = sorted(times)[len(times) / 2]
+        now = time.time()
+
+        stragglers = [(start, id) for id, start in tasks.iteritems()
+                        if id not in self._attempts
+                        and now - start > self.speculative_slowdown * median]
+
+        if not stragglers:
+            return None
+
+        start, id = min(stragglers)
+        backupid = '%s-backup' % id
+
+        args = self._work_args[id].copy()
+        if 'id' in args:
+            args['id'] = backupid # map output goes to its own files
+
+        tasks[backupid] = now
+        self._work_args[backupid] = dict(args)
+        self._attempts[id] = backupid
+        self._attempts[backupid] = id
+
+        return backupid, args
+
+
+    def _start_work_unit(self, task, args, id, callback, callback_args, local=False):
+        """starts a map, merge or reduce task: right here in sequential mode,
+        in a thread of this worker or on a worker requested from the cluster"""
+
+        # the work unit uses the files of this job run
+        args['run'] = self.im.task_id
+
         if self.sequential:
-            self.maptask._start(args=map_args, callback=self.map_callback,
-                                            callback_args={'mapid': mapid})
+            task._start(args=args, callback=callback, callback_args=callback_args)
         else:
             if local: # XXX orginal worker is to run computations as well, or schedule only?
-                logger.debug("mapreduce: running locally %s" % mapid)
-                self.maptask.start(args=map_args, callback=self.map_callback,
-                                    callback_args={'mapid': mapid, 'local': local})
+                logger.debug("mapreduce: running locally %s" % id)
+                callback_args['local'] = local
+                task.start(args=args, callback=callback, callback_args=callback_args,
+                        errback=self._work_unit_failed)
             else:
                 logger.debug("mapreduce: requesting worker for %s: %s"
-                        % (mapid, self.maptask.get_key()) )
-                self.parent.request_worker(self.maptask.get_key(), map_args, mapid)
+                        % (id, task.get_key()) )
+                self.parent.request_worker(task.get_key(), args, id)
 
 
     def reduce_stage(self):
         """starting a reduce stage"""
 
-        if self.map_tasks:
-            logger.debug('mapreduce: waiting for map stage to finish')
-            reactor.callLater(1, self.reduce_stage)
-            return
-
-
-        self._partition_iter = enumerate(self.im)
+        self._reduce_queue = deque(self._plan_reduce())
 
         logger.debug('mapreduce: reduce stage')
 
@@ -333,40 +1121,131 @@ class MapReduceTask(Task):
         self.reduce_next(local=True)
 
 
+    def _plan_reduce(self):
+        """returns (reduceid, args) of a reduce task for every partition,
+        a hot partition is split by its files into several reduce tasks"""
+
+        partitions = self.im.partition_sizes()
+
+        sizes = sorted(sum(b for f, r, b in files) for p, files in partitions)
+        median = sizes and sizes[len(sizes) / 2]
+
+        units = []
+
+        for p, files in partitions:
+            bytes = sum(b for f, r, b in files)
+
+            parts = 1
+            if self.skew_factor and median and bytes > self.skew_factor * median:
+                parts = min(len(files), int(math.ceil(float(bytes) / median)))
+
+            if parts < 2:
+                units.append(self._reduce_unit(p, [f for f, r, b in files]))
+                continue
+
+            logger.debug('mapreduce: splitting partition %d (%d bytes) into %d parts'
+                    % (p, bytes, parts))
+
+            self._splits[p] = [parts, []]
+
+            for i, chunk in enumerate(split_files(files, parts)):
+                splitid = 'reduce%d-split%d' % (p, i)
+                units.append((splitid, {'id': splitid, 'split': p, 'partition': chunk}))
+
+        return units
+
+
+    def _reduce_unit(self, p, files):
+        """returns (reduceid, args) of a reduce task of a partition"""
+
+        reduceid = 'reduce%d' % p
+        return reduceid, {
+                            'id': reduceid,
+                            'partition': files,
+                            'output_name': 'part-%05d' % p,
+                         }
+
+
     def reduce_next(self, local=False):
         """more work for reduce task"""
 
-        try:
-            id, p = self._partition_iter.next()
-        except StopIteration:
-            # call task complete (final stage)
-            if not self._complete_called:
-                self._complete_called = True
+        with self._lock:
+            if self._status == STATUS_FAILED:
+                return
+
+            try:
+                reduceid, reduce_args = self._reduce_queue.popleft()
+
+                if 'split' in reduce_args:
+                    self.split_tasks[reduceid] = reduce_args['split']
+                else:
+                    self.reduce_tasks[reduceid] = time.time()
+
+            except IndexError:
+                reduceid = None
+
+                # speculative execution, backup of a straggling reduce task
+                # (only if the output of both the attempts would be the same)
+                backup = getattr(self.output, 'idempotent', True) and \
+                        self._begin_backup(self.reduce_tasks, self._reduce_times)
+
+                # barrier, task completes after the last reduce task
+                barrier = not (self.reduce_tasks or self.split_tasks \
+                                or self._complete_called)
+                if barrier:
+                    self._complete_called = True
+
+        if reduceid is None:
+            if backup:
+                backupid, reduce_args = backup
+
+                logger.debug('   starting backup reducetask: %s' % backupid)
+                self._start_work_unit(self.reducetask, reduce_args, backupid,
+                        self.reduce_callback, {'reduceid': backupid}, local)
+
+            elif barrier:
+                # call task complete (final stage)
                 self._complete()
 
             return
 
+        logger.debug('   starting reducetask: %s' % reduceid)
+
+        if 'split' in reduce_args:
+            self._start_work_unit(self.reducetask, reduce_args, reduceid,
+                    self.split_callback, {'splitid': reduceid}, local)
+            return
+
+        if self.speculative_execution:
+            self._work_args[reduceid] = dict(reduce_args)
 
-        reduceid = 'reduce%d' % id
-        self.reduce_tasks[reduceid] = 1
+        self._start_work_unit(self.reducetask, reduce_args, reduceid,
+                self.reduce_callback, {'reduceid': reduceid}, local)
 
-        logger.debug('   starting reducetask: %s' % reduceid)
-        reduce_args = {
-                        'partition': p,
-                      }
 
-        if self.sequential:
-            self.reducetask._start(args=reduce_args, callback=self.reduce_callback,
-                                callback_args={'reduceid': reduceid})
-        else:
-            if local: # XXX orginal worker is to run computations as well, or schedule only?
-                logger.debug("mapreduce: running locally %s" % reduceid)
-                self.reducetask.start(args=reduce_args, callback=self.reduce_callback,
-                                        callback_args={'reduceid': reduceid, 'local': local})
-            else:
-                logger.debug("mapreduce: requesting worker for %s: %s"
-                        % (reduceid, self.reducetask.get_key()) )
-                self.parent.request_worker(self.reducetask.get_key(), reduce_args, reduceid)
+    def _work_unit_failed(self, failure):
+        """errback of a local work unit, the task fails: no more work units
+        are started, results of the running ones are discarded and the
+        failure is reported to the worker, the master then stops the work
+        units of the task running on other workers"""
+
+        logger.error('mapreduce: work unit failed: %s' % failure.getErrorMessage())
+
+        with self._lock:
+            self._status = STATUS_FAILED
+
+        self.im.clear()
+
+        worker = self.get_worker()
+        if hasattr(worker, 'work_failed'):
+            worker.work_failed(failure)
+
+
+    def _stop(self):
+        """stops the task, removing its intermediate results"""
+
+        Task._stop(self)
+        self.im.clear()
 
 
     def _work_unit_complete(self, result, id):
@@ -378,30 +1257,41 @@ class MapReduceTask(Task):
         if id in self.map_tasks:
             self.map_callback(result, id, local=False)
 
+        elif id in self.merge_tasks:
+            self.merge_callback(result, id, local=False)
+
         elif id in self.reduce_tasks:
             self.reduce_callback(result, id, local=False)
 
+        elif id in self.split_tasks:
+            self.split_callback(result, id, local=False)
+
+        elif id in self._lost_attempts:
+            self._lost_attempts[id](result, id, local=False)
+
 
     def _complete(self):
         """
         Should be called when all map and reduce task have completed
         """
 
-        if self.reduce_tasks:
-            logger.debug('mapreduce: waiting for reduce stage to finish')
-            reactor.callLater(1, self._complete)
-            return
-
         self.im.clear()
 
         logger.debug('mapreduce: finished')
-        logger.info(self.output)
+
+        if self._sink:
+            results = sorted(self._summaries, key=itemgetter('path'))
+            logger.info('mapreduce: %d records written to %d outputs' %
+                    (sum(s['records'] for s in results), len(results)))
+        else:
+            results = self.output
+            logger.info('mapreduce: %d output items' % len(results))
 
         self._status = STATUS_COMPLETE
 
         #make a callback, if any
         if self.__callback:
-            self.__callback(self.output, **self._callback_args)
+            self.__callback(results, **self._callback_args)
 
 
     def get_subtask(self, task_path):
@@ -492,29 +1382,95 @@ class MapReduceWrapper():
 
 class MapWrapper(MapReduceWrapper):
 
+    def __init__(self, task, im, parent, combiner=None,
+                    buffer_records=None, buffer_bytes=None):
+        MapReduceWrapper.__init__(self, task, im, parent)
+
+        self.combiner = combiner
+        if combiner:
+            combiner.parent = parent
+
+        self.buffer_records = buffer_records
+        self.buffer_bytes = buffer_bytes
+
+
+    def combine(self, pdict):
+        """runs the combiner on every partition of a partitioned output,
+        combined partitions are sorted by key as well"""
+
+        for p, tuples in pdict:
+            output = AppendableDict()
+            self.combiner._work(input=group_values(tuples), output=output)
+
+            yield p, sorted(output.iteritems(), key=itemgetter(0))
+
+
+    def partition(self, output):
+        """partitions, sorts and combines map output"""
+
+        pdict = self.im.partition_output(output)
+
+        if self.combiner:
+            pdict = self.combine(pdict)
+
+        return pdict
+
+
     def _start(self, args={}, callback=None, callback_args={}):
         """
         Overwrites Task._start() because MapTask needs to provide special input and output
         dictionaries. And it is necessary to self.im.dump() intermediate results after
         self.work().
+
+        Map output is buffered in memory up to the buffer budget, a full buffer
+        is spilled as a sorted run and the runs are merged after self.work().
+
+        With 'input_keys' argument (an input split) self.work() is called for
+        every key of the split, all with the same output.
         """
         logger.debug('%s - MapWrapper.work()'  % self.get_worker().worker_key)
 
+        # args of the work unit are kept for its backup, not changing them
+        args = dict(args)
+
+        if args.has_key('run'):
+            self.im.task_id = args.pop('run')
+
+        # refusing to start without space for the output
+        self.im.check_space()
+
+        if args.has_key('partitioner'):
+            self.im.partitioner.set_state(args.pop('partitioner'))
+
         if args.has_key('input_key') and hasattr(self.parent, 'input'):
             args['input'] = self.parent.input.load(args['input_key'])
 
-        output = AppendableDict()
+        id = args['id']
+        runs = []
+
+        def spill(buffer):
+            run_id = '%s-run%d' % (id, len(runs))
+            logger.debug("%s._work() spilling %d records to %s" % (id, buffer.records, run_id))
+            runs.append(self.im.dump(self.partition(buffer), run_id))
+
+        output = MapOutputBuffer(spill, self.buffer_records, self.buffer_bytes)
         args['output'] = output
 
-        id = args['id']
         logger.debug("%s._work()" % id)
 
-        self.task._work(**args) # ignoring results
-
-        pdict = self.im.partition_output(output)
+        if args.has_key('input_keys') and hasattr(self.parent, 'input'):
+            for key in args['input_keys']:
+                args['input'] = self.parent.input.load(key)
+                self.task._work(**args) # ignoring results
+        else:
+            self.task._work(**args) # ignoring results
 
         logger.debug("%s._work() dumping i9e" % id)
-        results = self.im.dump(pdict, id) # partitions are our results
+        if runs:
+            output.flush()
+            results = self.im.merge_runs(runs, id)
+        else:
+            results = self.im.dump(self.partition(output), id) # partitions are our results
 
         logger.debug('%s - MapWrapper - work complete' % self.get_worker().worker_key)
 
@@ -534,14 +1490,51 @@ class ReduceWrapper(MapReduceWrapper):
         """
         Overwrites Task._start() beacuse ReduceTask needs to provide special input
         dictionaries (from self.im).
+
+        With 'merge' argument (reduce slow-start) it only merges the partition
+        files into one and returns corresponding partitions-dictionary.
+
+        With 'split' argument (a part of a hot partition) the output is dumped
+        to intermediate results, partitions-dictionary is returned.
+
+        If the output of MapReduceTask is a sink, the output is written to it
+        and only its summary is returned.
         """
         logger.debug('%s - ReduceWrapper.work()'  % self.get_worker().worker_key)
 
-        args['input'] = self.im.load(args['partition'])
-        output = args['output'] = {}
+        # args of the work unit are kept for its backup, not changing them
+        args = dict(args)
+
+        if args.has_key('run'):
+            self.im.task_id = args.pop('run')
+
+        if args.has_key('merge'):
+            p = args['merge']
+            results = self.im.merge_files({p: args['partition']}, args['id'])
+
+        elif args.has_key('split'):
+            p = args['split']
+            args['input'] = self.im.load(args['partition'])
+            output = args['output'] = {}
+
+            self.task._work(**args) # ignoring results
+
+            tuples = sorted(((k, [v]) for k, v in output.iteritems()), key=itemgetter(0))
+            results = self.im.dump([(p, tuples)], args['id'])
+
+        elif hasattr(getattr(self.parent, 'output', None), 'open'):
+            args['input'] = self.im.load(args['partition'])
+            output = args['output'] = self.parent.output.open(args['output_name'], args['id'])
+
+            self.task._work(**args) # ignoring results
+            results = output.close()
+
+        else:
+            args['input'] = self.im.load(args['partition'])
+            output = args['output'] = {}
 
-        self.task._work(**args) # ignoring results
-        results = output
+            self.task._work(**args) # ignoring results
+            results = output
 
         logger.debug('%s - ReduceWrapper - work complete' % self.get_worker().worker_key)
 
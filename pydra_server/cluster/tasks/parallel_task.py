@@ -19,6 +19,9 @@
 
 from __future__ import with_statement
 from threading import Thread, Lock
+from collections import deque
+from itertools import islice
+import math
 from twisted.internet import reactor, threads
 
 from pydra_server.cluster.tasks import Task, TaskNotFoundException, STATUS_CANCELLED, STATUS_CANCELLED,\
@@ -30,18 +33,51 @@ logger = logging.getLogger('root')
 class ParallelTask(Task):
     """
     ParallelTask - is a task that can be broken into discrete work units
+
+    Small work units can be sent in batches to save on requests for workers.
+    batch_size items of _data are sent at once or, with guided scheduling,
+    1/(available workers) of the remaining items but at least batch_size, so
+    the batches are big at the start and shrink towards the end.  The subtask
+    gets a 'batch' arg (see Task._work) and work_unit_complete is still
+    called for each item.
+
+    _data can be a list, any iterator (generator) or a Datasource (Slicer),
+    items are pulled from it only when they are handed out.  The items of
+    a datasource are its keys, subtasks can get the data with
+    self.parent.load(key) when the datasource is created in __init__.
+
+    Results can be combined with an associative merge(results1, results2)
+    method instead of work_unit_complete.  Results of a batch are merged on
+    the worker running it, the main worker merges one result per workunit
+    as they come, so with big (guided) batches it gets few of them.  Results
+    are not merged per node, workunits of workers of a node are returned to
+    the main worker separately.  By default work_complete returns the merged
+    results.
     """
     _lock = None                # general lock
     _available_workers = 1      # number of workers available to this task
-    _data = None                # list of data for this task
-    _data_in_progress = {}      # workunits of data
+    _data = None                # list, iterator or datasource of data for this task
+    _data_in_progress = None    # workunits of data
+    _items = None               # iterator over _data, None when exhausted
+    _queue = None               # items read ahead from _items or returned by failed workers
+    _size = None                # number of items in _data if known
+    _pulled = 0                 # items pulled from _items
     _workunit_count = 0         # count of workunits handed out.  This is used to identify transactions
     subtask = None              # subtask that is parallelized
     subtask_key = None          # cached key from subtask
+    batch_size = 1              # items of _data in a workunit
+    guided = False              # guided self-scheduling of batch sizes
+    merge = None                # associative function merging results, see above
+    _merge_lock = None          # lock for _merged
+    _merged = None              # results merged so far
+    _merged_count = 0           # workunits merged into _merged
 
     def __init__(self, msg=None):
         Task.__init__(self, msg)
         self._lock = Lock()
+        self._merge_lock = Lock()
+        self._data_in_progress = {}
+        self._queue = deque()
 
     def __setattr__(self, key, value):
         Task.__setattr__(self, key, value)
@@ -60,6 +96,26 @@ class ParallelTask(Task):
         pass
 
 
+    def work_complete(self):
+        """
+        Method stub for method called when all workunits are complete, returns
+        results of the task.  By default these are the merged results.
+        """
+        return self._merged
+
+
+    def _merge_results(self, results):
+        """
+        merges results of a workunit into results merged so far
+        """
+        with self._merge_lock:
+            if self._merged_count:
+                self._merged = self.merge(self._merged, results)
+            else:
+                self._merged = results
+            self._merged_count += 1
+
+
     def progress(self):
         """
         progress - returns the progress as a number 0-100.
@@ -90,6 +146,17 @@ class ParallelTask(Task):
 
         self.subtask_key = self.subtask._generate_key()
 
+        with self._merge_lock:
+            self._merged = None
+            self._merged_count = 0
+
+        with self._lock:
+            self._data_in_progress = {}
+            self._queue = deque()
+            self._items = iter(self._data)
+            self._size = len(self._data) if hasattr(self._data, '__len__') else None
+            self._pulled = 0
+
         logger.debug('Paralleltask - getting count of available workers')
         self._available_workers = self.get_worker().available_workers
         logger.debug('Paralleltask - starting, workers available: %i' % self._available_workers)
@@ -132,13 +199,15 @@ class ParallelTask(Task):
         """
         data, index = self.get_work_unit()
         if not data == None:
+            args = {'batch':data} if self._batched() else {'data':data}
+
             if local:
                 logger.debug('Paralleltask - starting work locally')
-                self.subtask.start({'data':data}, callback=self._work_unit_complete, callback_args={'index':index, 'local':True})
+                self.subtask.start(args, callback=self._work_unit_complete, callback_args={'index':index, 'local':True})
 
             else:
                 logger.debug('Paralleltask - assigning remote work')
-                self.parent.request_worker(self.subtask.get_key(), {'data':data}, index)
+                self.parent.request_worker(self.subtask.get_key(), args, index)
 
         else:
             logger.debug('Paralleltask - no workunits retrieved, idling')
@@ -156,21 +225,97 @@ class ParallelTask(Task):
         data = None
         with self._lock:
 
-            #grab from the beginning of the list
-            if len(self._data):
-                data = self._data.pop(0)
-            else:
+            #grab from the beginning of the queue, then from the source
+            if not self._more():
                 return None, None
+            elif self._batched():
+                data = self._take(self._batch_size())
+            else:
+                data = self._queue.popleft()
 
             self._workunit_count += 1
 
-            #remove from _data and add to in_progress
+            #add to in_progress
             self._data_in_progress[self._workunit_count] = data
         logger.debug('Paralleltask - got a workunit: %s %s' % (data, self._workunit_count))
 
         return data, self._workunit_count;
 
 
+    def load(self, key):
+        """
+        loads data of an item of a datasource
+        """
+        return self._data.load(key)
+
+
+    def _more(self):
+        """
+        whether any items are left, reads one item ahead if needed.  _lock
+        must be held
+        """
+        if self._queue:
+            return True
+
+        if self._items is not None:
+            for item in islice(self._items, 1):
+                self._pulled += 1
+                self._queue.append(item)
+                return True
+
+            self._items = None
+
+        return False
+
+
+    def _take(self, count):
+        """
+        takes up to count items from the queue and the source, _lock must be
+        held
+        """
+        items = []
+        while self._queue and len(items) < count:
+            items.append(self._queue.popleft())
+
+        if self._items is not None and len(items) < count:
+            pulled = list(islice(self._items, count - len(items)))
+            self._pulled += len(pulled)
+            items.extend(pulled)
+
+        return items
+
+
+    def _remaining(self):
+        """
+        number of items left, None if the size of _data is unknown.  _lock
+        must be held
+        """
+        if self._size is None:
+            return None
+
+        return len(self._queue) + self._size - self._pulled
+
+
+    def _batched(self):
+        """
+        whether workunits are sent in batches
+        """
+        return self.guided or self.batch_size != 1
+
+
+    def _batch_size(self):
+        """
+        number of items of the next batch, _lock must be held
+        """
+        remaining = self._remaining()
+
+        if self.guided and remaining is not None:
+            guided = math.ceil(remaining / float(max(self._available_workers, 1)))
+            return max(self.batch_size, int(guided))
+
+        return self.batch_size
+
+
     def _work_unit_complete(self, results, index, local=False):
         """
         A work unit completed.  Handle the common management tasks to remove the data
@@ -179,9 +324,22 @@ class ParallelTask(Task):
         This method *MUST* lock while it is altering the lists of data
         """
         logger.debug('Paralleltask - Work unit completed, local=%s' % local)
+
+        # merging does not need _lock, it must be done before the workunit
+        # is removed from in progress though
+        if self.merge:
+            self._merge_results(results)
+
         with self._lock:
-            # run the task specific post process
-            self.work_unit_complete(self._data_in_progress[index], results)
+            # run the task specific post process, for each item of a batch,
+            # unless the results were merged
+            if self.merge:
+                pass
+            elif self._batched():
+                for data, data_results in zip(self._data_in_progress[index], results):
+                    self.work_unit_complete(data, data_results)
+            else:
+                self.work_unit_complete(self._data_in_progress[index], results)
 
             # remove the workunit from _in_progress
             del self._data_in_progress[index]
@@ -191,7 +349,7 @@ class ParallelTask(Task):
                 self.task_complete(None)
 
             #check for more work
-            if not (len(self._data_in_progress) or len(self._data)):
+            if not (len(self._data_in_progress) or self._more()):
                 #all work is done, call the task specific function to combine the results 
                 logger.debug('Paralleltask - all workunits complete, calling task post process')
                 results = self.work_complete()
@@ -202,7 +360,7 @@ class ParallelTask(Task):
         # workers completing at the same time reaching this call.  _assign_work() 
         # will handle the locking.  It will cause some threads to fail to get work but
         # that is expected.  to lock here would require a reentrant lock which is slower
-        logger.debug('Paralleltask - still has more work: %s :  %s' % (len(self._data), len(self._data_in_progress)))
+        logger.debug('Paralleltask - still has more work: %s :  %s' % (self._remaining(), len(self._data_in_progress)))
         self._assign_work(local)
 
 
@@ -217,5 +375,8 @@ class ParallelTask(Task):
             data = self._data_in_progress[index]
             del self._data_in_progress[index]
 
-            #add data to the end of the list
-            self._data.append(data)
\ No newline at end of file
+            #add data to the end of the queue
+            if self._batched():
+                self._queue.extend(data)
+            else:
+                self._queue.append(data)
\ No newline at end of file
@@ -17,6 +17,9 @@
     along with Pydra.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+from __future__ import with_statement
+from threading import Lock
+
 from pydra_server.cluster.tasks import Task, TaskNotFoundException, STATUS_CANCELLED, STATUS_CANCELLED,\
     STATUS_FAILED,STATUS_STOPPED,STATUS_RUNNING,STATUS_PAUSED,STATUS_COMPLETE
 
@@ -32,11 +35,14 @@ class SubTaskWrapper():
     This class acts as a proxy for all Task methods
 
         percentage - the percentage of work the task accounts for.
+        depends - indexes of subtasks whose results this task needs, None
+                  for the default of the container (see TaskContainer)
     """
-    def __init__(self, task, parent, percentage):
+    def __init__(self, task, parent, percentage, depends=None):
         self.task = task
         self.percentage = percentage
         self.parent = parent
+        self.depends = depends
 
     def get_subtask(self, task_path):
         return self.task.get_subtask(task_path)
@@ -62,6 +68,17 @@ class SubTaskWrapper():
         return self.parent.request_worker(*args, **kwargs)
 
 
+    def _work_unit_complete(self, results, workunit_key):
+        """
+        results of the subtask run by another worker
+        """
+        return self.parent._work_unit_complete(results, workunit_key)
+
+
+    def _worker_failed(self, workunit_key):
+        return self.parent._worker_failed(workunit_key)
+
+
     def _stop(self, *args, **kwargs):
         return self.task._stop(*args, **kwargs)
 
@@ -78,24 +95,57 @@ class TaskContainer(Task):
 
     TaskContainer does no work itself.  Its purpose is to allow a bigger job
     to be broken into discrete functions.  IE.  downloading and processing.
+
+    Subtasks run once the subtasks they depend on are complete, getting
+    their results as args (results of several subtasks are merged).  By
+    default a subtask of a sequential container depends on the previous one
+    and all of them run on this worker.  In a container that is not
+    sequential subtasks depend on nothing unless told otherwise, and the
+    ones that are ready run concurrently on other workers.  Results of the
+    container are the results of the subtasks no other subtask depends on.
     """
     def __init__(self, msg, sequential=True):
         Task.__init__(self, msg)
         self.subtasks = []
         self.sequential = sequential
+        self._lock = Lock()
+
+        self._results = {}      # index -> results of the completed subtasks
+        self._remote = set()    # indexes of the subtasks run by other workers
 
         for task in self.subtasks:
             task.parent = self
 
-    def add_task(self, task, percentage=None):
+    def add_task(self, task, percentage=None, depends=None):
         """
         Adds a task to the container
+
+        depends - subtasks (tasks or their indexes) added before, whose
+                  results the task needs
         """
-        subtask = SubTaskWrapper(task, self, percentage)
+        if depends is not None:
+            depends = [self._index(dependency) for dependency in depends]
+
+        subtask = SubTaskWrapper(task, self, percentage, depends)
         self.subtasks.append(subtask)
         task.parent=subtask
         task.id = '%s-%d' % (self.id,len(self.subtasks))
 
+    def _index(self, task):
+        """
+        index of a subtask given by the task or the index
+        """
+        if isinstance(task, int):
+            if 0 <= task < len(self.subtasks):
+                return task
+
+        else:
+            for index, subtask in enumerate(self.subtasks):
+                if subtask.task is task:
+                    return index
+
+        raise TaskNotFoundException("Task not found: %s" % task)
+
     def reset(self):
         for subtask in self.subtasks:
             subtask.task.reset()
@@ -130,35 +180,152 @@ class TaskContainer(Task):
 
 
     def _work(self, **kwargs):
-        # Starts the task running all subtasks
-        result = kwargs
+        # Starts the task running subtasks that depend on nothing
+        with self._lock:
+            self._args = kwargs
+            self._results = {}
+            self._remote = set()
+            self._started = set()
+            self._running_local = False
+            self._running_remote = 0
+
+        if self.sequential:
+            self._available_workers = 1
+        else:
+            self._available_workers = self.get_worker().available_workers
+
+        if not self.subtasks:
+            self._complete(kwargs)
+            return
 
-        # start first subtask
-        self._current_subtask = 0
-        self._start_subtask(args=kwargs)
+        self._start_subtasks()
 
 
-    def _start_subtask(self, args={}):
+    def dependencies(self, index):
         """
-        Starts a subtask
+        Returns indexes of the subtasks the subtask depends on
         """
-        subtask = self.subtasks[self._current_subtask]
-        logger.debug('TaskContainer - starting subtask: %s' % subtask)
-        subtask.task.start(args=args, callback=self._subtask_complete)
-        logger.debug('TaskContainer - STARTED! subtask: %s' % subtask)
+        depends = self.subtasks[index].depends
+        if depends is None:
+            return [index-1] if self.sequential and index else []
+
+        return depends
 
 
-    def _subtask_complete(self, results):
+    def _merge(self, indexes):
         """
-        Callback when a subtask is complete.  Will either move on
-        to the next subtask or call the callback
+        results of subtasks, merged if there are more of them.  A key may be
+        in results of several subtasks only with the same value (e.g. an arg
+        passed through), other collisions raise ValueError.
         """
-        self._current_subtask += 1
-        if self._current_subtask < len (self.subtasks):
-            self._start_subtask(args=results)
+        if len(indexes) == 1:
+            return self._results[indexes[0]]
+
+        merged = {}
+        owners = {}
+        for index in indexes:
+            if not self._results[index]:
+                continue
+
+            for key, value in self._results[index].iteritems():
+                if key in merged and merged[key] != value:
+                    raise ValueError("results of subtasks %s and %s collide on key %r" \
+                            % (self.subtasks[owners[key]], self.subtasks[index], key))
+                merged[key] = value
+                owners.setdefault(key, index)
+        return merged
+
+
+    def _start_subtasks(self):
+        """
+        Starts the subtasks whose dependencies are complete, as many as
+        there are workers.  The first one runs on this worker.
+        """
+        start = []
+        with self._lock:
+            for index in range(len(self.subtasks)):
+                depends = self.dependencies(index)
+                if index in self._started or \
+                        [i for i in depends if not i in self._results]:
+                    continue
+
+                if not self._running_local:
+                    self._running_local = local = True
+                elif self._running_remote < self._available_workers - 1:
+                    self._running_remote += 1
+                    self._remote.add(index)
+                    local = False
+                else:
+                    break
+
+                args = self._merge(depends) if depends else self._args
+                self._started.add(index)
+                start.append((index, args, local))
+
+        for index, args, local in start:
+            self._start_subtask(index, args, local)
+
+
+    def _start_subtask(self, index, args={}, local=True):
+        """
+        Starts a subtask
+        """
+        subtask = self.subtasks[index]
+        if local:
+            logger.debug('TaskContainer - starting subtask: %s' % subtask)
+            subtask.task.start(args=args, callback=self._subtask_complete,
+                    callback_args={'index':index, 'local':True})
+            logger.debug('TaskContainer - STARTED! subtask: %s' % subtask)
 
         else:
+            logger.debug('TaskContainer - requesting worker for subtask: %s' % subtask)
+            self.parent.request_worker(subtask.task.get_key(), args, index)
+
+
+    def _subtask_complete(self, results, index, local=False):
+        """
+        Callback when a subtask is complete.  Will either start the
+        subtasks depending on it or call the callback
+        """
+        with self._lock:
+            self._results[index] = results
+            if local:
+                self._running_local = False
+            else:
+                self._running_remote -= 1
+                self._remote.discard(index)
+
+            complete = len(self._results) == len(self.subtasks)
+            if complete:
+                depended = set()
+                for i in range(len(self.subtasks)):
+                    depended.update(self.dependencies(i))
+                results = self._merge([i for i in range(len(self.subtasks)) if not i in depended])
+
+        if complete:
             self._complete(results)
+        else:
+            self._start_subtasks()
+
+
+    def _work_unit_complete(self, results, index):
+        """
+        A subtask run by another worker is complete
+        """
+        self._subtask_complete(results, index)
+
+
+    def _worker_failed(self, index):
+        """
+        A worker failed while running a subtask, it is started again
+        """
+        logger.warning('TaskContainer - Worker failure during subtask %s' % index)
+        with self._lock:
+            self._started.discard(index)
+            self._running_remote -= 1
+            self._remote.discard(index)
+
+        self._start_subtasks()
 
 
     def _stop(self):
@@ -171,6 +338,20 @@ class TaskContainer(Task):
 
 
 
+    def _subtask_status(self, index):
+        """
+        Returns the status of a subtask.  The instances of subtasks run by
+        other workers are not used, their status is known only here
+        """
+        if index in self._results:
+            return STATUS_COMPLETE
+
+        if index in self._remote:
+            return STATUS_RUNNING
+
+        return self.subtasks[index].task.status()
+
+
     def progress(self):
         """
         progress - returns the progress as a number 0-100.
@@ -189,16 +370,20 @@ class TaskContainer(Task):
                 auto_subtask_count -= 1
         auto_percentage = auto_total / auto_subtask_count / float(100)
 
-        for subtask in self.subtasks:
+        for index, subtask in enumerate(self.subtasks):
             if subtask.percentage:
                 percentage = subtask.percentage/float(100)
             else:
                 percentage = auto_percentage
 
             # if task is done it complete 100% of its work
-            if subtask.task._status == STATUS_COMPLETE:
+            if self._subtask_status(index) == STATUS_COMPLETE:
                 progress += 100*percentage
 
+            # progress of other workers is not known until they are done
+            elif index in self._remote:
+                continue
+
             # task is only partially complete
             else:
                 progress += subtask.task.progress()*percentage
@@ -232,8 +417,8 @@ class TaskContainer(Task):
         has_unfinished = False
         has_failed = False
 
-        for subtask in self.subtasks:
-            status = subtask.task.status()
+        for index in range(len(self.subtasks)):
+            status = self._subtask_status(index)
             if status == STATUS_RUNNING:
                 # we can return right here because if any child is running the 
                 # container is considered to be running.  This overrides STATUS_FAILED
@@ -152,10 +152,24 @@ class Task(object):
         as soon as work() completes.  For any subclass that distributes
         work the callback cannot be called until after all workunits
         asynchronously return
+
+        A 'batch' arg is a list of data values of several workunits sent
+        at once (see ParallelTask.batch_size), work is called for each of
+        them and the results are returned in a list, or merged if the parent
+        has a merge function.
         """
-        results = self.work(**kwargs)
+        if kwargs.has_key('batch'):
+            results = [self.work(data=data) for data in kwargs['batch']]
+
+            merge = getattr(self.parent, 'merge', None)
+            if merge and results:
+                results = reduce(merge, results)
+        else:
+            results = self.work(**kwargs)
         self._complete(results)
 
+        return results
+
 
     def work(self, **kwargs):
         """
@@ -0,0 +1,55 @@
+"""
+    Benchmark of reading lines of DatasourceDir input files, plain file
+    objects against memory mapped files (use_mmap).
+
+    python benchmark_datasource.py [lines] [split size]
+"""
+from __future__ import with_statement
+
+import os, sys, time, tempfile, shutil
+
+from pydra_server.cluster.tasks.datasource import DatasourceDir, LineFileSlicer
+
+
+def read_lines(source, split_size):
+    """reads all the lines through a LineFileSlicer, returns their count"""
+    slicer = LineFileSlicer(split_size=split_size)
+    slicer.input = source
+
+    count = 0
+    for key in slicer:
+        if split_size:
+            for line in slicer.load(key):
+                count += 1
+        else:
+            slicer.load(key)
+            count += 1
+
+    return count
+
+
+def benchmark(lines=1000000, split_size=16 * 1024 * 1024):
+    tempdir = tempfile.mkdtemp()
+
+    try:
+        with open(os.path.join(tempdir, 'input'), 'w') as f:
+            for i in xrange(lines):
+                f.write('line %d of the benchmark input file\n' % i)
+
+        for mode in ('lines', 'ranges'):
+            for use_mmap in (False, True):
+                source = DatasourceDir(tempdir, use_mmap=use_mmap)
+
+                start = time.time()
+                count = read_lines(source, mode == 'ranges' and split_size)
+                elapsed = time.time() - start
+
+                print '%-6s %-8s %d lines in %.2fs' % \
+                        (mode, use_mmap and 'mmap' or 'readline', count, elapsed)
+
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    benchmark(*[int(arg) for arg in sys.argv[1:]])
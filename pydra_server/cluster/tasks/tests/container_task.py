@@ -23,6 +23,7 @@ from twisted.trial import unittest as twisted_unittest
 from twisted.internet import threads
 
 from pydra_server.cluster.tasks.tasks import *
+from pydra_server.cluster.tasks.task_container import TaskContainer
 from pydra_server.task_cache.demo_task import *
 from proxies import *
 
@@ -413,3 +414,131 @@ class TaskContainer2_Test(unittest.TestCase):
             returned = self.container_task.subtasks[i].task.get_worker()
             self.assert_(returned, 'no worker was returned')
             self.assertEqual(returned, self.worker, 'worker retrieved was not the expected worker')
+
+
+
+class EmitTask(Task):
+    """returns its args plus a value"""
+    def __init__(self, key, value):
+        Task.__init__(self, key)
+        self.key = key
+        self.value = value
+
+    def work(self, **kwargs):
+        results = dict(kwargs)
+        results[self.key] = self.value
+        return results
+
+    def progress(self):
+        return 0
+
+
+class TaskContainerDAG_Test(unittest.TestCase):
+    """
+    Tests for running subtasks of TaskContainer by their dependencies
+    """
+
+    def make_task(self, workers, sequential):
+        self.worker = QueueWorkerProxy(workers)
+        self.results = None
+
+        ctask = TaskContainer('dag', sequential=sequential)
+        ctask.parent = self.worker
+        a, b, c = EmitTask('a', 1), EmitTask('b', 2), EmitTask('c', 3)
+        ctask.add_task(a)
+        ctask.add_task(b, depends=[] if sequential else None)
+        ctask.add_task(c, depends=[a, 1])
+
+        for subtask in ctask.subtasks:
+            self.worker.queue_local(subtask.task)
+
+        return ctask
+
+
+    def callback(self, results):
+        self.results = results
+
+
+    def test_concurrent(self):
+        ctask = self.make_task(3, False)
+        ctask._start({'input':0}, self.callback)
+
+        # independent subtasks run at once, one of them on another worker
+        self.assertEqual(len(self.worker.queue), 2)
+        self.assertEqual(self.worker.queue[1][0], 'TaskContainer.1.EmitTask')
+
+        self.worker.run(ctask)
+        self.assertEqual(self.results, {'input':0, 'a':1, 'b':2, 'c':3})
+
+
+    def test_one_worker(self):
+        ctask = self.make_task(1, False)
+        ctask._start({'input':0}, self.callback)
+
+        self.assertEqual(len(self.worker.queue), 1)
+        self.worker.run(ctask)
+        self.assertEqual(self.results, {'input':0, 'a':1, 'b':2, 'c':3})
+
+
+    def test_sequential(self):
+        # runs locally despite more workers, b does not depend on a
+        ctask = self.make_task(3, True)
+        ctask._start({'input':0}, self.callback)
+
+        self.assertEqual(len(self.worker.queue), 1)
+        self.worker.run(ctask)
+        self.assertEqual(self.results, {'input':0, 'a':1, 'b':2, 'c':3})
+        self.assertEqual(ctask.dependencies(1), [])
+
+
+    def test_worker_failed(self):
+        ctask = self.make_task(3, False)
+        ctask._start({'input':0}, self.callback)
+
+        # remote subtask is started again
+        subtask_key, args, index = self.worker.queue.pop(1)
+        ctask._worker_failed(index)
+        self.assertEqual(self.worker.queue[-1][0], subtask_key)
+
+        self.worker.run(ctask)
+        self.assertEqual(self.results, {'input':0, 'a':1, 'b':2, 'c':3})
+
+
+    def test_remote_status(self):
+        ctask = self.make_task(3, False)
+        ctask._start({'input':0}, self.callback)
+
+        # b runs on another worker, c waits for it
+        subtask_key, args, index = self.worker.queue.pop(1)
+        self.worker.run(ctask)
+        self.assertEqual(ctask.status(), STATUS_RUNNING)
+        self.assertEqual(ctask.progress(), 33)
+
+        ctask._work_unit_complete({'input':0, 'b':2}, index)
+        self.assertEqual(ctask.progress(), 66)
+
+        self.worker.run(ctask)
+        self.assertEqual(ctask.status(), STATUS_COMPLETE)
+        self.assertEqual(self.results, {'input':0, 'a':1, 'b':2, 'c':3})
+
+
+    def test_depends_unknown(self):
+        ctask = TaskContainer('dag')
+        self.assertRaises(TaskNotFoundException, ctask.add_task, EmitTask('a', 1), depends=[0])
+
+
+    def test_merge_collision(self):
+        self.worker = QueueWorkerProxy(1)
+        ctask = TaskContainer('dag', sequential=False)
+        ctask.parent = self.worker
+        a, b, c = EmitTask('a', 1), EmitTask('a', 2), EmitTask('c', 3)
+        ctask.add_task(a)
+        ctask.add_task(b)
+        ctask.add_task(c, depends=[a, b])
+        for subtask in ctask.subtasks:
+            self.worker.queue_local(subtask.task)
+
+        # 'input' is passed through both, 'a' has different values
+        ctask._start({'input':0}, self.callback)
+        self.assertRaises(ValueError, self.worker.run, ctask)
+        self.failIf(2 in ctask._started)
@@ -3,7 +3,13 @@ from __future__ import with_statement
 import unittest
 
 from pydra_server.cluster.tasks.datasource import *
-import tempfile, shutil
+import tempfile, shutil, gzip, bz2, threading
+import BaseHTTPServer, SimpleHTTPServer, urllib2
+from twisted.trial import unittest as twisted_unittest
+from twisted.internet import threads
+
+from pydra_server.cluster.shuffle import get_shuffle_service
+from pydra_server.cluster.tasks.mapreduce import IntermediateResultsFiles
 
 in_dict = { 
             "k1": ['one', 'two', 'four', 'two', 'four', 'seven'],
@@ -137,3 +143,623 @@ class DatasourceDir_Test(unittest.TestCase):
                         "failed on key %s: %s == %s" % (str(key), str(val), str(expected)) )
 
 
+
+    def test_lineslicer_ranges(self):
+        expected = {}
+        for key in self.source:
+            with self.source.load(key) as f:
+                expected[key] = [line.strip() for line in f]
+
+        for split_size in (1, 4, 7, 1000):
+            slicer = LineFileSlicer(split_size=split_size)
+            slicer.input = self.source
+
+            lines = {}
+            for key in slicer:
+                self.assertEqual(len(key), 3)
+                self.assert_(0 < slicer.size(key) <= split_size)
+                lines.setdefault(key[:-2], []).extend(slicer.load(key))
+
+            self.assertEqual(lines, expected)
+
+
+    def test_lineslicer_size(self):
+        slicer = LineFileSlicer()
+        slicer.input = self.source
+
+        for key in slicer:
+            self.assertEqual(slicer.size(key), None)
+
+
+    def test_mmap(self):
+        mapped = DatasourceDir(self.tempdir, use_mmap=True)
+
+        for split_size in (None, 5):
+            expected = []
+            lines = []
+
+            for source, result in ((self.source, expected), (mapped, lines)):
+                slicer = LineFileSlicer(split_size=split_size)
+                slicer.input = source
+
+                for key in slicer:
+                    if split_size:
+                        result.extend(slicer.load(key))
+                    else:
+                        result.append(slicer.load(key))
+
+            self.assertEqual(lines, expected)
+
+        with open(os.path.join(self.tempdir, 'empty'), 'w'):
+            pass
+
+        with mapped.load(('empty',)) as f:
+            self.assertEqual(f.read(), '')
+            self.assertEqual(list(f), [])
+
+        mapped.close()
+
+
+    def test_mmap_rewritten(self):
+        mapped = DatasourceDir(self.tempdir, use_mmap=True)
+        path = os.path.join(self.tempdir, 'rewritten')
+
+        for text in ('first\n', 'second file\n'):
+            with open(path, 'w') as f:
+                f.write(text)
+
+            with mapped.load(('rewritten',)) as f:
+                self.assertEqual(f.read(), text)
+
+            # mapping is released with the reader
+            self.assertEqual(f.map, None)
+
+
+class CompressedInput_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.lines = ['line %d' % i for i in range(100)]
+        text = ''.join('%s\n' % line for line in self.lines)
+
+        with open(os.path.join(self.tempdir, 'plain'), 'w') as f:
+            f.write(text)
+
+        f = gzip.GzipFile(os.path.join(self.tempdir, 'input.gz'), 'wb')
+        f.write(text)
+        f.close()
+
+        f = bz2.BZ2File(os.path.join(self.tempdir, 'input.bz2'), 'wb')
+        f.write(text)
+        f.close()
+
+        with open(os.path.join(self.tempdir, 'input.pblk'), 'wb') as f:
+            write_line_blocks(f, self.lines, block_lines=10)
+
+        self.source = DatasourceDir(self.tempdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+
+    def test_compression(self):
+        expected = {
+                'plain': None,
+                'input.gz': 'gzip',
+                'input.bz2': 'bz2',
+                'input.pblk': 'block',
+            }
+
+        for key in self.source:
+            self.assertEqual(self.source.compression(key), expected[key[-1]])
+
+            with self.source.load(key) as f:
+                self.assertEqual([line.strip() for line in f], self.lines)
+
+
+    def test_compression_not_sniffed(self):
+        # plain text starting with magic bytes, or with a wrong extension
+        text = 'BZh is not bz2\n'
+        for filename in ('BZh', 'text.gz'):
+            with open(os.path.join(self.tempdir, filename), 'w') as f:
+                f.write(text)
+
+            self.assertEqual(self.source.compression((filename, )), None)
+
+            for split_size in (None, 100):
+                slicer = LineFileSlicer(split_size=split_size)
+                slicer.input = self.source
+
+                lines = []
+                for key in slicer:
+                    if key[0] == filename:
+                        if split_size:
+                            lines.extend(slicer.load(key))
+                        else:
+                            lines.append(slicer.load(key))
+
+                self.assertEqual(lines, [text.strip()])
+
+
+    def test_lines(self):
+        # line keys of compressed files, seeking in decompressed streams
+        slicer = LineFileSlicer()
+        slicer.input = self.source
+
+        lines = {}
+        for key in slicer:
+            lines.setdefault(key[0], []).append(slicer.load(key))
+
+        self.assertEqual(sorted(lines), ['input.bz2', 'input.gz', 'input.pblk', 'plain'])
+        for filename in lines:
+            self.assertEqual(lines[filename], self.lines)
+
+
+    def test_compression_cache(self):
+        self.source.compression_cache = 2
+
+        for key in self.source:
+            self.source.compression(key)
+            self.assert_(len(self.source._compression) <= 2)
+
+
+    def test_splits(self):
+        slicer = LineFileSlicer(split_size=200)
+        slicer.input = self.source
+
+        lines = {}
+        ranges = {}
+
+        for key in slicer:
+            lines.setdefault(key[0], []).extend(slicer.load(key))
+            ranges[key[0]] = ranges.get(key[0], 0) + 1
+
+        for filename in lines:
+            self.assertEqual(lines[filename], self.lines)
+
+        # compressed files are not splittable, block files are
+        self.assertEqual(ranges['input.gz'], 1)
+        self.assertEqual(ranges['input.bz2'], 1)
+        self.assert_(ranges['input.pblk'] > 1)
+        self.assert_(ranges['plain'] > 1)
+
+
+class FakeCursor(object):
+    """MySQLdb cursor stand-in, results of queries are taken from
+    FakeConnection.results in order"""
+
+    def __init__(self, conn, cursorclass=None):
+        self.conn = conn
+        self.cursorclass = cursorclass
+        self.rows = []
+
+    def execute(self, sql, args=None):
+        FakeConnection.executed.append((sql, args))
+        FakeConnection.cursorclasses.append(self.cursorclass)
+        if FakeConnection.results:
+            self.rows = list(FakeConnection.results.pop(0))
+
+    def executemany(self, sql, rows):
+        FakeConnection.executed.append((sql, list(rows)))
+
+    def fetchone(self):
+        rows = self.fetchmany(1)
+        return rows[0] if rows else None
+
+    def fetchmany(self, size=1):
+        FakeConnection.fetches.append(size)
+        rows = self.rows[:size]
+        del self.rows[:size]
+        return rows
+
+    def fetchall(self):
+        return self.fetchmany(len(self.rows))
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    """MySQLdb connection stand-in for ConnectionPool and SQL tests"""
+
+    executed = []       # (sql, args) of all the connections
+    results = []        # rows returned by the following queries
+    cursorclasses = []  # cursor class of every executed query
+    fetches = []        # sizes of fetchmany() calls
+
+    def __init__(self, **kwargs):
+        self.broken = False
+        self.closed = False
+        self.commits = 0
+        self.rollbacks = 0
+
+    def ping(self):
+        if self.broken:
+            raise MySQLdb.OperationalError('gone away')
+
+    def cursor(self, cursorclass=None):
+        return FakeCursor(self, cursorclass)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPool_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.connect = MySQLdb.connect
+        MySQLdb.connect = FakeConnection
+
+    def tearDown(self):
+        MySQLdb.connect = self.connect
+
+
+    def test_reuse(self):
+        pool = ConnectionPool({}, 2)
+
+        a = pool.acquire()
+        b = pool.acquire()
+        self.assert_(a is not b)
+
+        pool.release(a)
+        self.assert_(pool.acquire() is a)
+
+
+    def test_broken_connection(self):
+        pool = ConnectionPool({}, 1)
+        pool.ping_interval = 0
+
+        a = pool.acquire()
+        a.broken = True
+        pool.release(a)
+
+        b = pool.acquire()
+        self.assert_(b is not a)
+        self.assert_(a.closed)
+
+
+    def test_timeout(self):
+        pool = ConnectionPool({}, 1)
+        pool.timeout = 0.01
+
+        a = pool.acquire()
+        self.assertRaises(MySQLdb.OperationalError, pool.acquire)
+
+        pool.release(a)
+        self.assert_(pool.acquire() is a)
+
+
+    def test_cursor_failed(self):
+        pool = ConnectionPool({}, 1)
+        conn = pool.acquire()
+
+        def cursor(cursorclass=None):
+            raise MySQLdb.OperationalError('gone away')
+        conn.cursor = cursor
+
+        # the connection is returned to the pool
+        self.assertRaises(MySQLdb.OperationalError, PooledCursor, pool, conn)
+        self.assert_(pool.acquire() is conn)
+
+
+    def test_shared_pool(self):
+        a = DatasourceSQL(db='test')
+        b = DatasourceSQL(db='test')
+        a.connect()
+        b.connect()
+        self.assert_(a.pool is b.pool)
+
+        with a.connection() as conn:
+            self.assert_(isinstance(conn, FakeConnection))
+
+
+class SQLTable_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.connect = MySQLdb.connect
+        MySQLdb.connect = FakeConnection
+        FakeConnection.executed = []
+        FakeConnection.results = []
+        FakeConnection.cursorclasses = []
+        FakeConnection.fetches = []
+
+        self.db = DatasourceSQL(db='test_sqltable')
+        self.db.connect()
+
+    def tearDown(self):
+        MySQLdb.connect = self.connect
+
+
+    def test_key_input(self):
+        input = SQLTableKeyInput(db=self.db, table='i9e')
+        FakeConnection.results = [[('a', '1'), ('a', '2'), ('b', '3')]]
+
+        # partitions are read when the iterator is created
+        input.input = ['p1', 'p2']
+        rows = iter(input)
+        input.input = ['p3']
+
+        self.assertEqual(list(rows), [('a', ('1', )), ('a', ('2', )), ('b', ('3', ))])
+        sql, args = FakeConnection.executed[-1]
+        self.assertEqual(args, ['p1', 'p2'])
+        self.assert_('ORDER BY k' in sql)
+
+
+    def test_key_input_empty(self):
+        input = SQLTableKeyInput(db=self.db, table='i9e')
+        input.input = []
+
+        self.assertEqual(list(input), [])
+        self.assertEqual(FakeConnection.executed, [])
+
+
+    def test_output_dump(self):
+        output = SQLTableOutput(db=self.db, table='i9e')
+        self.assertEqual(output.dump('p1', [('a', [1, 2]), ('b', 3)]), 'p1')
+
+        create, insert = FakeConnection.executed
+        self.assert_('`partition` VARCHAR' in create[0])
+        self.assert_('INDEX (`partition`, k)' in create[0])
+        self.assertEqual(insert, ('INSERT INTO i9e (`partition`, k, v) VALUES (%s, %s, %s)',
+                [('p1', 'a', '1'), ('p1', 'a', '2'), ('p1', 'b', '3')]))
+
+        # the table is created once
+        output.dump('p2', [('c', [4])])
+        self.assertEqual(len(FakeConnection.executed), 3)
+
+
+    def test_output_batches(self):
+        output = SQLTableOutput(db=self.db, table='i9e', batch_size=2)
+        output._created = True
+        self.db.pool = ConnectionPool({}, 1)
+
+        output.dump('p1', [('a', [1, 2, 3]), ('b', [4]), ('c', [5])])
+
+        batches = [rows for sql, rows in FakeConnection.executed]
+        self.assertEqual(batches, [
+                [('p1', 'a', '1'), ('p1', 'a', '2'), ('p1', 'a', '3')],
+                [('p1', 'b', '4'), ('p1', 'c', '5')],
+            ])
+
+        # one transaction per dump
+        conn = self.db.pool.acquire()
+        self.assertEqual(conn.commits, 1)
+
+
+    def test_output_rollback(self):
+        output = SQLTableOutput(db=self.db, table='i9e', batch_size=2)
+        output._created = True
+        self.db.pool = ConnectionPool({}, 1)
+
+        def tuples():
+            yield 'a', [1, 2]
+            raise ValueError('map failed')
+
+        self.assertRaises(ValueError, output.dump, 'p1', tuples())
+
+        conn = self.db.pool.acquire()
+        self.assertEqual(conn.commits, 0)
+        self.assert_(conn.rollbacks > 0)
+
+
+    def test_partition_quoted(self):
+        output = SQLTableOutput(db=self.db, table='i9e')
+        output.remove('p1')
+        output.remove_prefix('mapreduce-i9e-1-')
+
+        input = SQLTableKeyInput(db=self.db, table='i9e')
+        input.input = ['p1']
+        list(input)
+
+        for sql, args in FakeConnection.executed:
+            self.assert_('`partition`' in sql, sql)
+
+
+    def test_slicer_ranges(self):
+        slicer = SQLTableSlicer(table='rows', range_size=10)
+        slicer.input = self.db
+        FakeConnection.results = [[(3, 25)]]
+
+        keys = list(slicer)
+        self.assertEqual(keys, [('_mysql', 3, 13), ('_mysql', 13, 23),
+                ('_mysql', 23, 33)])
+        self.assertEqual([slicer.size(key) for key in keys], [10, 10, 10])
+        self.assertEqual(FakeConnection.executed[-1][0],
+                'SELECT MIN(id), MAX(id) FROM rows')
+
+
+    def test_slicer_empty_table(self):
+        slicer = SQLTableSlicer(table='rows', range_size=10)
+        slicer.input = self.db
+        FakeConnection.results = [[(None, None)]]
+
+        self.assertEqual(list(slicer), [])
+
+
+    def test_slicer_streams_range(self):
+        slicer = SQLTableSlicer(table='rows', range_size=10)
+        slicer.fetch_size = 2
+        slicer.input = self.db
+        rows = [(i, 'row %d' % i) for i in range(13, 18)]
+        FakeConnection.results = [rows]
+
+        self.assertEqual(list(slicer.load(('_mysql', 13, 23))), rows)
+
+        sql, args = FakeConnection.executed[-1]
+        self.assertEqual(sql, 'SELECT * FROM rows WHERE id >= %s AND id < %s')
+        self.assertEqual(args, (13, 23))
+        self.assertEqual(FakeConnection.cursorclasses, [MySQLdb.cursors.SSCursor])
+        self.assertEqual(FakeConnection.fetches, [2, 2, 2, 2])
+
+
+    def test_slicer_id_keys(self):
+        slicer = SQLTableSlicer(table='rows')
+        slicer.input = self.db
+        FakeConnection.results = [[(1, ), (2, )]]
+
+        keys = list(slicer)
+        self.assertEqual(keys, [('_mysql', 1), ('_mysql', 2)])
+        self.assertEqual([slicer.size(key) for key in keys], [None, None])
+
+
+class DatasourceShuffle_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.remote_dir = tempfile.mkdtemp()
+
+        remote_dir = self.remote_dir
+        class Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+            def translate_path(self, path):
+                return os.path.join(remote_dir, path.lstrip('/'))
+            def log_message(self, *args):
+                pass
+
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+        self.remote = DatasourceShuffle(self.remote_dir, self.server.server_port,
+                                        host='127.0.0.1')
+        self.local = DatasourceShuffle(self.tempdir, self.server.server_port,
+                                        host='localnode')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        shutil.rmtree(self.tempdir)
+        shutil.rmtree(self.remote_dir)
+
+
+    def test_location(self):
+        output = FileBlockOutput(self.remote, compression='zlib')
+        location = output.dump('file', [('a', [1]), ('b', [2, 3])])
+
+        self.assertEqual(location, 'http://127.0.0.1:%d/file' % self.server.server_port)
+
+        # read from the directory on its node, over HTTP on other nodes
+        for reader in (self.remote, self.local):
+            subslicer = FileBlockSubslicer(dir=reader)
+            subslicer.input = [location]
+            self.assertEqual(list(subslicer), [('a', [1]), ('b', [2, 3])])
+
+        self.assertEqual(self.local.size((location, )), self.remote.size((location, )))
+
+        output.remove(location)
+        self.assertEqual(os.listdir(self.remote_dir), [])
+
+
+class ShuffleService_Test(twisted_unittest.TestCase):
+    """
+    DatasourceShuffle reading from the shuffle server of a node
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.remote_dir = tempfile.mkdtemp()
+
+        self.service = get_shuffle_service(self.remote_dir, 0)
+        self.service.startService()
+        port = self.service._port.getHost().port
+
+        self.remote = DatasourceShuffle(self.remote_dir, port, host='127.0.0.1')
+        self.local = DatasourceShuffle(self.tempdir, port, host='localnode')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        shutil.rmtree(self.remote_dir)
+        return self.service.stopService()
+
+
+    def verify_pickle(self):
+        output = FilePickleOutput(self.remote)
+        location = output.dump('mapreduce-i9e-1-0-map0', [('a', [1]), ('b', [2, 3])])
+
+        for reader in (self.remote, self.local):
+            subslicer = FileUnpicleSubslicer(dir=reader)
+            subslicer.input = [location]
+            self.assertEqual(list(subslicer), [('a', [1]), ('b', [2, 3])])
+
+        # other nodes remove files over HTTP
+        self.local.remove((location, ))
+        self.assertEqual(os.listdir(self.remote_dir), [])
+
+
+    def verify_clear(self):
+        # files of a task are removed from the nodes which wrote them
+        im = IntermediateResultsFiles(self.local)
+        im.task_id = '1'
+
+        output = FilePickleOutput(self.remote)
+        location = output.dump('mapreduce-i9e-1-0-map0', [('a', [1])])
+        im.update_partitions({0: (location, 1, 10)})
+
+        im.clear()
+        self.assertEqual(os.listdir(self.remote_dir), [])
+
+
+    def verify_delete_refused(self):
+        open(os.path.join(self.remote_dir, 'input'), 'w').close()
+
+        self.assertRaises(urllib2.HTTPError, self.local.remove,
+                (self.remote.location('input'), ))
+        self.assertRaises(urllib2.HTTPError, self.local.remove,
+                (self.remote.location('mapreduce-i9e-missing'), ))
+        self.assertEqual(os.listdir(self.remote_dir), ['input'])
+
+
+    def test_pickle(self):
+        return threads.deferToThread(self.verify_pickle)
+
+
+    def test_clear(self):
+        return threads.deferToThread(self.verify_clear)
+
+
+    def test_delete_refused(self):
+        return threads.deferToThread(self.verify_delete_refused)
+
+
+class BlockFormat_Test(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+
+    def test_blocks(self):
+        blocks = [ [('a', [1, 2]), ('b', [3])], [('c', range(100))], [] ]
+
+        for compression in (None, 'zlib', 'bz2'):
+            with open(self.path, "wb") as f:
+                for block in blocks:
+                    write_block(f, block, compression)
+
+            with open(self.path, "rb") as f:
+                for block in blocks:
+                    self.assertEqual(read_block(f), block)
+
+                self.assertEqual(read_block(f), None)
+
+
+    def test_corrupted_block(self):
+        with open(self.path, "wb") as f:
+            write_block(f, [('a', [1, 2])], 'zlib')
+
+        with open(self.path, "r+b") as f:
+            f.seek(-1, os.SEEK_END)
+            byte = f.read(1)
+            f.seek(-1, os.SEEK_END)
+            f.write(chr(ord(byte) ^ 0xff))
+
+        with open(self.path, "rb") as f:
+            self.assertRaises(IOError, read_block, f)
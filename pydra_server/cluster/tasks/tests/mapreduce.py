@@ -1,9 +1,12 @@
 import unittest
 
-import tempfile, shutil
+import os, sys, tempfile, shutil
+
+from twisted.python.failure import Failure
 
 from pydra_server.cluster.tasks.mapreduce import *
 from pydra_server.cluster.tasks.tasks import Task
+from pydra_server.cluster.tasks.datasource import DatasourceStriped
 from pydra_server.task_cache.mapreduce import *
 from proxies import *
 
@@ -25,6 +28,30 @@ class AppendableDict_Test(unittest.TestCase):
         self.assert_(3 not in a['key'])
 
 
+class MapOutputBuffer_Test(unittest.TestCase):
+
+    def test_estimate_size(self):
+        self.assertEqual(estimate_size('x'*1000), sys.getsizeof('x'*1000))
+
+        # items of containers are counted
+        value = ('key', ['x'*1000, 'y'*1000], {'z': 'z'*1000})
+        self.assert_(estimate_size(value) > 3000)
+        self.assert_(estimate_size(value) > sys.getsizeof(value))
+
+
+    def test_max_bytes(self):
+        spilled = []
+        buffer = MapOutputBuffer(lambda b: spilled.append(dict(b)), max_bytes=3000)
+
+        buffer['a'] = 'x'*1000
+        buffer['b'] = 'y'*1000
+        self.assertEqual(spilled, [])
+
+        buffer['a'] = 'z'*1000
+        self.assertEqual(spilled, [{'a': ['x'*1000, 'z'*1000], 'b': ['y'*1000]}])
+        self.assertEqual((len(buffer), buffer.records, buffer.bytes), (0, 0, 0))
+
+
 class IntermediateResultsFiles_Test(unittest.TestCase):
 
     def setUp(self):
@@ -37,7 +64,7 @@ class IntermediateResultsFiles_Test(unittest.TestCase):
 
     def test_partition(self):
 
-        a = { 'a': 1, 'b': 1, }
+        a = { 'a': [1], 'b': [1], }
 
         im1 = IntermediateResultsFiles(self.dir) 
         im1.task_id = self.task_name
@@ -46,7 +73,7 @@ class IntermediateResultsFiles_Test(unittest.TestCase):
         pdict = im1.partition_output(a)
         p1 = im1.dump(pdict, 'map1')
 
-        b = { 'b': 1, 'c': 1, }
+        b = { 'b': [1], 'c': [1], }
 
         im2 = IntermediateResultsFiles(self.dir) 
         im2.task_id = self.task_name
@@ -66,14 +93,127 @@ class IntermediateResultsFiles_Test(unittest.TestCase):
         # reduce
         c = { 'a': 0, 'b': 0, 'c': 0 }
         for p in im:
-            for k, v in im.load(p):
-                c[k] += 1
+            for k, vs in im.load(p):
+                c[k] += len(list(vs))
 
         self.assertEqual(c['a'], 1)
         self.assertEqual(c['b'], 2)
         self.assertEqual(c['c'], 1)
 
 
+    def test_sort_merge(self):
+        self._test_sort_merge(IntermediateResultsFiles(self.dir))
+
+
+    def test_sort_merge_passes(self):
+        for format in ('pickle', 'block'):
+            im = IntermediateResultsFiles(self.dir, format=format)
+            im.task_id = '%s_%s' % (self.task_name, format)
+            im.merge_factor = 2
+
+            self._test_sort_merge(im)
+
+            # only files of the map tasks are left
+            files = [f for f in os.listdir(self.tempdir) if f.startswith(im.prefix())]
+            self.assertEqual(len(files), 3)
+            self.failIf([f for f in files if 'pass' in f])
+
+
+    def test_sort_merge_block_format(self):
+        for compression in (None, 'zlib', 'bz2'):
+            im = IntermediateResultsFiles(self.dir, format='block',
+                    compression=compression, block_records=2)
+            im.task_id = '%s_%s' % (self.task_name, compression)
+
+            self._test_sort_merge(im)
+
+
+    def _test_sort_merge(self, im):
+
+        maps = [
+                { 'd': [1], 'a': [1, 1], 'c': [1], },
+                { 'c': [1, 1], 'b': [1], },
+                { 'a': [1], 'e': [1], 'b': [1, 1, 1], },
+               ]
+
+        im.reducers = 1
+
+        for i, output in enumerate(maps):
+            im.update_partitions(im.dump(im.partition_output(output), 'map%d' % i))
+
+        for p in im:
+            keys = []
+            counts = {}
+
+            for k, vs in im.load(p):
+                keys.append(k)
+                counts[k] = sum(vs)
+
+        # every key comes once, in sorted order, with all its values
+        self.assertEqual(keys, ['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual(counts, { 'a': 3, 'b': 4, 'c': 3, 'd': 1, 'e': 1 })
+
+
+class Partitioner_Test(unittest.TestCase):
+
+    def test_hash_partitioner(self):
+        partitioner = HashPartitioner()
+
+        for key in ('a', 1, ('a', 1), ['a', 1]):
+            p = partitioner.partition(key, 3)
+            self.assert_(0 <= p < 3)
+            self.assertEqual(p, partitioner.partition(key, 3))
+
+
+    def test_hash_partitioner_objects(self):
+        class Key(object):
+            def __repr__(self):
+                return 'key'
+
+        # equal keys with hash() of their address
+        partitioner = HashPartitioner()
+        partitions = set(partitioner.partition(Key(), 1000) for i in range(10))
+        self.assertEqual(len(partitions), 1)
+
+
+    def test_range_partitioner_sample(self):
+        class Input(object):
+            read = 0
+            def __iter__(self):
+                for i in xrange(10000):
+                    self.read += 1
+                    yield i,
+            def load(self, key):
+                return [key[0]]
+
+        class Map(object):
+            def _work(self, input, output):
+                for i in input:
+                    output[i] = 1
+
+        task = type('Task', (object, ), {})()
+        task.input = Input()
+        task.maptask = type('MapWrapper', (object, ), {})()
+        task.maptask.task = Map()
+        task.reducers = 2
+
+        partitioner = RangePartitioner(input_samples=5, input_prefix=100)
+        partitioner.sample(task)
+
+        # only a prefix of the input is read
+        self.assertEqual(task.input.read, 100)
+        self.assertEqual(len(partitioner.splits), 1)
+        self.assert_(partitioner.splits[0] < 100)
+
+
+    def test_range_partitioner(self):
+        partitioner = RangePartitioner()
+        partitioner.set_state(['c', 'f'])
+
+        partitions = [partitioner.partition(k, 3) for k in 'abcdefgh']
+        self.assertEqual(partitions, [0, 0, 1, 1, 1, 2, 2, 2])
+
+
 class MapReduceTask_Test(unittest.TestCase):
     """
     Tests for verify functionality of MapReduceTask class
@@ -176,6 +316,333 @@ class MapReduceTask_Test(unittest.TestCase):
         self.assertEqual(returned, self.worker, 'worker retrieved was not the expected worker')
 
 
+in_dict = {
+            "k1": ['one', 'two', 'four', 'two', 'four', 'seven'],
+            "k2": ['seven', 'four', 'seven', 'seven'],
+            "k3": ['seven', 'four', 'seven', 'seven'],
+          }
+
+word_counts = { 'one': 1, 'two': 2, 'four': 4, 'seven': 7 }
+
+
+class MapReduceTaskRun_Test(unittest.TestCase):
+    """
+    Runs a whole map-reduce task in sequential mode
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+        self.worker = WorkerProxy()
+        self.worker.available_workers = 1
+
+        self.results = None
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+
+    def make_task(self, **kwargs):
+        attrs = {
+                'input': DatasourceDict(in_dict),
+                'output': {},
+                'map': MapWords,
+                'reduce': ReduceWords,
+                'intermediate': IntermediateResultsFiles(DatasourceDir(self.tempdir)),
+                'reducers': 2,
+                'sequential': True,
+                }
+        attrs.update(kwargs)
+
+        task = type('TestCountWords', (MapReduceTask, ), attrs)('test_count_words')
+        task.parent = self.worker
+
+        return task
+
+
+    def callback(self, results):
+        self.results = results
+
+
+    def test_run(self):
+        task = self.make_task()
+        task._start(args={}, callback=self.callback)
+
+        self.assertEqual(self.results, word_counts)
+        self.assertEqual(task.map_tasks, {})
+        self.assertEqual(task.reduce_tasks, {})
+
+        # intermediate files are removed at the end
+        self.assertEqual(os.listdir(self.tempdir), [])
+
+        # and they are not checked for compression
+        self.assertEqual(task.im.dir._compression, {})
+
+
+    def test_striped(self):
+        dirs = [os.path.join(self.tempdir, d) for d in ('a', 'b')]
+        for dir in dirs:
+            os.mkdir(dir)
+
+        task = self.make_task(reducers=4,
+                intermediate=IntermediateResultsFiles(DatasourceStriped(dirs)))
+        task.im.cleanup = False
+        task._start(args={}, callback=self.callback)
+
+        self.assertEqual(self.results, word_counts)
+
+        # files of the task are spread over both directories
+        self.assert_(all(os.listdir(dir) for dir in dirs))
+        self.assert_(task.im.usage() > 0)
+
+        task.im.cleanup = True
+        task.im.clear()
+        self.assertEqual([os.listdir(dir) for dir in dirs], [[], []])
+
+
+    def test_no_space(self):
+        dir = DatasourceDir(self.tempdir, min_free=1<<60)
+        task = self.make_task(intermediate=IntermediateResultsFiles(dir))
+
+        self.assertRaises(IOError, task._start, args={}, callback=self.callback)
+        self.assertEqual(self.results, None)
+
+
+    def test_reduce_slowstart(self):
+        task = self.make_task(sequential=False, reduce_slowstart=0.0, reducers=1)
+        task.im.cleanup = False
+
+        worker = QueueWorkerProxy(3)
+        task.parent = worker
+        worker.queue_local(task.maptask)
+        worker.queue_local(task.reducetask)
+
+        task._start(args={}, callback=self.callback)
+        worker.run(task)
+
+        self.assertEqual(self.results, word_counts)
+
+        # outputs of the first two maps were merged while the last was running
+        merged = [f for f in os.listdir(self.tempdir) if '-merge' in f]
+        self.assertEqual(len(merged), 1)
+        self.assertEqual(len(os.listdir(self.tempdir)), 2)
+
+
+    def test_speculative_execution(self):
+        task = self.make_task(sequential=False, reducers=1,
+                speculative_execution=True, speculative_threshold=0.5)
+        task.im.cleanup = False
+
+        worker = QueueWorkerProxy(2)
+        task.parent = worker
+        worker.queue_local(task.maptask)
+        worker.queue_local(task.reducetask)
+
+        task._start(args={}, callback=self.callback)
+
+        # map0 is a straggler, it completes after its backup
+        straggler = [u for u in worker.queue if u[1].get('id') == 'map0'][0]
+        worker.queue.remove(straggler)
+        task.map_tasks['map0'] -= 60
+
+        worker.run(task)
+        self.assertEqual(self.results, word_counts)
+        self.assertEqual(task.map_tasks, {})
+
+        worker.queue.append(straggler)
+        worker.run(task)
+        self.assertEqual(task._lost_attempts, {})
+
+        # files of the lost attempt are discarded
+        files = os.listdir(self.tempdir)
+        self.assertEqual(len(files), 3)
+        self.failIf([f for f in files if f.endswith('-map0')])
+        self.assertEqual(len([f for f in files if f.endswith('-map0-backup')]), 1)
+
+
+    def test_work_args_unchanged(self):
+        task = self.make_task(sequential=False, reducers=1, speculative_execution=True,
+                partitioner=RangePartitioner())
+
+        worker = QueueWorkerProxy(1)
+        task.parent = worker
+        worker.queue_local(task.maptask)
+        worker.queue_local(task.reducetask)
+
+        task._start(args={}, callback=self.callback)
+
+        # a local map does not change args kept for its backup
+        subtask, args, callback = worker.queue[0]
+        self.assert_(task._work_args[args['id']] is not args)
+        expected = dict(args)
+
+        worker.run(task)
+        self.assertEqual(self.results, word_counts)
+        self.assertEqual(args, expected)
+        self.assert_('partitioner' in args)
+
+
+    def test_run_prefix(self):
+        task = self.make_task(sequential=False, reducers=1)
+        task.im.cleanup = False
+
+        worker = QueueWorkerProxy(2)
+        task.parent = worker
+        worker.queue_local(task.maptask)
+        worker.queue_local(task.reducetask)
+
+        task._start(args={}, callback=self.callback)
+
+        # every job run has its own prefix, sent with the work units
+        run = task.im.task_id
+        self.assertNotEqual(run, 'test_count_words')
+        self.assert_(all(u[1]['run'] == run for u in worker.queue))
+
+        worker.run(task)
+        self.assertEqual(self.results, word_counts)
+        self.assert_(all(f.startswith(task.im.prefix()) for f in os.listdir(self.tempdir)))
+
+        task._start(args={}, callback=self.callback)
+        self.assertNotEqual(task.im.task_id, run)
+
+
+    def test_work_unit_failed(self):
+        task = self.make_task(sequential=False, reducers=1)
+
+        worker = QueueWorkerProxy(2)
+        task.parent = worker
+        worker.queue_local(task.maptask)
+        worker.queue_local(task.reducetask)
+
+        task._start(args={}, callback=self.callback)
+        self.assertEqual(len(worker.queue), 2)
+
+        failure = Failure(Exception('map failed'))
+        task._work_unit_failed(failure)
+
+        # running work units complete, no more are started
+        worker.run(task)
+
+        self.assertEqual(worker.failures, [failure])
+        self.assertEqual(task.status(), STATUS_FAILED)
+        self.assertEqual(self.results, None)
+        self.assertEqual(task._maps_started, 2)
+        self.assertEqual(os.listdir(self.tempdir), [])
+
+
+    def test_range_partitioner(self):
+        task = self.make_task(partitioner=RangePartitioner(), reducers=3)
+        task._start(args={}, callback=self.callback)
+
+        # split points are kept by the task instance
+        self.assert_(task.partitioner is not type(task).partitioner)
+        self.assertEqual(type(task).partitioner.splits, [])
+
+        self.assertEqual(self.results, word_counts)
+
+        # sorted keys go to the partitions in order
+        partitions = [task.im.partition(k) for k in sorted(word_counts)]
+        self.assertEqual(partitions, sorted(partitions))
+        self.assertEqual(len(task.partitioner.splits), 2)
+        self.assert_(len(set(partitions)) > 1)
+
+
+    def test_skew(self):
+        partitioner = WordPartitioner(['seven', 'one', 'two', 'four'])
+        task = self.make_task(partitioner=partitioner, reducers=4, skew_factor=1.2)
+        task.im.cleanup = False
+        task._start(args={}, callback=self.callback)
+
+        self.assertEqual(self.results, word_counts)
+        self.assertEqual(task.split_tasks, {})
+
+        # 'seven' partition is split into two reduce tasks
+        splits = [f for f in os.listdir(self.tempdir) if '-split' in f]
+        self.assertEqual(len(splits), 2)
+        self.assert_(all('-0-reduce0-split' in f for f in splits))
+
+
+    def test_skew_slowstart(self):
+        # the last of the partitions with the most files is merged
+        partitioner = WordPartitioner(['one', 'two', 'four', 'seven'])
+        task = self.make_task(partitioner=partitioner, reducers=4, skew_factor=1.2,
+                sequential=False, reduce_slowstart=0.0)
+        task.im.cleanup = False
+
+        worker = QueueWorkerProxy(3)
+        task.parent = worker
+        worker.queue_local(task.maptask)
+        worker.queue_local(task.reducetask)
+
+        task._start(args={}, callback=self.callback)
+        worker.run(task)
+
+        self.assertEqual(self.results, word_counts)
+
+        # files of the hot partition are not merged, they are split
+        files = os.listdir(self.tempdir)
+        self.failIf([f for f in files if '-3-merge' in f])
+        self.assertEqual(len([f for f in files if '-3-reduce3-split' in f]), 2)
+
+
+    def test_file_sink(self):
+        outdir = tempfile.mkdtemp()
+        try:
+            task = self.make_task(output=FileSink(DatasourceDir(outdir)))
+            task._start(args={}, callback=self.callback)
+
+            self.assertEqual(sorted(os.listdir(outdir)), ['part-00000', 'part-00001'])
+
+            counts = {}
+            for summary in self.results:
+                lines = open(summary['path']).readlines()
+                self.assertEqual(summary['records'], len(lines))
+                self.assertEqual(summary['bytes'], sum(len(l) for l in lines))
+
+                for line in lines:
+                    word, count = line.split('\t')
+                    counts[word] = int(count)
+
+            self.assertEqual(counts, word_counts)
+
+        finally:
+            shutil.rmtree(outdir)
+
+
+    def test_callable_sink(self):
+        counts = {}
+        task = self.make_task(output=CallableSink(counts.__setitem__))
+        task._start(args={}, callback=self.callback)
+
+        self.assertEqual(counts, word_counts)
+        self.assertEqual(sum(s['records'] for s in self.results), len(word_counts))
+
+
+    def test_input_splits(self):
+        task = self.make_task(split_keys=2)
+        task._start(args={}, callback=self.callback)
+
+        self.assertEqual(self.results, word_counts)
+        self.assertEqual(task._maps_started, 2)
+
+
+    def test_run_no_input(self):
+        task = self.make_task(input=DatasourceDict({}))
+        task._start(args={}, callback=self.callback)
+
+        self.assertEqual(self.results, {})
+
+
+class WordPartitioner(HashPartitioner):
+    """puts every word to the partition given by a list"""
+
+    def __init__(self, words):
+        self.words = words
+
+    def partition(self, key, reducers):
+        return self.words.index(key)
+
+
 class IdentityMapTask(Task):
 
     def _work(self, input, output, **kwargs):
@@ -192,9 +659,21 @@ class IdentityReduceTask(Task):
             output[k] = v
 
 
+class SumReduceTask(Task):
+
+    def _work(self, input, output, **kwargs):
+
+        for k, vs in input:
+            output[k] = sum(vs)
+
+
 class NullIM():
     """dummy intermediate results class"""
 
+    def check_space(self):
+        pass
+
+
     def partition_output(self, output):
         return output
 
@@ -256,3 +735,93 @@ class MapReduceWrapper_Test(unittest.TestCase):
         returned = self.reducetask.get_subtask(key.split('.'))
         self.assert_(returned is expected, 'ReduceTask retrieved was not the expected Task')
 
+
+
+class GroupKeys_Test(unittest.TestCase):
+
+    def test_group_keys(self):
+        keys = range(7)
+        self.assertEqual(list(group_keys(keys, max_keys=3)),
+                [[0, 1, 2], [3, 4, 5], [6]])
+
+        self.assertEqual(list(group_keys(keys, max_bytes=10, size=lambda k: k)),
+                [[0, 1, 2, 3, 4], [5, 6]])
+
+    def test_group_keys_unknown_size(self):
+        keys = range(7)
+        self.assertEqual(list(group_keys(keys, max_bytes=10, size=lambda k: None)),
+                [keys])
+        self.assertEqual(list(group_keys(keys, 3, 10, lambda k: None)),
+                [[0, 1, 2], [3, 4, 5], [6]])
+
+
+class MapWrapperCombiner_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+        self.im = IntermediateResultsFiles(DatasourceDir(self.tempdir))
+        self.im.task_id = "test_task"
+        self.im.reducers = 2
+
+        self.worker = WorkerProxy()
+
+        self.maptask = MapWrapper(IdentityMapTask("IdentityMapTask"), self.im,
+                self.worker, SumReduceTask("SumReduceTask"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+
+    def test_combine(self):
+        a = [ ('a', 1), ('b', 2), ('a', 3), ('c', 1), ('b', 1), ('a', 1), ]
+
+        partitions = self.maptask._start(args={'input': a, 'id': 'map1'})
+        self.im.update_partitions(partitions)
+
+        # combined map output holds a single value per key
+        combined = {}
+        for p in self.im:
+            for k, vs in self.im.load(p):
+                vs = list(vs)
+                self.assertEqual(len(vs), 1)
+                combined[k] = vs[0]
+
+        self.assertEqual(combined, { 'a': 5, 'b': 3, 'c': 1 })
+
+
+class MapWrapperSpill_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+        self.im = IntermediateResultsFiles(DatasourceDir(self.tempdir))
+        self.im.task_id = "test_task"
+        self.im.reducers = 2
+
+        self.worker = WorkerProxy()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+
+    def test_spill(self):
+        maptask = MapWrapper(IdentityMapTask("IdentityMapTask"), self.im,
+                self.worker, buffer_records=3)
+
+        a = [ (k, 1) for k in 'abcabdaebf' ]
+
+        partitions = maptask._start(args={'input': a, 'id': 'map1'})
+        self.im.update_partitions(partitions)
+
+        # spilled runs are merged and removed
+        self.assertEqual(sorted(os.listdir(self.tempdir)),
+                sorted(key for key, records, bytes in partitions.values()))
+
+        counts = {}
+        for p in self.im:
+            for k, vs in self.im.load(p):
+                self.assert_(k not in counts)
+                counts[k] = sum(vs)
+
+        self.assertEqual(counts, { 'a': 3, 'b': 3, 'c': 1, 'd': 1, 'e': 1, 'f': 1 })
@@ -23,6 +23,8 @@ from twisted.trial import unittest as twisted_unittest
 from twisted.internet import threads
 
 from pydra_server.cluster.tasks.tasks import *
+from pydra_server.cluster.tasks.parallel_task import ParallelTask
+from pydra_server.cluster.tasks.datasource import DatasourceDict
 from pydra_server.task_cache.demo_task import *
 from proxies import *
 
@@ -127,4 +129,174 @@ class ParallelTask_Test(unittest.TestCase):
         """
         returned = self.parallel_task.subtask.get_worker()
         self.assert_(returned, 'no worker was returned')
-        self.assertEqual(returned, self.worker, 'worker retrieved was not the expected worker')    
\ No newline at end of file
+        self.assertEqual(returned, self.worker, 'worker retrieved was not the expected worker')    
+
+
+
+class SquareTask(Task):
+    def work(self, data):
+        return data*data
+
+
+class LoadSquareTask(Task):
+    def work(self, data):
+        value = self.parent.load(data)
+        return value*value
+
+
+class SquaresTask(ParallelTask):
+    """squares numbers, recording the sizes of workunits"""
+
+    def __init__(self, data, **kwargs):
+        ParallelTask.__init__(self)
+        self.subtask = SquareTask('square')
+        self._data = data
+        self.__dict__.update(kwargs)
+        self.squares = {}
+        self.batches = []
+
+    def get_work_unit(self):
+        data, index = ParallelTask.get_work_unit(self)
+        if data is not None:
+            self.batches.append(len(data) if self._batched() else 1)
+        return data, index
+
+    def work_unit_complete(self, data, results):
+        self.squares[data] = results
+
+    def work_complete(self):
+        return self.squares
+
+
+class ParallelTaskRun(unittest.TestCase):
+    """
+    Base class for tests running a ParallelTask on a QueueWorkerProxy
+    """
+
+    def run_task(self, task, workers=3, expected=None):
+        worker = QueueWorkerProxy(workers)
+        task.parent = worker
+        worker.queue_local(task.subtask)
+
+        self.results = None
+        def callback(results):
+            self.results = results
+
+        task._start({}, callback)
+        worker.run(task)
+
+        if expected is None:
+            expected = dict((i, i*i) for i in range(20))
+        self.assertEqual(self.results, expected)
+
+
+class ParallelTaskBatch_Test(ParallelTaskRun):
+    """
+    Tests for sending workunits of ParallelTask in batches
+    """
+
+
+    def test_single(self):
+        task = SquaresTask(range(20))
+        self.run_task(task)
+        self.assertEqual(task.batches, [1]*20)
+
+
+    def test_batch_size(self):
+        task = SquaresTask(range(20), batch_size=6)
+        self.run_task(task)
+        self.assertEqual(task.batches, [6, 6, 6, 2])
+
+
+    def test_guided(self):
+        task = SquaresTask(range(20), guided=True, batch_size=2)
+        self.run_task(task)
+
+        # batches shrink down to batch_size
+        self.assertEqual(task.batches, [7, 5, 3, 2, 2, 1])
+        self.assertEqual(task._data_in_progress, {})
+
+
+    def test_generator(self):
+        pulled = []
+        def numbers():
+            for i in range(20):
+                pulled.append(i)
+                yield i
+
+        task = SquaresTask(numbers(), batch_size=6, guided=True)
+        self.run_task(task)
+
+        # size of a generator is unknown, batch_size is used
+        self.assertEqual(task.batches, [6, 6, 6, 2])
+        self.assertEqual(pulled, range(20))
+
+
+    def test_datasource(self):
+        task = SquaresTask(DatasourceDict(dict((i, i) for i in range(20))))
+        task.subtask = LoadSquareTask('square')
+
+        # keys are sent, subtasks load the data
+        self.run_task(task, expected=dict(((i,), i*i) for i in range(20)))
+
+
+    def test_worker_failed(self):
+        task = SquaresTask(iter(range(20)), batch_size=4)
+        other = SquaresTask(range(20))
+        worker = QueueWorkerProxy(3)
+        task.parent = worker
+        worker.queue_local(task.subtask)
+        task._start({}, None)
+
+        # a remote batch is returned, another instance is not affected
+        subtask, args, index = worker.queue.pop(0)
+        task._worker_failed(index)
+        self.assertEqual(other._data_in_progress, {})
+        self.assertEqual(list(task._queue), args['batch'])
+
+
+class SumSquaresTask(SquaresTask):
+    """sums squares by merging, counting merges on the main worker"""
+
+    def merge(self, results1, results2):
+        return results1 + results2
+
+    def _merge_results(self, results):
+        self.merged.append(results)
+        SquaresTask._merge_results(self, results)
+
+    def work_complete(self):
+        return ParallelTask.work_complete(self)
+
+
+class ParallelTaskMerge_Test(ParallelTaskRun):
+    """
+    Tests for merging results of ParallelTask
+    """
+
+    def test_merge(self):
+        task = SumSquaresTask(range(20))
+        task.merged = []
+        self.run_task(task, expected=sum(i*i for i in range(20)))
+        self.assertEqual(len(task.merged), 20)
+
+
+    def test_merge_batches(self):
+        task = SumSquaresTask(range(20), guided=True)
+        task.merged = []
+        self.run_task(task, expected=sum(i*i for i in range(20)))
+
+        # batches are merged by the workers, one result for each
+        self.assertEqual(len(task.merged), len(task.batches))
+        self.assert_(len(task.merged) < 10)
+
+
+    def test_merge_batch_size(self):
+        task = SumSquaresTask(range(20), batch_size=6)
+        task.merged = []
+        self.run_task(task, expected=sum(i*i for i in range(20)))
+
+        # the main worker gets a sum for each batch instead of 20 squares
+        batches = [range(0, 6), range(6, 12), range(12, 18), range(18, 20)]
+        self.assertEqual(sorted(task.merged),
+                sorted(sum(i*i for i in batch) for batch in batches))
@@ -35,6 +35,47 @@ class WorkerProxy():
         return None
 
 
+class QueueWorkerProxy(WorkerProxy):
+    """
+    Worker proxy that queues work units instead of running them.  run() then
+    processes them one by one in the order they were started, as if they
+    were run by several workers.  Use queue_local() on subtasks which would
+    be started in a thread of this worker.
+    """
+
+    def __init__(self, available_workers=1):
+        self.available_workers = available_workers
+        self.queue = []
+        self.failures = []
+
+    def work_failed(self, failure):
+        self.failures.append(failure)
+
+    def request_worker(self, subtask_key, args, workunit_key):
+        self.queue.append((subtask_key, args, workunit_key))
+
+    def queue_local(self, subtask):
+        def start(args={}, subtask_key=None, callback=None, callback_args={}, errback=None):
+            self.queue.append((subtask, args, (callback, callback_args)))
+        subtask.start = start
+
+    def run(self, task):
+        """
+        runs queued work units, remote results are sent to task
+        """
+        while self.queue:
+            subtask, args, workunit_key = self.queue.pop(0)
+
+            if isinstance(subtask, str):
+                subtask = task.get_subtask(subtask.split('.'))
+                results = subtask._start(args)
+                task._work_unit_complete(results, workunit_key)
+
+            else:
+                callback, callback_args = workunit_key
+                subtask._start(args, callback, callback_args)
+
+
 class StartupAndWaitTask(Task):
     """
     Task that runs indefinitely.  Used for tests that
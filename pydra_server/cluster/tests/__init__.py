@@ -21,6 +21,7 @@ import unittest
 
 from pydra_server.cluster.auth.tests import suite as auth_suite
 from pydra_server.cluster.tasks.tests import suite as tasks_suite
+from pydra_server.cluster.tests.slots import suite as slots_suite
 
 
 def suite():
@@ -30,5 +31,6 @@ def suite():
     cluster_suite = unittest.TestSuite()
     cluster_suite.addTest(auth_suite())
     cluster_suite.addTest(tasks_suite())
+    cluster_suite.addTest(slots_suite())
 
     return cluster_suite
\ No newline at end of file
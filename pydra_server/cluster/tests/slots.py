@@ -0,0 +1,187 @@
+"""
+    Copyright 2009 Oregon State University
+
+    This file is part of Pydra.
+
+    Pydra is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Pydra is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Pydra.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import unittest
+from threading import Lock
+from twisted.internet import defer
+
+from pydra_server.cluster.slots import WorkerSlots
+from pydra_server.cluster.worker import Worker, WorkerSlot
+from pydra_server.cluster.constants import *
+
+
+def suite():
+    """
+    Build a test suite from all the test suites in this module
+    """
+    slots_suite = unittest.TestSuite()
+    slots_suite.addTest(unittest.makeSuite(WorkerSlots_Test))
+    slots_suite.addTest(unittest.makeSuite(WorkerSlot_Test))
+
+    return slots_suite
+
+
+class WorkerSlots_Test(unittest.TestCase):
+    """
+    Tests of bookkeeping of worker slots in the Master
+    """
+
+    def setUp(self):
+        self.slots = WorkerSlots()
+        for slot in range(2):
+            self.slots.add_idle('w1', slot)
+        self.slots.add_idle('w2', 0)
+
+
+    def test_select_release(self):
+        self.assertEqual(len(self.slots), 3)
+        self.failIf(self.slots.add_idle('w1', 0))
+
+        self.assertEqual(self.slots.select('job1'), ('w1', 0))
+        self.assertEqual(self.slots.select('job2'), ('w2', 0))
+        self.assertEqual(self.slots.select('job3'), ('w1', 1))
+        self.assertEqual(self.slots.job('w1', 1), 'job3')
+        self.assertEqual(len(self.slots), 0)
+        self.assertEqual(self.slots.status('w1'), {0:'job1', 1:'job3'})
+
+        self.assertEqual(self.slots.release('w1', 0), 'job1')
+        self.assertEqual(self.slots.status('w1'), {0:None, 1:'job3'})
+
+        # workers without working slots are not kept
+        self.slots.release('w1', 1)
+        self.slots.release('w2', 0)
+        self.assertEqual(self.slots.working, {})
+        self.assertEqual(self.slots.idle, [('w1', 0), ('w1', 1), ('w2', 0)])
+
+
+    def test_spread(self):
+        slots = WorkerSlots()
+        for worker_key in ('w1', 'w2'):
+            for slot in range(2):
+                slots.add_idle(worker_key, slot)
+
+        # work goes to the least busy worker
+        selected = [slots.select(i)[0] for i in range(4)]
+        self.assertEqual(selected, ['w1', 'w2', 'w1', 'w2'])
+
+        # w1 is idle, w2 still has a busy slot
+        slots.release('w1', 0)
+        slots.release('w1', 1)
+        slots.release('w2', 0)
+        self.assertEqual(slots.select('job'), ('w1', 0))
+
+
+    def test_no_idle_slots(self):
+        for i in range(3):
+            self.slots.select(i)
+
+        self.assertEqual(self.slots.select('job'), (None, None))
+        self.assertEqual(sorted(self.slots.jobs()), [('w1', 0, 0), ('w1', 1, 2), ('w2', 0, 1)])
+
+
+    def test_remove_worker(self):
+        self.slots.select('job')
+
+        self.assertEqual(self.slots.remove_worker('w1'), {0:'job'})
+        self.assertEqual(self.slots.idle, [('w2', 0)])
+
+        self.slots.release('w1', 0, idle=False)
+        self.assertEqual(self.slots.status('w1'), {})
+        self.assertEqual(self.slots.working, {})
+
+
+
+class MasterProxy(object):
+    """
+    Records calls of a worker to the master
+    """
+    def __init__(self):
+        self.calls = []
+
+    def callRemote(self, *args):
+        self.calls.append(args)
+        return defer.succeed(None)
+
+
+class QueuedTask(object):
+    """
+    Task that is not run until the test calls its callback
+    """
+    STOP_FLAG = False
+
+    def start(self, args={}, subtask_key=None, callback=None, callback_args={}, errback=None):
+        self.callback = callback
+        self.callback_args = callback_args
+        return 1
+
+    def complete(self, results):
+        self.callback(results, **self.callback_args)
+
+
+class SlotWorker(Worker):
+    """
+    Worker that does not connect anywhere
+    """
+    def __init__(self, slots):
+        self._Worker__lock = Lock()
+        self._Worker__lock_connection = Lock()
+        self.worker_key = 'localhost:11890:0'
+        self.master = MasterProxy()
+        self.available_tasks = {'QueuedTask':QueuedTask}
+        self.slots = [WorkerSlot(self, i) for i in range(slots)]
+
+
+class WorkerSlot_Test(unittest.TestCase):
+    """
+    Tests of running tasks in slots of a worker
+    """
+
+    def setUp(self):
+        self.worker = SlotWorker(2)
+
+
+    def test_run_in_slots(self):
+        worker = self.worker
+        self.assertEqual(worker.status(), [(WORKER_STATUS_IDLE,), (WORKER_STATUS_IDLE,)])
+
+        self.assertEqual(worker.run_task('QueuedTask', {}, None, 'unit0', 2, 0), 1)
+        self.assertEqual(worker.run_task('QueuedTask', {}, 'QueuedTask', 'unit1', 2, 1), 1)
+        self.assert_(worker.run_task('QueuedTask', {}, None, 'unit2', 2, 1).startswith('FAILURE'))
+
+        self.assertEqual(worker.status(), [(WORKER_STATUS_WORKING, 'QueuedTask', None),
+                                           (WORKER_STATUS_WORKING, 'QueuedTask', 'QueuedTask')])
+
+        # each slot has its own task instance, parented by the slot
+        task = worker.slots[1].task_instance
+        self.assert_(task is not worker.slots[0].task_instance)
+        self.assert_(task.parent.get_worker() is worker.slots[1])
+
+        task.complete('results')
+        self.assertEqual(worker.master.calls, [('send_results', 'results', 'unit1', 1)])
+        self.assertEqual(worker.status()[1], (WORKER_STATUS_IDLE,))
+
+        # freed slot runs another task
+        self.assertEqual(worker.run_task('QueuedTask', {}, None, 'unit2', 2, 1), 1)
+
+
+    def test_request_worker(self):
+        self.worker.run_task('QueuedTask', {}, None, 'unit0', 2, 1)
+        self.worker.slots[1].request_worker('QueuedTask', {'data':1}, 3)
+
+        self.assertEqual(self.worker.master.calls, [('request_worker', 'QueuedTask', {'data':1}, 3, 1)])
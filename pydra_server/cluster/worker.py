@@ -41,6 +41,7 @@ from twisted.internet import reactor
 from twisted.cred import credentials
 from twisted.internet.protocol import ReconnectingClientFactory
 from threading import Lock
+from functools import partial
 
 from pydra_server.cluster.auth.rsa_auth import RSAClient, load_crypto
 from pydra_server.cluster.tasks.task_manager import TaskManager
@@ -75,18 +76,63 @@ class MasterClientFactory(pb.PBClientFactory):
 
 
 
+class WorkerSlot(object):
+    """
+    WorkerSlot - A Worker runs one Task (or work unit) per slot.  A Worker with several slots runs
+            several of them concurrently, each in its own thread.  The slot is the parent of the
+            Task instances it runs, so they report to the Master through it.
+    """
+    def __init__(self, worker, slot):
+        self.worker = worker
+        self.slot = slot
+        self.worker_key = worker.worker_key
+        self.available_workers = 1
+
+        self.task = None
+        self.subtask = None
+        self.workunit_key = None
+        self.task_instance = None
+        self.results = None
+        self.stop_flag = None
+
+
+    def request_worker(self, subtask_key, args, workunit_key):
+        return self.worker.request_worker(subtask_key, args, workunit_key, self.slot)
+
+
+    def work_failed(self, failure):
+        """
+        Reports a failure of the task after it was started (e.g. one of its local work units)
+        """
+        return self.worker.work_failed(failure, self.slot)
+
+
+    def get_worker(self):
+        """
+        Recursive function so tasks can find this worker
+        """
+        return self
+
+
+    def get_key(self):
+        """
+        recursive task key generation function.  This stops the recursion
+        """
+        return None
+
+
+
 class Worker(pb.Referenceable):
     """
     Worker - The Worker is the workhorse of the cluster.  It sits and waits for Tasks and SubTasks to be executed
             Each Task will be run on a single Worker.  If the Task or any of its subtasks are a ParallelTask 
             the first worker will make requests for work to be distributed to other Nodes
+
+            A Worker has a number of slots, each of them running a Task.  More slots than cores helps
+            when the work units are waiting for I/O (databases, intermediate files of other nodes)
     """
-    def __init__(self, master_host, master_port, node_key, worker_key):
+    def __init__(self, master_host, master_port, node_key, worker_key, slots=1):
         self.id = id
-        self.__task = None
-        self.__task_instance = None
-        self.__results = None
-        self.__stop_flag = None
         self.__lock = Lock()
         self.__lock_connection = Lock()
         self.master = None
@@ -95,6 +141,7 @@ class Worker(pb.Referenceable):
         self.node_key = node_key
         self.worker_key = worker_key
         self.reconnect_count = 0
+        self.slots = [WorkerSlot(self, i) for i in range(slots)]
 
         # load crypto for authentication
         # workers use the same keys as their parent Node
@@ -107,7 +154,7 @@ class Worker(pb.Referenceable):
         self.task_manager.autodiscover()
         self.available_tasks = self.task_manager.registry
 
-        logger.info('Started Worker: %s' % worker_key)
+        logger.info('Started Worker: %s (%d slots)' % (worker_key, slots))
         self.connect()
 
     def connect(self):
@@ -153,28 +200,31 @@ class Worker(pb.Referenceable):
         """
         self.reconnect()
 
-    def run_task(self, key, args={}, subtask_key=None, workunit_key=None, available_workers=1):
+    def run_task(self, key, args={}, subtask_key=None, workunit_key=None, available_workers=1, slot=0):
         """
-        Runs a task on this worker
+        Runs a task in a slot of this worker
         """
+        worker_slot = self.slots[slot]
 
-        #Check to ensure this worker is not already busy.
+        #Check to ensure this slot is not already busy.
         # The Master should catch this but lets be defensive.
         with self.__lock:
-            if self.__task:
-                return "FAILURE THIS WORKER IS ALREADY RUNNING A TASK"
-            self.__task = key
-            self.__subtask = subtask_key
-            self.__workunit_key = workunit_key
+            if worker_slot.task:
+                return "FAILURE THIS WORKER SLOT IS ALREADY RUNNING A TASK"
+            worker_slot.task = key
+            worker_slot.subtask = subtask_key
+            worker_slot.workunit_key = workunit_key
 
-        self.available_workers = available_workers
+        worker_slot.available_workers = available_workers
 
-        logger.info('Worker:%s - starting task: %s:%s  %s' % (self.worker_key, key,subtask_key, args))
+        logger.info('Worker:%s - starting task in slot %d: %s:%s  %s' % (self.worker_key, slot, key,subtask_key, args))
         #create an instance of the requested task
-        if not self.__task_instance or self.__task_instance.__class__.__name__ != key:
-            self.__task_instance = object.__new__(self.available_tasks[key])
-            self.__task_instance.__init__()
-            self.__task_instance.parent = self
+        task_instance = worker_slot.task_instance
+        if not task_instance or task_instance.__class__.__name__ != key:
+            task_instance = object.__new__(self.available_tasks[key])
+            task_instance.__init__()
+            task_instance.parent = worker_slot
+            worker_slot.task_instance = task_instance
 
         # process args to make sure they are no longer unicode
         clean_args = {}
@@ -182,73 +232,83 @@ class Worker(pb.Referenceable):
             for key, arg in args.items():
                 clean_args[key.__str__()] = arg
 
-        return self.__task_instance.start(clean_args, subtask_key, self.work_complete, errback=self.work_failed)
+        return task_instance.start(clean_args, subtask_key, self.work_complete, {'slot':slot},
+                errback=partial(self.work_failed, slot=slot))
 
 
-    def stop_task(self):
+    def stop_task(self, slot=None):
         """
-        Stops the current task
+        Stops the task running in a slot, or in all the slots
         """
         logger.info('%s - Received STOP command' % self.worker_key)
-        if self.__task_instance:
-            self.__task_instance._stop()
+        slots = self.slots if slot is None else [self.slots[slot]]
+        for worker_slot in slots:
+            if worker_slot.task_instance:
+                worker_slot.task_instance._stop()
 
 
     def status(self):
         """
-        Return the status of the current task if running, else None
+        Return the statuses of all the slots: the task if running, else None
         """
-        # if there is a task it must still be running
-        if self.__task:
-            return (WORKER_STATUS_WORKING, self.__task, self.__subtask)
+        statuses = []
+        for worker_slot in self.slots:
+            # if there is a task it must still be running
+            if worker_slot.task:
+                statuses.append((WORKER_STATUS_WORKING, worker_slot.task, worker_slot.subtask))
 
-        # if there are results it was waiting for the master to retrieve them
-        if self.__results:
-            return (WORKER_STATUS_FINISHED, self.__task, self.__subtask)
+            # if there are results it was waiting for the master to retrieve them
+            elif worker_slot.results:
+                statuses.append((WORKER_STATUS_FINISHED, worker_slot.task, worker_slot.subtask))
 
-        return (WORKER_STATUS_IDLE,)
+            else:
+                statuses.append((WORKER_STATUS_IDLE,))
+
+        return statuses
 
 
-    def work_complete(self, results):
+    def work_complete(self, results, slot=0):
         """
         Callback that is called when a job is run in non_blocking mode.
         """
-        stop_flag = self.__task_instance.STOP_FLAG
-        self.__task = None
+        worker_slot = self.slots[slot]
+        stop_flag = worker_slot.task_instance.STOP_FLAG
+        worker_slot.task = None
 
         if stop_flag:
             #stop flag, this task was canceled.
             with self.__lock_connection:
                 if self.master:
-                    deferred = self.master.callRemote("stopped")
-                    deferred.addErrback(self.send_stopped_failed)
+                    deferred = self.master.callRemote("stopped", slot)
+                    deferred.addErrback(self.send_stopped_failed, slot)
                 else:
-                    self.__stop_flag = True
+                    worker_slot.stop_flag = True
 
         else:
             #completed normally
             # if the master is still there send the results
             with self.__lock_connection:
                 if self.master:
-                    deferred = self.master.callRemote("send_results", results, self.__workunit_key)
-                    deferred.addErrback(self.send_results_failed, results, self.__workunit_key)
+                    deferred = self.master.callRemote("send_results", results, worker_slot.workunit_key, slot)
+                    deferred.addErrback(self.send_results_failed, results, worker_slot.workunit_key, slot)
 
                 # master disapeared, hold results until it requests them
                 else:
-                    self.__results = results
+                    worker_slot.results = results
 
 
-    def work_failed(self, results):
+    def work_failed(self, results, slot=0):
         """
         Callback that there was an exception thrown by the task
         """
-        self.__task = None
+        worker_slot = self.slots[slot]
+        worker_slot.task = None
 
         with self.__lock_connection:
             if self.master:
-                deferred = self.master.callRemote("failed", results, self.__workunit_key)
+                deferred = self.master.callRemote("failed", results, worker_slot.workunit_key, slot)
                 logger.error('Worker - Task Failed: %s' % results)
-                #deferred.addErrback(self.send_failed_failed, results, self.__workunit_key)
+                #deferred.addErrback(self.send_failed_failed, results, worker_slot.workunit_key)
 
             # master disapeared, hold failure until it comes back online and requests it
             else:
@@ -256,7 +316,7 @@ class Worker(pb.Referenceable):
                 pass
 
 
-    def send_results_failed(self, results, task_results, workunit_key):
+    def send_results_failed(self, results, task_results, workunit_key, slot=0):
         """
         Errback called when sending results to the master fails.  resend when
         master reconnects
@@ -275,11 +335,11 @@ class Worker(pb.Referenceable):
             else:
                 #nope really isn't connected.  set flag.  even if connection is in progress
                 #this thread has the lock and reconnection cant finish till we release it
-                self.__results = task_results
-                self.__workunit_key = workunit_key
+                self.slots[slot].results = task_results
+                self.slots[slot].workunit_key = workunit_key
 
 
-    def send_stopped_failed(self, results):
+    def send_stopped_failed(self, results, slot=0):
         """
         failed to send the stopped message.  set the flag and wait for master to reconnect
         """
@@ -297,35 +357,36 @@ class Worker(pb.Referenceable):
             else:
                 #nope really isn't connected.  set flag.  even if connection is in progress
                 #this thread has the lock and reconnection cant finish till we release it
-                self.__stop_flag = True
+                self.slots[slot].stop_flag = True
 
 
-    def task_status(self):
+    def task_status(self, slot=0):
         """
-        Returns status of task this task is performing
+        Returns status of task the slot is performing
         """
-        if self.__task_instance:
-            return self.__task_instance.progress()
+        task_instance = self.slots[slot].task_instance
+        if task_instance:
+            return task_instance.progress()
 
 
-    def receive_results(self, results, subtask_key, workunit_key):
+    def receive_results(self, results, subtask_key, workunit_key, slot=0):
         """
         Function called to make the subtask receive the results processed by another worker
         """
         logger.info('Worker:%s - received REMOTE results for: %s' % (self.worker_key, subtask_key))
-        subtask = self.__task_instance.get_subtask(subtask_key.split('.'))
+        subtask = self.slots[slot].task_instance.get_subtask(subtask_key.split('.'))
         subtask.parent._work_unit_complete(results, workunit_key)
 
 
-    def request_worker(self, subtask_key, args, workunit_key):
+    def request_worker(self, subtask_key, args, workunit_key, slot=0):
         """
         Requests a work unit be handled by another worker in the cluster
         """
         logger.info('Worker:%s - requesting worker for: %s' % (self.worker_key, subtask_key))
-        deferred = self.master.callRemote('request_worker', subtask_key, args, workunit_key)
+        deferred = self.master.callRemote('request_worker', subtask_key, args, workunit_key, slot)
 
-    def return_work(self, subtask_key, workunit_key):
-        subtask = self.__task_instance.get_subtask(subtask_key.split('.'))
+    def return_work(self, subtask_key, workunit_key, slot=0):
+        subtask = self.slots[slot].task_instance.get_subtask(subtask_key.split('.'))
         subtask.parent._worker_failed(workunit_key)
 
 
@@ -349,24 +410,24 @@ class Worker(pb.Referenceable):
     def remote_task_list(self):
         return self.available_tasks.keys()
 
-    def remote_run_task(self, key, args={}, subtask_key=None, workunit_key=None, available_workers=1):
-        return self.run_task(key, args, subtask_key, workunit_key, available_workers)
+    def remote_run_task(self, key, args={}, subtask_key=None, workunit_key=None, available_workers=1, slot=0):
+        return self.run_task(key, args, subtask_key, workunit_key, available_workers, slot)
 
-    def remote_stop_task(self):
-        return self.stop_task()
+    def remote_stop_task(self, slot=None):
+        return self.stop_task(slot)
 
-    def remote_receive_results(self, results, subtask_key, workunit_key):
-        return self.receive_results(results, subtask_key, workunit_key)
+    def remote_receive_results(self, results, subtask_key, workunit_key, slot=0):
+        return self.receive_results(results, subtask_key, workunit_key, slot)
 
-    def remote_return_work(self, subtask_key, workunit_key):
+    def remote_return_work(self, subtask_key, workunit_key, slot=0):
         """
         Called by the Master when a Worker disconnected while working on a task.
         The work unit is returned so another worker can finish it.
         """
-        return self.return_work(subtask_key, workunit_key)
+        return self.return_work(subtask_key, workunit_key, slot)
 
-    def remote_task_status(self):
-        return self.task_status()
+    def remote_task_status(self, slot=0):
+        return self.task_status(slot)
 
 
 if __name__ == "__main__":
@@ -374,6 +435,7 @@ if __name__ == "__main__":
     master_port = int(sys.argv[2])
     node_key    = sys.argv[3]
     worker_key  = sys.argv[4]
+    slots       = int(sys.argv[5]) if len(sys.argv) > 5 else 1
 
-    worker = Worker(master_host, master_port, node_key, worker_key)
+    worker = Worker(master_host, master_port, node_key, worker_key, slots)
     reactor.run()
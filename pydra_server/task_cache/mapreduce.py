@@ -4,7 +4,7 @@ from pydra_server.cluster.tasks.mapreduce import MapReduceTask, \
         IntermediateResultsFiles, IntermediateResultsSQL
 
 from pydra_server.cluster.tasks.datasource import DatasourceDict, \
-        DatasourceDir, DatasourceSQL, SQLTableSlicer
+        DatasourceDir, DatasourceShuffle, DatasourceSQL, SQLTableSlicer
 
 import logging
 logger = logging.getLogger('root')
@@ -28,20 +28,10 @@ class ReduceWords(Task):
     def work(self, input, output, **kwargs):
         """sum occurances of each word"""
 
-        d = {}
-
-        # WARNING the same key can appear more than once
-        for word, v in input:
-            try:
-                v = sum(v)
-            except:
-                pass
-
-            d[word] = int(v) + d.get(word, 0)
-
-        for word, num in d.iteritems():
+        # input is grouped, every word comes once with all its values
+        for word, values in input:
             # emmit output (word, num)
-            output[word] = num
+            output[word] = sum(int(v) for v in values)
 
 
 class CountWords(MapReduceTask):
@@ -58,6 +48,7 @@ class CountWords(MapReduceTask):
             #    host='192.168.56.1', db='mapreduce'),
             'dir': DatasourceDir(dir='/mnt/shared/in'),
             'dir_i9e': DatasourceDir(dir='/mnt/shared/i9e'),
+            #'dir_i9e': DatasourceShuffle(dir='/var/lib/pydra/i9e', port=11891),
             }
 
     #input = datasources['dict']
@@ -71,8 +62,10 @@ class CountWords(MapReduceTask):
 
     map = MapWords
     reduce = ReduceWords
+    combine = ReduceWords
 
-    intermediate = IntermediateResultsFiles(dir=datasources['dir_i9e'])
+    intermediate = IntermediateResultsFiles(dir=datasources['dir_i9e'],
+            format='block', compression='zlib')
     #intermediate = IntermediateResultsSQL(table='count_words_i9e', db=datasources['sql'])
 
     reducers = 2